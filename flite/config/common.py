@@ -10,6 +10,43 @@ ROOT_DIR = environ.Path(__file__) - 3
 
 environ.Env.read_env(str(ROOT_DIR.path('.env')))
 
+
+def replica_databases():
+    """Database settings for each url in the comma separated DATABASE_REPLICA_URLS"""
+    urls = filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(','))
+    databases = {}
+    for index, url in enumerate(urls, 1):
+        databases['replica{}'.format(index)] = dict(
+            dj_database_url.parse(url, conn_max_age=int(os.getenv('POSTGRES_CONN_MAX_AGE', 600))),
+            TEST={'MIRROR': 'default'},
+        )
+    return databases
+
+
+def pooled(database):
+    """
+    Switches a Postgres database to the pooled backend when DATABASE_POOL
+    is set. Connections then go back to the pool at the end of each
+    request instead of staying open for CONN_MAX_AGE.
+    """
+    if not strtobool(os.getenv('DATABASE_POOL', 'no')) or 'postgresql' not in database['ENGINE']:
+        return database
+    return dict(
+        database,
+        ENGINE='flite.core.db.backends.postgresql_pool',
+        CONN_MAX_AGE=0,
+        POOL={
+            'MIN_SIZE': int(os.getenv('DATABASE_POOL_MIN_SIZE', 2)),
+            'MAX_SIZE': int(os.getenv('DATABASE_POOL_MAX_SIZE', 20)),
+            # seconds a request waits for a free connection
+            'TIMEOUT': float(os.getenv('DATABASE_POOL_TIMEOUT', 5)),
+            # seconds a connection above MIN_SIZE may sit idle
+            'MAX_IDLE': float(os.getenv('DATABASE_POOL_MAX_IDLE', 300)),
+            'PRE_PING': strtobool(os.getenv('DATABASE_POOL_PRE_PING', 'yes')),
+        },
+    )
+
+
 class Common(Configuration):
 
     INSTALLED_APPS = (
@@ -35,6 +72,8 @@ class Common(Configuration):
 
     # https://docs.djangoproject.com/en/2.0/topics/http/middleware/
     MIDDLEWARE = (
+        'flite.core.middleware.RequestMetricsMiddleware',
+        'flite.core.middleware.RequestTimingMiddleware',
         'django.middleware.security.SecurityMiddleware',
         'whitenoise.middleware.WhiteNoiseMiddleware',
         'django.contrib.sessions.middleware.SessionMiddleware',
@@ -43,6 +82,7 @@ class Common(Configuration):
         'django.contrib.auth.middleware.AuthenticationMiddleware',
         'django.contrib.messages.middleware.MessageMiddleware',
         'django.middleware.clickjacking.XFrameOptionsMiddleware',
+        'flite.core.middleware.ReplicaPinningMiddleware',
     )
 
     ALLOWED_HOSTS = ["*"]
@@ -64,6 +104,122 @@ class Common(Configuration):
             conn_max_age=int(os.getenv('POSTGRES_CONN_MAX_AGE', 600))
         )
     }
+    # Read replicas; reads are spread over them by
+    # flite.core.routers.ReplicaRouter
+    DATABASES.update(replica_databases())
+    DATABASES = {alias: pooled(database) for alias, database in DATABASES.items()}
+    DATABASE_REPLICAS = sorted(alias for alias in DATABASES if alias != 'default')
+    DATABASE_ROUTERS = ['flite.core.routers.ReplicaRouter']
+    # How long a client reads from the primary after writing
+    REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+    REPLICA_PIN_CACHE = 'default'
+    # Replicas further behind than this are skipped
+    REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 10))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 5))
+
+    # Share of requests (0 to 1) that get a Server-Timing header and a
+    # timing line on the flite.requests logger
+    REQUEST_TIMING_SAMPLE_RATE = float(os.getenv('REQUEST_TIMING_SAMPLE_RATE', 0))
+    # Bearer token required to scrape /metrics; open when unset
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+    # Cache
+    # Point CACHE_URL at memcached or redis so every worker shares the same
+    # store; Production refuses to start with a cache local to one process.
+    CACHES = {
+        'default': environ.Env.cache_url_config(os.getenv('CACHE_URL', 'locmemcache://')),
+    }
+
+    # Idempotency-Key handling for money-movement endpoints
+    IDEMPOTENCY_CACHE = 'default'
+    IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+    # How long a retry waits for the in-flight request with the same key
+    IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', 10))
+    # Upper bound on how long a crashed request can hold a key
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+    # Ledger
+    # Retries for postings aborted by a deadlock or serialization failure
+    LEDGER_MAX_RETRIES = int(os.getenv('LEDGER_MAX_RETRIES', 3))
+    LEDGER_RETRY_BASE_DELAY = float(os.getenv('LEDGER_RETRY_BASE_DELAY', 0.02))
+    LEDGER_RETRY_MAX_DELAY = float(os.getenv('LEDGER_RETRY_MAX_DELAY', 0.5))
+    # Largest number of payouts accepted by one bulk transfer request
+    BULK_TRANSFER_MAX_ITEMS = int(os.getenv('BULK_TRANSFER_MAX_ITEMS', 1000))
+    # Rows fetched per round trip from the server-side cursor of an export
+    EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 2000))
+    # Cached account balances; postings drop them on commit, and entries
+    # expire after the TTL, which bounds how stale a read can be
+    BALANCE_CACHE = 'default'
+    BALANCE_CACHE_TTL = int(os.getenv('BALANCE_CACHE_TTL', 60))
+
+    # Background jobs, see flite.core.jobs
+    # Seconds before the first retry of a failed job; it doubles per attempt
+    JOB_RETRY_BACKOFF = int(os.getenv('JOB_RETRY_BACKOFF', 10))
+    JOB_MAX_BACKOFF = int(os.getenv('JOB_MAX_BACKOFF', 60 * 60))
+    # Jobs running for longer are assumed to belong to a dead worker
+    JOB_LOCK_TIMEOUT = int(os.getenv('JOB_LOCK_TIMEOUT', 15 * 60))
+
+    # SMS, see flite.core.sms
+    SMS_BACKEND = os.getenv('SMS_BACKEND', 'flite.core.sms.backends.console.SmsBackend')
+    SMS_GATEWAY_URL = os.getenv('SMS_GATEWAY_URL', 'http://localhost:8025/messages')
+    SMS_GATEWAY_TOKEN = os.getenv('SMS_GATEWAY_TOKEN')
+    # Most messages the gateway takes in one request
+    SMS_GATEWAY_BATCH_SIZE = int(os.getenv('SMS_GATEWAY_BATCH_SIZE', 100))
+    SMS_GATEWAY_TIMEOUT = float(os.getenv('SMS_GATEWAY_TIMEOUT', 10))
+    # Batches a dispatcher sends at once
+    SMS_CONCURRENCY = int(os.getenv('SMS_CONCURRENCY', 4))
+    # Most messages a dispatcher sends a second, 0 for no limit
+    SMS_RATE_LIMIT = float(os.getenv('SMS_RATE_LIMIT', 0))
+    SMS_MAX_ATTEMPTS = int(os.getenv('SMS_MAX_ATTEMPTS', 5))
+    # Messages being sent for longer are assumed to belong to a dead dispatcher
+    SMS_LOCK_TIMEOUT = int(os.getenv('SMS_LOCK_TIMEOUT', 5 * 60))
+
+    # Webhooks for ledger events, see flite.users.webhooks
+    # Most events posted to an endpoint in one request
+    WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 100))
+    # Batches a dispatcher posts at once, also its connections per endpoint host
+    WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', 4))
+    WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', 10))
+    # Attempts before a delivery is dead-lettered
+    WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+    # Deliveries being sent for longer are assumed to belong to a dead dispatcher
+    WEBHOOK_LOCK_TIMEOUT = int(os.getenv('WEBHOOK_LOCK_TIMEOUT', 5 * 60))
+    # Age before an event of a sharded balance is fanned out, as TRANSACTION_STREAM_SHARDED_LAG
+    WEBHOOK_SHARDED_LAG = float(os.getenv('WEBHOOK_SHARDED_LAG', 2))
+
+    # Transaction streams, see flite.users.streams
+    # Off in the API's gunicorn workers, on in the stream server's (flite.gunicorn_streams)
+    TRANSACTION_STREAMS_ENABLED = strtobool(os.getenv('TRANSACTION_STREAMS_ENABLED', 'yes'))
+    # Seconds of quiet before a stream sends a keep-alive
+    TRANSACTION_STREAM_HEARTBEAT = float(os.getenv('TRANSACTION_STREAM_HEARTBEAT', 15))
+    # Seconds before a stream ends and its client reconnects
+    TRANSACTION_STREAM_MAX_DURATION = float(os.getenv('TRANSACTION_STREAM_MAX_DURATION', 5 * 60))
+    # Age before an event of a sharded balance is sent; longer than a
+    # posting takes to commit after writing its events
+    TRANSACTION_STREAM_SHARDED_LAG = float(os.getenv('TRANSACTION_STREAM_SHARDED_LAG', 2))
+
+    # Monthly partitions of the transaction entries, see flite.users.partitions
+    TRANSACTION_PARTITION_MONTHS_AHEAD = int(os.getenv('TRANSACTION_PARTITION_MONTHS_AHEAD', 3))
+    # Months of entries kept attached, 0 to keep all of them
+    TRANSACTION_PARTITION_RETENTION_MONTHS = int(os.getenv('TRANSACTION_PARTITION_RETENTION_MONTHS', 0))
+    # Seconds partition DDL waits for its lock before giving up
+    TRANSACTION_PARTITION_LOCK_TIMEOUT = float(os.getenv('TRANSACTION_PARTITION_LOCK_TIMEOUT', 5))
+
+    # Phone verification
+    PHONE_VERIFICATION_CACHE = 'default'
+    # Seconds a verification code stays valid
+    PHONE_VERIFICATION_CODE_TTL = int(os.getenv('PHONE_VERIFICATION_CODE_TTL', 10 * 60))
+    # Wrong codes accepted before a new code has to be requested
+    PHONE_VERIFICATION_MAX_ATTEMPTS = int(os.getenv('PHONE_VERIFICATION_MAX_ATTEMPTS', 5))
+
+    # Token authentication, see flite.core.authentication
+    # Resolved tokens kept per process, and for how long
+    TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+    TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 30))
+    # Optional cache alias shared by all workers, e.g. 'default' on redis
+    TOKEN_SHARED_CACHE = os.getenv('TOKEN_SHARED_CACHE') or None
+    # Holds the token generations that tell every worker a token was revoked
+    TOKEN_REVOCATION_CACHE = 'default'
 
     # General
     APPEND_SLASH = False
@@ -147,6 +303,9 @@ class Common(Configuration):
             'simple': {
                 'format': '%(levelname)s %(message)s'
             },
+            'message': {
+                'format': '%(message)s'
+            },
         },
         'filters': {
             'require_debug_true': {
@@ -164,6 +323,11 @@ class Common(Configuration):
                 'class': 'logging.StreamHandler',
                 'formatter': 'simple'
             },
+            'request_timings': {
+                'level': 'INFO',
+                'class': 'logging.StreamHandler',
+                'formatter': 'message'
+            },
             'mail_admins': {
                 'level': 'ERROR',
                 'class': 'django.utils.log.AdminEmailHandler'
@@ -188,6 +352,11 @@ class Common(Configuration):
                 'handlers': ['console'],
                 'level': 'INFO'
             },
+            'flite.requests': {
+                'handlers': ['request_timings'],
+                'level': 'INFO',
+                'propagate': False,
+            },
         }
     }
 
@@ -208,7 +377,11 @@ class Common(Configuration):
         ],
         'DEFAULT_AUTHENTICATION_CLASSES': (
             'rest_framework.authentication.SessionAuthentication',
-            'rest_framework.authentication.TokenAuthentication',
+            'flite.core.authentication.CachedTokenAuthentication',
         ),
-        'EXCEPTION_HANDLER': 'flite.core.utils.exception_handler'
+        'EXCEPTION_HANDLER': 'flite.core.utils.exception_handler',
+        'DEFAULT_THROTTLE_RATES': {
+            'phone_verification_ip': os.getenv('PHONE_VERIFICATION_IP_RATE', '20/hour'),
+            'phone_verification_number': os.getenv('PHONE_VERIFICATION_NUMBER_RATE', '5/hour'),
+        },
     }
@@ -1,6 +1,15 @@
 import os
+
+from django.core.exceptions import ImproperlyConfigured
+
 from .common import Common
 
+# Cache backends that keep their entries in one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
 
 class Production(Common):
     INSTALLED_APPS = Common.INSTALLED_APPS
@@ -30,3 +39,19 @@ class Production(Common):
     AWS_HEADERS = {
         'Cache-Control': 'max-age=86400, s-maxage=86400, must-revalidate',
     }
+
+    @classmethod
+    def post_setup(cls):
+        super().post_setup()
+        # Idempotency keys, read pins, pending verification codes, throttles
+        # and the other cached state only work when every worker sees the
+        # same entries
+        local = sorted(
+            alias for alias, cache in cls.CACHES.items() if cache['BACKEND'] in PROCESS_LOCAL_CACHES
+        )
+        if local:
+            raise ImproperlyConfigured(
+                "Cache(s) {} are local to one process; point CACHE_URL at memcached or redis".format(
+                    ", ".join(local)
+                )
+            )
@@ -1,3 +1,15 @@
 from django.contrib import admin
+from .models import Job, SmsMessage
 
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'queue', 'status', 'priority', 'attempts', 'run_at')
+    list_filter = ('status', 'queue')
+
+
+@admin.register(SmsMessage)
+class SmsMessageAdmin(admin.ModelAdmin):
+    list_display = ('phone_number', 'status', 'attempts', 'sent_at', 'provider_id')
+    list_filter = ('status',)
+    search_fields = ('phone_number', 'provider_id')
@@ -0,0 +1,181 @@
+"""
+Token authentication with cached token lookups.
+
+DRF's TokenAuthentication joins Token and User on every request. The
+class here keeps resolved tokens in a bounded, per-process LRU for
+TOKEN_CACHE_TTL seconds and, when TOKEN_SHARED_CACHE names a cache, in
+that cache as well so a fresh worker does not have to warm up from the
+database.
+
+Every token has a generation in TOKEN_REVOCATION_CACHE, which all
+workers share. Deleting a token or saving its user bumps it, and a
+cached entry is only used while the generation it was cached under is
+still current, so a revoked token is refused by every worker at once.
+Generations are random and stored without expiry, so one never comes
+back: a generation the cache evicts is replaced by a new one, which only
+costs the token's entries. Checking the generation costs one cache read
+per request but no query.
+
+QuerySet.update() and bulk deletes send no post_save or post_delete
+signals: code that deactivates users or deletes tokens that way has to
+call invalidate_user or invalidate itself, or the old entries are served
+for up to TOKEN_CACHE_TTL seconds.
+
+Entries are pickled snapshots, so every request gets its own user
+instance and nothing a view caches on it leaks into the next request.
+"""
+import collections
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+from . import instrumentation, metrics
+
+
+hits = metrics.counter("auth_token_cache_hits_total", "Token lookups served from the token cache")
+misses = metrics.counter("auth_token_cache_misses_total", "Token lookups that went to the database")
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded mapping whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_local = LRUCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+
+
+def _shared_cache():
+    if settings.TOKEN_SHARED_CACHE:
+        return caches[settings.TOKEN_SHARED_CACHE]
+    return None
+
+
+def _revocation_cache():
+    return caches[settings.TOKEN_REVOCATION_CACHE]
+
+
+def cache_key(key):
+    """The cache key for a token; raw tokens are never used as cache keys"""
+    return "auth-token:{}".format(hashlib.sha256(key.encode()).hexdigest())
+
+
+def generation_key(name):
+    return "{}:generation".format(name)
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def _generation(name):
+    revocations = _revocation_cache()
+    key = generation_key(name)
+    generation = revocations.get(key)
+    if generation is None:
+        generation = _new_generation()
+        # another worker may have started the token's generation first
+        if not revocations.add(key, generation, None):
+            generation = revocations.get(key)
+    return generation
+
+
+def _bump(cache_keys):
+    _revocation_cache().set_many({generation_key(name): _new_generation() for name in cache_keys}, None)
+
+
+def invalidate(*keys):
+    """Drops the cached lookups of the token ``keys`` in every worker"""
+    cache_keys = [cache_key(key) for key in keys]
+    if not cache_keys:
+        return
+    for key in cache_keys:
+        _local.delete(key)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete_many(cache_keys)
+    _bump(cache_keys)
+    # a lookup that read the old rows before they committed is dropped too
+    transaction.on_commit(lambda: _bump(cache_keys))
+
+
+def invalidate_user(user):
+    """Drops the cached lookups of every token that belongs to ``user``"""
+    from rest_framework.authtoken.models import Token
+
+    invalidate(*Token.objects.filter(user=user).values_list("key", flat=True))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for TokenAuthentication that resolves tokens from
+    the token cache and only queries the database on a miss.
+    """
+
+    def authenticate(self, request):
+        with instrumentation.span("auth"):
+            return super(CachedTokenAuthentication, self).authenticate(request)
+
+    def authenticate_credentials(self, key):
+        name = cache_key(key)
+        shared = _shared_cache()
+        generation = _generation(name)
+        entry = _local.get(name)
+        if (entry is None or entry[0] != generation) and shared is not None:
+            entry = shared.get(name)
+            if entry is not None and entry[0] == generation:
+                _local.set(name, entry)
+        if entry is not None and entry[0] == generation:
+            hits.inc()
+            return pickle.loads(entry[1])
+
+        misses.inc()
+        # the generation was read before the database, so a revocation in
+        # between leaves this entry outdated rather than current
+        user, token = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+        entry = (generation, pickle.dumps((user, token), pickle.HIGHEST_PROTOCOL))
+        _local.set(name, entry)
+        if shared is not None:
+            shared.set(name, entry, settings.TOKEN_CACHE_TTL)
+        return user, token
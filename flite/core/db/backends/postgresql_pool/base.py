@@ -0,0 +1,109 @@
+"""
+PostgreSQL backend that checks connections out of a per-process pool.
+
+Use it as the ENGINE of a database together with CONN_MAX_AGE = 0, so
+each request hands its connection back when Django closes it at the end
+of the request. Pool options go in the database's POOL setting:
+
+    'POOL': {'MIN_SIZE': 2, 'MAX_SIZE': 20, 'TIMEOUT': 5, 'MAX_IDLE': 300, 'PRE_PING': True}
+"""
+import os
+import threading
+
+from django.db.backends.postgresql import base
+
+from flite.core.db.pool import ConnectionPool, PoolTimeout
+from .creation import DatabaseCreation
+
+Database = base.Database
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _ping(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        if not connection.autocommit:
+            connection.rollback()
+    except Database.Error:
+        return False
+    return True
+
+
+def _reset(connection):
+    """Rolls back whatever a returned connection left open; False if it is broken"""
+    if connection.closed:
+        return False
+    try:
+        status = connection.get_transaction_status()
+        if status == Database.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != Database.extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+    except Database.Error:
+        return False
+    return True
+
+
+def get_pool(alias, conn_params, options):
+    """
+    Returns the pool for ``conn_params`` in this process. Pools are keyed
+    by process id so that a forked worker never reuses its parent's
+    sockets.
+    """
+    key = (os.getpid(), tuple(sorted((name, str(value)) for name, value in conn_params.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                lambda: Database.connect(**conn_params),
+                name=alias,
+                min_size=options.get("MIN_SIZE", 0),
+                max_size=options.get("MAX_SIZE", 10),
+                timeout=options.get("TIMEOUT", 5.0),
+                max_idle=options.get("MAX_IDLE", 300.0),
+                ping=_ping if options.get("PRE_PING", True) else None,
+                reset=_reset,
+            )
+    pool.warm()
+    return pool
+
+
+def clear_pools(database):
+    """Closes the idle pooled connections to the database named ``database``"""
+    with _pools_lock:
+        pools = [pool for (pid, params), pool in _pools.items() if ("database", database) in params]
+    for pool in pools:
+        pool.clear()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(self.alias, conn_params, self.settings_dict.get("POOL", {}))
+        try:
+            connection = self.pool.getconn()
+        except PoolTimeout as exc:
+            raise Database.OperationalError(str(exc)) from exc
+
+        # as in the stock backend, but a pooled connection may already
+        # have the isolation level applied
+        options = self.settings_dict["OPTIONS"]
+        try:
+            self.isolation_level = options["isolation_level"]
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            # a connection closed inside an atomic block stays referenced
+            # by this wrapper, so it must not be handed to another thread
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection, discard=self.in_atomic_block)
@@ -0,0 +1,11 @@
+from django.db.backends.postgresql import creation
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # pooled connections would keep the test database in use
+        from .base import clear_pools
+
+        clear_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
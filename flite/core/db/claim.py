@@ -0,0 +1,72 @@
+"""
+Claiming rows of a work queue table.
+
+``claim`` updates a batch of rows and returns them with a single
+``UPDATE ... WHERE pk IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING``,
+so concurrent workers never get the same row and never wait for each
+other. Doing it in one statement also keeps SQLite, which has no SKIP
+LOCKED, from failing to upgrade a read transaction to a write one.
+"""
+from django.db import connection, transaction
+
+
+_CLAIM_SQL = "UPDATE {table} SET {assignments} WHERE {pk} IN ({subquery}) RETURNING {columns}"
+
+
+def claim(queryset, order_by, limit, values, increment=()):
+    """
+    Sets ``values`` on up to ``limit`` rows of ``queryset``, first in
+    ``order_by``, skipping rows other transactions hold locks on
+
+    Args:
+        queryset(QuerySet): The rows that may be claimed
+        order_by(tuple): The order they are claimed in
+        limit(int): The most rows to claim
+        values(dict): Field values to set on the claimed rows
+        increment(tuple): Integer fields to add one to
+
+    Returns:
+        The claimed model instances as they are after the update, in no
+        particular order
+    """
+    model = queryset.model
+    meta = model._meta
+    qn = connection.ops.quote_name
+    fields = meta.concrete_fields
+    assignments, params = [], []
+    for name, value in values.items():
+        field = meta.get_field(name)
+        assignments.append("{} = %s".format(qn(field.column)))
+        params.append(field.get_db_prep_save(value, connection))
+    for name in increment:
+        column = qn(meta.get_field(name).column)
+        assignments.append("{0} = {0} + 1".format(column))
+
+    with transaction.atomic():
+        subquery, subquery_params = (
+            queryset.select_for_update(skip_locked=True).order_by(*order_by).values("pk")[:limit]
+            .query.get_compiler(connection=connection).as_sql()
+        )
+        sql = _CLAIM_SQL.format(
+            table=qn(meta.db_table),
+            assignments=", ".join(assignments),
+            pk=qn(meta.pk.column),
+            subquery=subquery,
+            columns=", ".join(qn(field.column) for field in fields),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + list(subquery_params))
+            rows = cursor.fetchall()
+
+    return [from_row(model, fields, row) for row in rows]
+
+
+def from_row(model, fields, row):
+    """Builds a model instance from raw column values, as a queryset would"""
+    values = []
+    for field, value in zip(fields, row):
+        column = field.get_col(model._meta.db_table)
+        for converter in connection.ops.get_db_converters(column) + field.get_db_converters(connection):
+            value = converter(value, column, connection)
+        values.append(value)
+    return model.from_db(connection.alias, [field.attname for field in fields], values)
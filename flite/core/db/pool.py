@@ -0,0 +1,194 @@
+"""
+A thread-safe pool of DB-API connections.
+
+The pool knows nothing about the database it talks to: it is given
+callables to open, check, reset and close connections, which keeps it
+testable with fake connections.
+"""
+import collections
+import threading
+import time
+
+from flite.core import metrics
+
+
+checkouts_total = metrics.counter("db_pool_checkouts_total", "Connections checked out of a pool")
+checkout_wait_seconds_total = metrics.counter(
+    "db_pool_checkout_wait_seconds_total", "Time spent waiting to check a connection out of a pool"
+)
+checkout_timeouts_total = metrics.counter(
+    "db_pool_checkout_timeouts_total", "Checkouts that gave up because the pool stayed exhausted"
+)
+recycled_total = metrics.counter(
+    "db_pool_recycled_total", "Pooled connections closed for being idle too long or failing a ping"
+)
+connections = metrics.gauge(
+    "db_pool_connections", "Open pooled connections", labelnames=("pool", "state")
+)
+utilization = metrics.gauge(
+    "db_pool_utilization", "Share of the pool's maximum size that is checked out", labelnames=("pool",),
+    multiprocess_mode="liveall",
+)
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the checkout timeout"""
+
+
+class ConnectionPool(object):
+    """
+    Hands out at most ``max_size`` connections. Returned connections are
+    kept for reuse; those idle for more than ``max_idle`` seconds are
+    closed, but never below ``min_size`` open connections.
+
+    Args:
+        connect(callable): Opens a new connection
+        name(str): Identifies the pool in metrics
+        min_size(int): Connections kept open when idle
+        max_size(int): Upper bound on open connections
+        timeout(float): Seconds a checkout waits for a free connection
+        max_idle(float): Seconds an idle connection is kept above min_size
+        ping(callable): Called with an idle connection before it is handed
+            out; a connection it rejects is replaced by a new one
+        reset(callable): Called with a returned connection; a connection
+            it rejects is closed instead of pooled
+        close(callable): Closes a connection
+    """
+
+    def __init__(self, connect, name="default", min_size=0, max_size=10, timeout=5.0, max_idle=300.0,
+                 ping=None, reset=None, close=None):
+        if not 0 <= min_size <= max_size:
+            raise ValueError("min_size must be between 0 and max_size")
+        self.connect = connect
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping = ping
+        self.reset = reset
+        self._close = close or (lambda conn: conn.close())
+        # most recently returned connections last, so reuse favours warm ones
+        self._idle = collections.deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def in_use(self):
+        return self._size - len(self._idle)
+
+    def _report(self):
+        idle = len(self._idle)
+        connections.labels(pool=self.name, state="idle").set(idle)
+        connections.labels(pool=self.name, state="in_use").set(self._size - idle)
+        utilization.labels(pool=self.name).set((self._size - idle) / self.max_size if self.max_size else 0)
+
+    def _expired(self, now):
+        """Takes the connections idle for too long off the pool; returns them for closing"""
+        expired = []
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+            expired.append(self._idle.popleft()[0])
+            self._size -= 1
+        return expired
+
+    def _discard(self, conns):
+        for conn in conns:
+            recycled_total.inc()
+            try:
+                self._close(conn)
+            except Exception:
+                pass
+
+    def _open(self):
+        """Opens a connection for a slot that is already counted in size"""
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._report()
+                self._cond.notify()
+            raise
+
+    def warm(self):
+        """Opens connections until the pool holds min_size of them"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._report()
+                self._cond.notify()
+
+    def getconn(self):
+        """
+        Returns a connection, waiting up to ``timeout`` seconds for one to be
+        returned when all ``max_size`` connections are checked out.
+
+        Raises:
+            PoolTimeout: if no connection became available in time
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        expired = []
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                expired.extend(self._expired(now))
+                if self._idle:
+                    conn = self._idle.pop()[0]
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    checkout_timeouts_total.inc()
+                    self._discard(expired)
+                    raise PoolTimeout(
+                        "No connection available in pool {!r} after {}s".format(self.name, self.timeout)
+                    )
+                self._cond.wait(remaining)
+            self._report()
+        self._discard(expired)
+
+        if conn is not None and self.ping is not None and not self.ping(conn):
+            self._discard([conn])
+            conn = None
+        if conn is None:
+            conn = self._open()
+
+        checkouts_total.inc()
+        checkout_wait_seconds_total.inc(time.monotonic() - started)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Gives a checked out connection back, closing it if ``discard`` is set or it cannot be reset"""
+        if not discard and self.reset is not None:
+            discard = not self.reset(conn)
+        with self._cond:
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._report()
+            self._cond.notify()
+        if discard:
+            self._discard([conn])
+
+    def clear(self):
+        """Closes every idle connection; checked out ones stay open"""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._report()
+        self._discard(idle)
@@ -0,0 +1,103 @@
+"""
+Idempotency-Key support for endpoints that move money.
+
+The first request with a given key runs the view and its successful
+response is kept in the cache for IDEMPOTENCY_KEY_TTL seconds; retries
+with the same key get that response replayed without touching the
+database. A retry that arrives while the first request is still in
+flight waits for it instead of running the view a second time.
+"""
+import functools
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+
+IDEMPOTENCY_HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+POLL_INTERVAL = 0.05
+
+
+def _cache():
+    return caches[settings.IDEMPOTENCY_CACHE]
+
+
+def _cache_key(request, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return "idempotency:{}:{}:{}:{}".format(request.user.pk, request.method, request.path, digest)
+
+
+def _fingerprint(request):
+    """Hash of the request payload, to catch a key reused for another request"""
+    data = request.data
+    if hasattr(data, "lists"):
+        data = dict(data.lists())
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _replay(stored, fingerprint):
+    if stored["fingerprint"] != fingerprint:
+        return Response(
+            {"detail": "Idempotency-Key has already been used for a different request"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    return Response(stored["data"], status=stored["status"], headers={REPLAYED_HEADER: "true"})
+
+
+def idempotent(view_method):
+    """
+    Makes a viewset action honour the ``Idempotency-Key`` request header.
+
+    Only 2xx responses are stored. Failed requests roll back their
+    writes, so a retry after a failure runs the view again.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {"detail": "Idempotency-Key must be at most {} characters".format(MAX_KEY_LENGTH)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        cache = _cache()
+        cache_key = _cache_key(request, key)
+        lock_key = cache_key + ":lock"
+        fingerprint = _fingerprint(request)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+
+        while True:
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            if cache.add(lock_key, True, settings.IDEMPOTENCY_LOCK_TIMEOUT):
+                break
+            if time.monotonic() >= deadline:
+                return Response(
+                    {"detail": "A request with this Idempotency-Key is still being processed"},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+            if status.is_success(response.status_code):
+                cache.set(
+                    cache_key,
+                    {"fingerprint": fingerprint, "status": response.status_code, "data": response.data},
+                    settings.IDEMPOTENCY_KEY_TTL,
+                )
+            return response
+        finally:
+            cache.delete(lock_key)
+    return wrapper
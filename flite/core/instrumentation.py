@@ -0,0 +1,90 @@
+"""
+Per-request timings.
+
+RequestTimingMiddleware starts a Timings for a sampled request and the
+code it runs adds to it: every SQL query through a database execute
+wrapper, and row lock waits, token lookups and serializer work through
+``span()`` and ``record()``. Outside a sampled request there is no
+Timings and both are close to free.
+"""
+import contextlib
+import threading
+import time
+
+
+_state = threading.local()
+
+
+class Timings(object):
+    """Seconds spent per activity, plus the number of SQL queries run"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.seconds = {}
+        self.sql_count = 0
+        self._open = set()
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Database execute wrapper counting and timing every query"""
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_count += 1
+            self.add("db", time.monotonic() - started)
+
+
+def current():
+    """Returns the Timings of the request being handled, None if it is not sampled"""
+    return getattr(_state, "timings", None)
+
+
+def start():
+    _state.timings = Timings()
+    return _state.timings
+
+
+def stop():
+    _state.timings = None
+
+
+def record(name, seconds):
+    """Adds ``seconds`` to the ``name`` timing of the current request"""
+    timings = current()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Times the block as ``name``. Nested spans of the same name count
+    once, so recursive work such as nested serializers is not counted
+    twice.
+    """
+    timings = current()
+    if timings is None or name in timings._open:
+        yield
+        return
+    timings._open.add(name)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timings._open.discard(name)
+        timings.add(name, time.monotonic() - started)
+
+
+class TimedSerializerMixin(object):
+    """Times validation and representation of a DRF serializer as ``serializer``"""
+
+    def run_validation(self, *args, **kwargs):
+        with span("serializer"):
+            return super(TimedSerializerMixin, self).run_validation(*args, **kwargs)
+
+    def to_representation(self, *args, **kwargs):
+        with span("serializer"):
+            return super(TimedSerializerMixin, self).to_representation(*args, **kwargs)
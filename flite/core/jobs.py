@@ -0,0 +1,175 @@
+"""
+Background jobs.
+
+Functions decorated with ``@job`` are run by the ``run_jobs`` command
+instead of in the request: ``send_sms_verification_code.delay(...)``
+only inserts a Job row. Inside a transaction the row commits (or rolls back) with
+the rest of the request's writes, so a job never sees data that was not
+committed.
+
+Workers claim batches of due jobs, highest priority first, with
+``SELECT ... FOR UPDATE SKIP LOCKED``, so any number of them can share
+the table without handing a job out twice. A job that raises is retried
+with exponential backoff until it has run ``max_attempts`` times, then
+it is marked failed and kept for inspection. Jobs of a worker that died
+are queued again after JOB_LOCK_TIMEOUT seconds.
+"""
+import functools
+import json
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from . import metrics
+from .db.claim import claim as claim_rows
+
+
+logger = logging.getLogger(__name__)
+
+enqueued_total = metrics.counter("jobs_enqueued_total", "Jobs enqueued, by queue", labelnames=("queue",))
+jobs_total = metrics.counter(
+    "jobs_total", "Jobs run, by queue and outcome (done, retried or failed)",
+    labelnames=("queue", "name", "outcome"),
+)
+latency_seconds = metrics.histogram(
+    "job_latency_seconds", "Time from when a job was due to when a worker started it",
+    labelnames=("queue",),
+)
+duration_seconds = metrics.histogram(
+    "job_duration_seconds", "Time to run a job", labelnames=("queue", "name")
+)
+queued_jobs = metrics.gauge(
+    "jobs_queued", "Jobs waiting to run, by queue", labelnames=("queue",), multiprocess_mode="max"
+)
+
+_registry = {}
+_queues_seen = set()
+
+
+def job(queue="default", priority=0, max_attempts=5):
+    """
+    Registers the decorated function as a job. Calling it still runs it
+    right away; ``.delay(*args, **kwargs)`` queues it instead. Arguments
+    must be JSON serializable.
+
+    Args:
+        queue(str): The queue workers take it from
+        priority(int): Jobs with a higher priority run first
+        max_attempts(int): Runs before the job is marked failed
+    """
+    def decorator(func):
+        name = "{}.{}".format(func.__module__, func.__qualname__)
+        _registry[name] = func
+
+        @functools.wraps(func)
+        def delay(*args, **kwargs):
+            return enqueue(name, args, kwargs, queue=queue, priority=priority, max_attempts=max_attempts)
+
+        func.delay = delay
+        func.job_name = name
+        return func
+    return decorator
+
+
+def enqueue(name, args=(), kwargs=None, queue="default", priority=0, max_attempts=5, run_at=None):
+    """Inserts a Job that runs the registered function ``name`` with the given arguments"""
+    from .models import Job
+
+    created = Job.objects.create(
+        name=name,
+        arguments=json.dumps({"args": list(args), "kwargs": kwargs or {}}),
+        queue=queue,
+        priority=priority,
+        max_attempts=max_attempts,
+        run_at=run_at or timezone.now(),
+    )
+    enqueued_total.labels(queue=queue).inc()
+    return created
+
+
+def claim(queues=None, limit=10):
+    """
+    Marks up to ``limit`` due jobs as running and returns them. Jobs
+    other workers are claiming at the same time are skipped, not waited
+    for.
+
+    Args:
+        queues(list): Names of the queues to take jobs from, all when None
+        limit(int): The most jobs to claim
+    """
+    from .models import Job
+
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=now)
+    if queues:
+        due = due.filter(queue__in=queues)
+    claimed = claim_rows(
+        due, ("-priority", "run_at"), limit,
+        {"status": Job.RUNNING, "locked_at": now, "modified": now}, increment=("attempts",),
+    )
+    return sorted(claimed, key=lambda job: (-job.priority, job.run_at))
+
+
+def backoff(attempts):
+    """Seconds to wait before running a job again after its ``attempts``-th failure"""
+    delay = min(settings.JOB_RETRY_BACKOFF * 2 ** (attempts - 1), settings.JOB_MAX_BACKOFF)
+    # jitter keeps jobs that failed together from being retried together
+    return delay * random.uniform(0.5, 1)
+
+
+def run(claimed):
+    """Runs a claimed job, then deletes it, schedules a retry or marks it failed"""
+    from .models import Job
+
+    started = timezone.now()
+    latency_seconds.labels(queue=claimed.queue).observe(max((started - claimed.run_at).total_seconds(), 0))
+    try:
+        func = _registry[claimed.name]
+        arguments = json.loads(claimed.arguments)
+        with duration_seconds.labels(queue=claimed.queue, name=claimed.name).time():
+            func(*arguments["args"], **arguments["kwargs"])
+    except Exception:
+        logger.exception("Job %s (%s) failed", claimed.pk, claimed.name)
+        error = traceback.format_exc()
+        now = timezone.now()
+        if claimed.attempts < claimed.max_attempts:
+            outcome = "retried"
+            changes = {"status": Job.QUEUED, "run_at": now + timedelta(seconds=backoff(claimed.attempts))}
+        else:
+            outcome = "failed"
+            changes = {"status": Job.FAILED}
+        Job.objects.filter(pk=claimed.pk).update(locked_at=None, last_error=error, modified=now, **changes)
+    else:
+        outcome = "done"
+        Job.objects.filter(pk=claimed.pk).delete()
+    jobs_total.labels(queue=claimed.queue, name=claimed.name, outcome=outcome).inc()
+    return outcome
+
+
+def requeue_stale():
+    """Queues the jobs of workers that stopped without finishing them again"""
+    from .models import Job
+
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+    return Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(
+        status=Job.QUEUED, locked_at=None, modified=timezone.now()
+    )
+
+
+def record_depth():
+    """Sets the ``jobs_queued`` gauge of every queue"""
+    from .models import Job
+
+    depths = dict(
+        Job.objects.filter(status=Job.QUEUED).values_list("queue").annotate(count=Count("pk")).order_by()
+    )
+    # queues that were seen before and are empty now go back to 0
+    _queues_seen.update(depths)
+    for queue in _queues_seen:
+        queued_jobs.labels(queue=queue).set(depths.get(queue, 0))
+    return depths
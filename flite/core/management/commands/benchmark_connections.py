@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connection
+
+from flite.core.utils import latency_summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays the connection handling of many concurrent requests: each "
+        "simulated request connects, runs --query and is closed the way "
+        "Django closes connections at the end of a request. Prints latency "
+        "percentiles as JSON; run it with and without DATABASE_POOL to "
+        "compare the pooled backend with CONN_MAX_AGE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=64, help="Concurrent simulated workers")
+        parser.add_argument("--requests", type=int, default=50, help="Requests per worker")
+        parser.add_argument("--query", default="SELECT 1", help="SQL each request runs")
+        parser.add_argument("--output", help="File to write the results to. Defaults to stdout")
+
+    def handle(self, *args, **options):
+        latencies, errors = [], []
+        lock = threading.Lock()
+        start = threading.Barrier(options["threads"])
+
+        def worker():
+            start.wait()
+            for _ in range(options["requests"]):
+                began = time.monotonic()
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(options["query"])
+                        cursor.fetchall()
+                except DatabaseError as exc:
+                    with lock:
+                        errors.append(str(exc))
+                finally:
+                    close_old_connections()
+                with lock:
+                    latencies.append(time.monotonic() - began)
+            connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options["threads"])]
+        began = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - began
+
+        database = connection.settings_dict
+        results = {
+            "engine": database["ENGINE"],
+            "conn_max_age": database["CONN_MAX_AGE"],
+            "pool": database.get("POOL"),
+            "threads": options["threads"],
+            "requests": len(latencies),
+            "errors": len(errors),
+            "throughput_per_second": round(len(latencies) / elapsed, 1),
+            "latency_ms": latency_summary(latencies),
+        }
+        report = json.dumps(results, indent=2) + "\n"
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(report)
+        else:
+            self.stdout.write(report, ending="")
@@ -0,0 +1,70 @@
+import collections
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from flite.core.sms import get_backend
+from flite.core.sms.dispatch import Dispatcher, requeue_stale
+
+# seconds between requeues of messages left behind by a dead dispatcher
+MAINTENANCE_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Delivers queued SMS in batches through SMS_BACKEND until stopped "
+        "with SIGINT or SIGTERM. Several can run side by side; messages are "
+        "claimed with SKIP LOCKED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int,
+                            help="Batches sent at once. Defaults to SMS_CONCURRENCY")
+        parser.add_argument("--rate", type=float,
+                            help="Most messages sent a second, 0 for no limit. Defaults to SMS_RATE_LIMIT")
+        parser.add_argument("--backend", help="Dotted path of the backend to use instead of SMS_BACKEND")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to wait before looking again when no message is due")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once no message is due instead of waiting")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] is not None and options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        dispatcher = Dispatcher(
+            backend=get_backend(options["backend"]), concurrency=options["concurrency"], rate=options["rate"]
+        )
+        self.stopping = False
+        if not options["once"]:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        counts = collections.Counter()
+        began = time.monotonic()
+        last_maintenance = None
+        try:
+            while not self.stopping:
+                if last_maintenance is None or time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                    requeue_stale()
+                    last_maintenance = time.monotonic()
+                round_counts = dispatcher.dispatch()
+                counts.update(round_counts)
+                if not round_counts:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+        finally:
+            dispatcher.close()
+        elapsed = time.monotonic() - began
+
+        total = sum(counts.values())
+        self.stdout.write(self.style.SUCCESS(
+            "{} message(s) in {:.1f}s ({} msg/s): {} sent, {} to be retried, {} failed".format(
+                total, elapsed, round(total / elapsed, 1) if elapsed else total,
+                counts["sent"], counts["retried"], counts["failed"],
+            )
+        ))
+
+    def stop(self, signum, frame):
+        self.stopping = True
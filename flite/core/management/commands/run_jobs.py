@@ -0,0 +1,120 @@
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils.module_loading import autodiscover_modules
+from prometheus_client import start_http_server
+
+from flite.core import jobs
+
+# seconds between refreshes of the queue depth gauge and requeues of stale jobs
+MAINTENANCE_INTERVAL = 15
+
+
+def run_job(claimed):
+    # each job gets a usable connection, like each request does
+    close_old_connections()
+    try:
+        return jobs.run(claimed)
+    finally:
+        close_old_connections()
+
+
+class InlineExecutor(object):
+    """Runs submitted calls right away in the calling thread"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs queued background jobs (see flite.core.jobs) on a pool of "
+        "threads until stopped with SIGINT or SIGTERM, after which the jobs "
+        "already claimed are finished. Start several to use more processes "
+        "or machines: jobs are claimed with SKIP LOCKED, so no job runs twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queues",
+                            help="Comma separated queues to take jobs from. Defaults to all of them")
+        parser.add_argument("--concurrency", type=int, default=4,
+                            help="Jobs run at the same time. With 1 they run in the command's own thread")
+        parser.add_argument("--batch-size", type=int, default=10, help="The most jobs claimed per query")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to wait before looking again when no job is due")
+        parser.add_argument("--once", action="store_true", help="Exit once no job is due instead of waiting")
+        parser.add_argument("--metrics-port", type=int,
+                            help="Serve this worker's metrics in the Prometheus format on this port")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        # registers the jobs of every app
+        autodiscover_modules("tasks")
+        if options["metrics_port"]:
+            start_http_server(options["metrics_port"])
+
+        queues = options["queues"].split(",") if options["queues"] else None
+        self.stopping = False
+        if not options["once"]:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        counts = {"done": 0, "retried": 0, "failed": 0}
+        in_flight = set()
+        last_maintenance = None
+        if options["concurrency"] > 1:
+            executor = ThreadPoolExecutor(options["concurrency"])
+        else:
+            executor = InlineExecutor()
+        with executor:
+            while not self.stopping:
+                if last_maintenance is None or time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                    jobs.requeue_stale()
+                    jobs.record_depth()
+                    last_maintenance = time.monotonic()
+
+                free = options["concurrency"] - len(in_flight)
+                claimed = jobs.claim(queues, min(free, options["batch_size"])) if free else []
+                in_flight.update(executor.submit(run_job, job) for job in claimed)
+                if options["once"] and not claimed and not in_flight:
+                    break
+
+                # wait for a free thread, or for jobs to come due
+                busy = len(in_flight) >= options["concurrency"]
+                if in_flight and (busy or not claimed):
+                    finished, in_flight = wait(
+                        in_flight,
+                        timeout=None if busy else options["poll_interval"],
+                        return_when=FIRST_COMPLETED,
+                    )
+                    for future in finished:
+                        counts[future.result()] += 1
+                elif not claimed:
+                    time.sleep(options["poll_interval"])
+
+            for future in wait(in_flight).done:
+                counts[future.result()] += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            "Ran {} job(s): {done} done, {retried} to be retried, {failed} failed".format(
+                sum(counts.values()), **counts
+            )
+        ))
+
+    def stop(self, signum, frame):
+        self.stopping = True
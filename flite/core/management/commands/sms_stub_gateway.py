@@ -0,0 +1,83 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from django.core.management.base import BaseCommand
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the SMS gateway protocol of flite.core.sms.backends.http "
+        "locally, so SMS delivery can be tried and benchmarked offline. "
+        "Point SMS_GATEWAY_URL at http://localhost:<port>/messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8025)
+        parser.add_argument("--latency", type=float, default=50, help="Milliseconds taken per batch")
+        parser.add_argument("--max-batch-size", type=int, default=1000,
+                            help="Batches with more messages are refused with 413")
+        parser.add_argument("--reject-rate", type=float, default=0, help="Share of messages rejected")
+        parser.add_argument("--error-rate", type=float, default=0,
+                            help="Share of batches answered with 503, as an overloaded gateway would")
+
+    def handle(self, *args, **options):
+        stats = {"batches": 0, "messages": 0}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections open, as a real gateway would
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                messages = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["messages"]
+                time.sleep(options["latency"] / 1000)
+                if len(messages) > options["max_batch_size"]:
+                    return self.respond(413, {"error": "too many messages"})
+                if random.random() < options["error_rate"]:
+                    return self.respond(503, {"error": "overloaded"})
+                results = []
+                for message in messages:
+                    if random.random() < options["reject_rate"]:
+                        results.append({"id": message["id"], "status": "rejected", "error": "invalid number"})
+                    else:
+                        results.append(
+                            {"id": message["id"], "status": "accepted", "provider_id": uuid.uuid4().hex}
+                        )
+                with lock:
+                    stats["batches"] += 1
+                    stats["messages"] += len(messages)
+                self.respond(200, {"results": results})
+
+            def respond(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", options["port"]), Handler)
+        self.stdout.write("SMS stub gateway listening on port {}".format(options["port"]))
+        began = time.monotonic()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        elapsed = time.monotonic() - began
+        self.stdout.write("Took {messages} message(s) in {batches} batch(es), {rate} msg/s".format(
+            rate=round(stats["messages"] / elapsed, 1) if elapsed else 0, **stats
+        ))
@@ -0,0 +1,80 @@
+"""
+Operational metrics, exported in the Prometheus text format at /metrics.
+
+Metrics are prometheus_client counters, gauges and histograms. When the
+``prometheus_multiproc_dir`` environment variable names a directory
+(the gunicorn config sets it), every worker process writes its values to
+memory-mapped files there and /metrics adds them up across workers.
+"""
+import os
+import threading
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess,
+)
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(klass, name, documentation, labelnames=(), **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = klass(name, documentation, labelnames=labelnames, **kwargs)
+        return _registry[name]
+
+
+def counter(name, documentation, labelnames=()):
+    """
+    Returns the counter registered under ``name``, creating it if needed
+
+    Args:
+        name(str): The metric name, ending in _total
+        documentation(str): A one line description of the metric
+        labelnames(tuple): Names of the labels that tell its children apart
+    """
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=(), multiprocess_mode="livesum"):
+    """
+    Returns the gauge registered under ``name``, creating it if needed
+
+    Args:
+        name(str): The metric name
+        documentation(str): A one line description of the metric
+        labelnames(tuple): Names of the labels that tell its children apart
+        multiprocess_mode(str): How the values of the worker processes are
+            combined, see prometheus_client.Gauge
+    """
+    return _register(Gauge, name, documentation, labelnames, multiprocess_mode=multiprocess_mode)
+
+
+def histogram(name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+    """
+    Returns the histogram registered under ``name``, creating it if needed
+
+    Args:
+        name(str): The metric name
+        documentation(str): A one line description of the metric
+        labelnames(tuple): Names of the labels that tell its children apart
+        buckets(tuple): Upper bounds of the buckets
+    """
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def sample(name, **labels):
+    """Returns the current value of the sample ``name`` in this process"""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def exposition():
+    """Returns the content type and body of the /metrics response"""
+    if os.environ.get("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return CONTENT_TYPE_LATEST, generate_latest(registry)
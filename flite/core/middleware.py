@@ -0,0 +1,127 @@
+import contextlib
+import hashlib
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from . import instrumentation, metrics, routers
+
+
+logger = logging.getLogger("flite.requests")
+
+request_duration_seconds = metrics.histogram(
+    "http_request_duration_seconds", "Time to handle a request, by route", labelnames=("method", "route")
+)
+requests_total = metrics.counter(
+    "http_requests_total", "Requests handled, by route and status", labelnames=("method", "route", "status")
+)
+
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+# anything else is labelled "other", so clients cannot add label values
+METRIC_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "POST", "PUT", "PATCH", "DELETE", "CONNECT", "TRACE"))
+
+
+def _cache():
+    return caches[settings.REPLICA_PIN_CACHE]
+
+
+def _client_key(request):
+    """Identifies the client by its credentials, None for anonymous clients"""
+    credentials = request.META.get("HTTP_AUTHORIZATION")
+    if not credentials and hasattr(request, "session"):
+        credentials = request.session.session_key
+    if not credentials:
+        return None
+    return "db-pin:{}".format(hashlib.sha256(credentials.encode()).hexdigest())
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Keeps a client's reads on the primary while it writes and for
+    REPLICA_PIN_SECONDS afterwards, so it reads its own writes even when
+    the replicas lag behind.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        key = _client_key(request)
+        writing = request.method not in SAFE_METHODS
+        routers.pin(writing or (key is not None and _cache().get(key) is not None))
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.pin(False)
+        if writing and key is not None:
+            _cache().set(key, True, settings.REPLICA_PIN_SECONDS)
+        return response
+
+
+class RequestTimingMiddleware(object):
+    """
+    Instruments a REQUEST_TIMING_SAMPLE_RATE share of requests: their SQL
+    query count and time, row lock waits, token lookup, serializer and
+    view time are sent back in a Server-Timing header and logged as one
+    JSON line on the ``flite.requests`` logger. Requests that are not
+    sampled are not instrumented at all.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.REQUEST_TIMING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        timings = instrumentation.start()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.execute_wrapper))
+                response = self.get_response(request)
+            finished = time.monotonic()
+            if hasattr(request, "_view_started"):
+                timings.add("view", finished - request._view_started)
+            timings.add("total", finished - timings.started)
+        finally:
+            instrumentation.stop()
+
+        response["Server-Timing"] = ", ".join(
+            '{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in sorted(timings.seconds.items())
+        ) + ', sql;desc="{} queries"'.format(timings.sql_count)
+        logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "sql_count": timings.sql_count,
+            **{name + "_ms": round(seconds * 1000, 2) for name, seconds in timings.seconds.items()},
+        }, sort_keys=True))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if instrumentation.current() is not None:
+            request._view_started = time.monotonic()
+
+
+class RequestMetricsMiddleware(object):
+    """Records the latency and status of every request by route"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.monotonic()
+        response = self.get_response(request)
+        match = getattr(request, "resolver_match", None)
+        route = match.view_name if match is not None else "unmatched"
+        method = request.method if request.method in METRIC_METHODS else "other"
+        request_duration_seconds.labels(method=method, route=route).observe(time.monotonic() - started)
+        requests_total.labels(method=method, route=route, status=response.status_code).inc()
+        return response
@@ -10,3 +10,71 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+class Job(BaseModel):
+    """A call of a ``jobs.job`` function waiting to run, see jobs"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (FAILED, "Failed"),
+    )
+
+    queue = models.CharField(max_length=50, default="default")
+    name = models.CharField(max_length=200)
+    # JSON encoded positional and keyword arguments
+    arguments = models.TextField(default="{}")
+    # higher runs first
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # the claim query: queued jobs of some queues, by priority and age
+            models.Index(fields=["status", "queue", "-priority", "run_at"], name="core_job_claim_idx"),
+        ]
+
+    def __str__(self):
+        return "{} ({})".format(self.name, self.status)
+
+
+class SmsMessage(BaseModel):
+    """An outgoing SMS, see sms"""
+    QUEUED = "queued"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    )
+
+    phone_number = models.CharField(max_length=32)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # the gateway's id for the message once it accepted it
+    provider_id = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "SMS message"
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="core_sms_claim_idx"),
+        ]
+
+    def __str__(self):
+        return "{} ({})".format(self.phone_number, self.status)
@@ -0,0 +1,103 @@
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Newest-first pagination on (created, id).
+
+    Each page starts where the previous one ended with a row comparison
+    that an (owner, created, id) index can seek to directly, so a page costs
+    the same at any depth. Unlike PageNumberPagination there is no
+    COUNT(*) unless the client asks for it with ``?count=true``.
+    """
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    count_query_param = "count"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ("1", "true"):
+            self.count = queryset.count()
+
+        queryset = queryset.order_by("-created", "-pk")
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = self.filter_after(queryset, *position)
+
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def filter_after(self, queryset, created, pk):
+        """Restricts ``queryset`` to the rows that sort after (created, pk)"""
+        opts = queryset.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        created_field = opts.get_field("created")
+        try:
+            pk = opts.pk.to_python(pk)
+        except ValidationError:
+            raise NotFound(self.invalid_cursor_message)
+        # the row comparison alone does not let Postgres skip partitions,
+        # the redundant bound on created does
+        where = "{table}.{created} <= %s AND ({table}.{created}, {table}.{pk}) < (%s, %s)".format(
+            table=table, created=qn(created_field.column), pk=qn(opts.pk.column)
+        )
+        created = created_field.get_db_prep_value(created, connection)
+        params = [created, created, opts.pk.get_db_prep_value(pk, connection)]
+        return queryset.extra(where=[where], params=params)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            created, pk = base64.urlsafe_b64decode(encoded.encode()).decode().split("|")
+        except (TypeError, ValueError, binascii.Error, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        created = parse_datetime(created)
+        if created is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created, pk
+
+    def encode_cursor(self, row):
+        position = "{}|{}".format(row.created.isoformat(), row.pk)
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if self.count is not None:
+            response["count"] = self.count
+        response["next"] = self.get_next_link()
+        response["results"] = data
+        return Response(response)
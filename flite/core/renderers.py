@@ -0,0 +1,20 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets views that stream server-sent events accept ``text/event-stream``
+    clients. The events themselves bypass it in a StreamingHttpResponse;
+    what it renders is an error, as one ``error`` event.
+    """
+    media_type = "text/event-stream"
+    format = "event-stream"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return "event: error\ndata: {}\n\n".format(json.dumps(data, cls=JSONEncoder)).encode()
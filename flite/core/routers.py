@@ -0,0 +1,120 @@
+"""
+Read-replica routing.
+
+Reads go to one of the DATABASE_REPLICAS and writes to the primary.
+Reads stay on the primary when:
+
+* the thread is pinned to it, which ReplicaPinningMiddleware does for
+  unsafe requests and for clients that wrote in the last
+  REPLICA_PIN_SECONDS, so users always see their own writes
+* a transaction is open on the primary, so reads inside it see its
+  writes and take part in its locks
+* no replica is within REPLICA_MAX_LAG seconds of the primary
+
+Each replica's lag is measured at most every REPLICA_LAG_CHECK_INTERVAL
+seconds per process and kept in the ``db_replica_lag_seconds`` gauge.
+"""
+import contextlib
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from . import metrics
+
+
+replica_lag_seconds = metrics.gauge(
+    "db_replica_lag_seconds", "Seconds the replica is behind the primary", labelnames=("alias",),
+    multiprocess_mode="liveall",
+)
+
+_state = threading.local()
+
+
+def is_pinned():
+    return getattr(_state, "pinned", False)
+
+
+def pin(pinned=True):
+    """Sends (or stops sending) this thread's reads to the primary"""
+    _state.pinned = pinned
+
+
+@contextlib.contextmanager
+def use_primary():
+    """Sends the reads made inside the block to the primary"""
+    previous = is_pinned()
+    pin()
+    try:
+        yield
+    finally:
+        pin(previous)
+
+
+def replica_lag(alias):
+    """
+    Returns how many seconds the database ``alias`` is behind its primary,
+    0 for a database that is not a streaming replica.
+    """
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() "
+            "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaRouter(object):
+
+    def __init__(self):
+        self._lag = {}
+        self._lock = threading.Lock()
+
+    def _lag_of(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            lag, checked = self._lag.get(alias, (None, None))
+            if checked is not None and now - checked < settings.REPLICA_LAG_CHECK_INTERVAL:
+                return lag
+            # other threads keep the old value while this one measures
+            self._lag[alias] = (lag, now)
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError:
+            lag = float("inf")
+        else:
+            replica_lag_seconds.labels(alias=alias).set(lag)
+        with self._lock:
+            self._lag[alias] = (lag, now)
+        return lag
+
+    def replicas(self):
+        """Returns the replicas that are close enough to the primary to read from"""
+        return [
+            alias for alias in settings.DATABASE_REPLICAS
+            if (self._lag_of(alias) or 0) <= settings.REPLICA_MAX_LAG
+        ]
+
+    def db_for_read(self, model, **hints):
+        if is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = self.replicas()
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # every alias holds the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
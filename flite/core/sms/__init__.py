@@ -0,0 +1,39 @@
+"""
+Outgoing SMS.
+
+``send_sms`` and ``send_many`` only queue SmsMessage rows. The
+``dispatch_sms`` command delivers them in batches through SMS_BACKEND,
+which picks the gateway the way EMAIL_BACKEND picks how mail is sent:
+
+* ``flite.core.sms.backends.http.SmsBackend`` posts batches to the
+  gateway at SMS_GATEWAY_URL
+* ``flite.core.sms.backends.console.SmsBackend`` prints messages
+* ``flite.core.sms.backends.locmem.SmsBackend`` keeps them in
+  ``flite.core.sms.outbox``, for tests
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# messages "sent" by the locmem backend
+outbox = []
+
+
+def get_backend(backend=None, **kwargs):
+    """Returns an instance of the SMS backend ``backend``, SMS_BACKEND by default"""
+    return import_string(backend or settings.SMS_BACKEND)(**kwargs)
+
+
+def send_sms(phone_number, body):
+    """Queues an SMS and returns its SmsMessage"""
+    from flite.core.models import SmsMessage
+
+    return SmsMessage.objects.create(phone_number=str(phone_number), body=body)
+
+
+def send_many(messages):
+    """Queues an SMS for every (phone number, body) pair with one INSERT"""
+    from flite.core.models import SmsMessage
+
+    return SmsMessage.objects.bulk_create(
+        [SmsMessage(phone_number=str(phone_number), body=body) for phone_number, body in messages]
+    )
@@ -0,0 +1,31 @@
+class SmsError(Exception):
+    """The gateway refused a message; sending it again will not help"""
+
+
+class TransientSmsError(SmsError):
+    """A message could not be sent now but may be later"""
+
+
+class BaseSmsBackend(object):
+    """
+    Base class for SMS backends. Subclasses implement send_messages and
+    may set max_batch_size to the most messages their gateway takes in
+    one call.
+    """
+    max_batch_size = 100
+
+    def send_messages(self, messages):
+        """
+        Sends a batch of SmsMessages
+
+        Returns:
+            A dict with, for each message id, the gateway's id for the
+            message or the SmsError it was refused with
+
+        Raises:
+            SmsError: when the whole batch failed
+        """
+        raise NotImplementedError("subclasses of BaseSmsBackend must override send_messages()")
+
+    def close(self):
+        pass
@@ -0,0 +1,19 @@
+import sys
+import threading
+
+from .base import BaseSmsBackend
+
+
+class SmsBackend(BaseSmsBackend):
+    """Writes messages to a stream, standard output by default"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def send_messages(self, messages):
+        with self._lock:
+            for message in messages:
+                self.stream.write("SMS to {}: {}\n".format(message.phone_number, message.body))
+            self.stream.flush()
+        return {message.pk: "console-{}".format(message.pk) for message in messages}
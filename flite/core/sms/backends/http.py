@@ -0,0 +1,85 @@
+import json
+import logging
+
+import urllib3
+from django.conf import settings
+
+from .base import BaseSmsBackend, SmsError, TransientSmsError
+
+
+logger = logging.getLogger(__name__)
+
+
+class SmsBackend(BaseSmsBackend):
+    """
+    Posts batches of messages as JSON to the gateway at SMS_GATEWAY_URL,
+    over a pool of kept-alive connections:
+
+        {"messages": [{"id": ..., "to": ..., "body": ...}, ...]}
+
+    and expects a result per message back:
+
+        {"results": [{"id": ..., "status": "accepted", "provider_id": ...},
+                     {"id": ..., "status": "rejected", "error": ...}, ...]}
+
+    Connection errors, 429 and 5xx responses fail the batch with a
+    TransientSmsError so it is retried; other error responses fail it
+    for good. Once the gateway answers 2xx it has taken the batch, so a
+    message without a readable result is logged and counted as sent
+    rather than retried and sent twice. ``sms_stub_gateway`` serves this
+    protocol locally.
+    """
+
+    def __init__(self, url=None, token=None, timeout=None, max_batch_size=None, pool_size=None):
+        self.url = url or settings.SMS_GATEWAY_URL
+        self.token = token or settings.SMS_GATEWAY_TOKEN
+        self.max_batch_size = max_batch_size or settings.SMS_GATEWAY_BATCH_SIZE
+        # one connection per concurrent batch; block instead of opening more
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size or settings.SMS_CONCURRENCY,
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(total=timeout or settings.SMS_GATEWAY_TIMEOUT),
+        )
+
+    def send_messages(self, messages):
+        body = json.dumps({
+            "messages": [
+                {"id": str(message.pk), "to": message.phone_number, "body": message.body}
+                for message in messages
+            ],
+        })
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = "Bearer {}".format(self.token)
+        try:
+            response = self.http.request("POST", self.url, body=body, headers=headers)
+        except urllib3.exceptions.HTTPError as exc:
+            raise TransientSmsError("Gateway unreachable: {}".format(exc))
+        if response.status == 429 or response.status >= 500:
+            raise TransientSmsError("Gateway responded {}".format(response.status))
+        if response.status >= 400:
+            raise SmsError("Gateway responded {}: {}".format(response.status, response.data[:200]))
+
+        try:
+            results = {str(result["id"]): result for result in json.loads(response.data.decode())["results"]}
+        except (ValueError, KeyError, TypeError) as exc:
+            logger.warning(
+                "Unreadable gateway response to an accepted batch: %s: %r", exc, response.data[:200]
+            )
+            results = {}
+        outcomes = {}
+        for message in messages:
+            result = results.get(str(message.pk))
+            if result is None:
+                if results:
+                    logger.warning("Message %s is missing from an accepted batch's results", message.pk)
+                outcomes[message.pk] = ""
+            elif result.get("status") == "accepted":
+                outcomes[message.pk] = result.get("provider_id") or ""
+            else:
+                outcomes[message.pk] = SmsError(result.get("error") or "Rejected")
+        return outcomes
+
+    def close(self):
+        self.http.clear()
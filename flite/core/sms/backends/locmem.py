@@ -0,0 +1,10 @@
+from flite.core import sms
+from .base import BaseSmsBackend
+
+
+class SmsBackend(BaseSmsBackend):
+    """Appends messages to ``flite.core.sms.outbox``"""
+
+    def send_messages(self, messages):
+        sms.outbox.extend(messages)
+        return {message.pk: "locmem-{}".format(message.pk) for message in messages}
@@ -0,0 +1,173 @@
+"""
+Batched SMS delivery.
+
+A Dispatcher claims due queued messages with SKIP LOCKED, splits them
+into batches of the backend's ``max_batch_size`` and sends up to
+SMS_CONCURRENCY batches at once on a thread pool, no faster than
+SMS_RATE_LIMIT messages a second. Outcomes are written back with one
+UPDATE per outcome: sent messages get their gateway id, refused ones
+are marked failed and the ones that hit a transient error are retried
+with the job backoff until SMS_MAX_ATTEMPTS.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Case, CharField, DateTimeField, TextField, Value, When
+from django.utils import timezone
+
+from flite.core import jobs, metrics
+from flite.core.db.claim import claim
+from . import get_backend
+from .backends.base import SmsError, TransientSmsError
+
+
+messages_total = metrics.counter(
+    "sms_messages_total", "SMS delivery attempts by outcome (sent, retried or failed)",
+    labelnames=("outcome",),
+)
+batch_seconds = metrics.histogram("sms_batch_seconds", "Time for the gateway to take a batch")
+
+
+class RateLimiter(object):
+    """A token bucket shared by the threads of a dispatcher"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count):
+        """Waits until ``count`` messages may be sent"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # a batch bigger than a second's worth still goes, after a wait
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - count
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def batches(messages, size):
+    for start in range(0, len(messages), size):
+        yield messages[start:start + size]
+
+
+def _each(values, output_field):
+    """A CASE expression giving each message its own value"""
+    return Case(
+        *[When(pk=pk, then=Value(value, output_field=output_field)) for pk, value in values.items()],
+        output_field=output_field,
+    )
+
+
+class Dispatcher(object):
+
+    def __init__(self, backend=None, concurrency=None, rate=None):
+        self.backend = backend or get_backend()
+        self.concurrency = concurrency or settings.SMS_CONCURRENCY
+        self.limiter = RateLimiter(settings.SMS_RATE_LIMIT if rate is None else rate)
+        self.executor = ThreadPoolExecutor(self.concurrency) if self.concurrency > 1 else None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.backend.close()
+
+    def claim(self):
+        """Marks the messages of one round of batches as being sent and returns them"""
+        from flite.core.models import SmsMessage
+
+        now = timezone.now()
+        due = SmsMessage.objects.filter(status=SmsMessage.QUEUED, next_attempt_at__lte=now)
+        claimed = claim(
+            due, ("next_attempt_at",), self.backend.max_batch_size * self.concurrency,
+            {"status": SmsMessage.SENDING, "locked_at": now, "modified": now}, increment=("attempts",),
+        )
+        return sorted(claimed, key=lambda message: message.next_attempt_at)
+
+    def send(self, batch):
+        """Sends one batch, returning the outcome of every message"""
+        self.limiter.acquire(len(batch))
+        try:
+            with batch_seconds.time():
+                return self.backend.send_messages(batch)
+        except SmsError as exc:
+            return {message.pk: exc for message in batch}
+        except Exception as exc:
+            # a bug or an unexpected gateway failure must not lose the batch
+            return {message.pk: TransientSmsError(repr(exc)) for message in batch}
+
+    def dispatch(self):
+        """
+        Sends one round of due messages
+
+        Returns:
+            A Counter of the outcomes, empty when no message was due
+        """
+        messages = self.claim()
+        if not messages:
+            return collections.Counter()
+        send_batches = list(batches(messages, self.backend.max_batch_size))
+        if self.executor is None:
+            results = map(self.send, send_batches)
+        else:
+            results = self.executor.map(self.send, send_batches)
+        outcomes = {}
+        for result in results:
+            outcomes.update(result)
+        return self.record(messages, outcomes)
+
+    def record(self, messages, outcomes):
+        """Writes the outcome of every message back to its row"""
+        from flite.core.models import SmsMessage
+
+        now = timezone.now()
+        sent, retried, failed = {}, {}, {}
+        for message in messages:
+            outcome = outcomes.get(message.pk, TransientSmsError("Not sent"))
+            if not isinstance(outcome, SmsError):
+                sent[message.pk] = outcome
+            elif isinstance(outcome, TransientSmsError) and message.attempts < settings.SMS_MAX_ATTEMPTS:
+                retried[message.pk] = (outcome, now + timedelta(seconds=jobs.backoff(message.attempts)))
+            else:
+                failed[message.pk] = outcome
+
+        if sent:
+            SmsMessage.objects.filter(pk__in=sent).update(
+                status=SmsMessage.SENT, sent_at=now, modified=now, locked_at=None,
+                provider_id=_each(sent, CharField()),
+            )
+        if retried:
+            SmsMessage.objects.filter(pk__in=retried).update(
+                status=SmsMessage.QUEUED, modified=now, locked_at=None,
+                next_attempt_at=_each({pk: at for pk, (_, at) in retried.items()}, DateTimeField()),
+                last_error=_each({pk: str(error) for pk, (error, _) in retried.items()}, TextField()),
+            )
+        if failed:
+            SmsMessage.objects.filter(pk__in=failed).update(
+                status=SmsMessage.FAILED, modified=now, locked_at=None,
+                last_error=_each({pk: str(error) for pk, error in failed.items()}, TextField()),
+            )
+
+        counts = collections.Counter(sent=len(sent), retried=len(retried), failed=len(failed))
+        for outcome, count in counts.items():
+            messages_total.labels(outcome=outcome).inc(count)
+        return counts
+
+
+def requeue_stale():
+    """Queues messages again whose dispatcher stopped while sending them"""
+    from flite.core.models import SmsMessage
+
+    cutoff = timezone.now() - timedelta(seconds=settings.SMS_LOCK_TIMEOUT)
+    return SmsMessage.objects.filter(status=SmsMessage.SENDING, locked_at__lt=cutoff).update(
+        status=SmsMessage.QUEUED, locked_at=None, modified=timezone.now()
+    )
@@ -1,3 +1,421 @@
-from django.test import TestCase
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from datetime import timedelta
+from io import StringIO
+
+import mock
+from django.core.management import call_command
+from django.db import DatabaseError, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from nose.tools import eq_, ok_, assert_raises
+
+from . import instrumentation, jobs, metrics, routers, sms
+from .db.pool import ConnectionPool, PoolTimeout
+from .middleware import ReplicaPinningMiddleware
+from .models import Job, SmsMessage
+from .sms.backends import http as http_backend, locmem
+from .sms.backends.base import SmsError, TransientSmsError
+from .sms.dispatch import Dispatcher, RateLimiter
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"], REPLICA_MAX_LAG=10, REPLICA_LAG_CHECK_INTERVAL=60)
+class TestReplicaRouter(TestCase):
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        patcher = mock.patch.object(routers, "replica_lag", return_value=0.5)
+        self.replica_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(routers.pin, False)
+
+    def test_reads_go_to_a_replica(self):
+        # TestCase wraps each test in a transaction on the primary
+        with mock.patch.object(routers.connections["default"], "in_atomic_block", False):
+            eq_(self.router.db_for_read(None), "replica1")
+        eq_(self.router.db_for_write(None), "default")
+        eq_(metrics.sample("db_replica_lag_seconds", alias="replica1"), 0.5)
+
+    def test_reads_stay_on_the_primary_in_a_transaction(self):
+        with transaction.atomic():
+            eq_(self.router.db_for_read(None), "default")
+
+    def test_pinned_reads_stay_on_the_primary(self):
+        with mock.patch.object(routers.connections["default"], "in_atomic_block", False):
+            with routers.use_primary():
+                eq_(self.router.db_for_read(None), "default")
+            eq_(self.router.db_for_read(None), "replica1")
+
+    def test_lagging_or_broken_replicas_are_skipped(self):
+        with mock.patch.object(routers.connections["default"], "in_atomic_block", False):
+            self.replica_lag.return_value = 30
+            eq_(self.router.db_for_read(None), "default")
+
+            self.router = routers.ReplicaRouter()
+            self.replica_lag.side_effect = DatabaseError()
+            eq_(self.router.db_for_read(None), "default")
+
+    def test_lag_is_checked_once_per_interval(self):
+        for _ in range(3):
+            self.router.replicas()
+        eq_(self.replica_lag.call_count, 1)
+
+
+class TestReplicaPinningMiddleware(TestCase):
+
+    def setUp(self):
+        self.pinned = []
+        self.middleware = ReplicaPinningMiddleware(lambda request: self.pinned.append(routers.is_pinned()))
+        self.factory = RequestFactory()
+
+    def test_clients_read_their_writes(self):
+        self.middleware(self.factory.get("/", HTTP_AUTHORIZATION="Token writer"))
+        self.middleware(self.factory.post("/", HTTP_AUTHORIZATION="Token writer"))
+        self.middleware(self.factory.get("/", HTTP_AUTHORIZATION="Token writer"))
+        self.middleware(self.factory.get("/", HTTP_AUTHORIZATION="Token reader"))
+
+        eq_(self.pinned, [False, True, True, False])
+        ok_(not routers.is_pinned())
+
+    @override_settings(REPLICA_PIN_SECONDS=0)
+    def test_pin_expires(self):
+        self.middleware(self.factory.post("/", HTTP_AUTHORIZATION="Token expired"))
+        self.middleware(self.factory.get("/", HTTP_AUTHORIZATION="Token expired"))
+        eq_(self.pinned, [True, False])
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.alive = True
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(SimpleTestCase):
+
+    def setUp(self):
+        self.opened = []
+
+    def connect(self):
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def pool(self, **kwargs):
+        kwargs.setdefault("timeout", 0.05)
+        return ConnectionPool(self.connect, name="test", **kwargs)
+
+    def test_connections_are_reused(self):
+        pool = self.pool(max_size=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        eq_(pool.getconn(), conn)
+        eq_(len(self.opened), 1)
+        eq_(metrics.sample("db_pool_connections", pool="test", state="in_use"), 1)
+
+    def test_warm_opens_min_size_connections(self):
+        pool = self.pool(min_size=2, max_size=4)
+        pool.warm()
+        eq_(pool.size, 2)
+        eq_(pool.in_use, 0)
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = self.pool(max_size=1)
+        pool.getconn()
+        timeouts = metrics.sample("db_pool_checkout_timeouts_total")
+        with assert_raises(PoolTimeout):
+            pool.getconn()
+        eq_(metrics.sample("db_pool_checkout_timeouts_total"), timeouts + 1)
+
+    def test_checkout_waits_for_a_returned_connection(self):
+        pool = self.pool(max_size=1, timeout=5)
+        conn = pool.getconn()
+        threading.Timer(0.05, pool.putconn, [conn]).start()
+        eq_(pool.getconn(), conn)
+
+    def test_idle_connections_are_recycled_down_to_min_size(self):
+        pool = self.pool(min_size=1, max_size=3, max_idle=0)
+        conns = [pool.getconn() for _ in range(3)]
+        for conn in conns:
+            pool.putconn(conn)
+        time.sleep(0.01)
+
+        pool.getconn()
+        eq_(pool.size, 1)
+        eq_(sum(conn.closed for conn in conns), 2)
+
+    def test_dead_connections_are_replaced_on_checkout(self):
+        pool = self.pool(ping=lambda conn: conn.alive)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.alive = False
+
+        fresh = pool.getconn()
+        ok_(fresh is not conn)
+        ok_(conn.closed)
+        eq_(pool.size, 1)
+
+    def test_connections_that_cannot_be_reset_are_closed(self):
+        pool = self.pool(reset=lambda conn: False)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        ok_(conn.closed)
+        eq_(pool.size, 0)
+
+    def test_failed_connects_free_their_slot(self):
+        pool = ConnectionPool(mock.Mock(side_effect=DatabaseError()), max_size=1, timeout=0)
+        for _ in range(2):
+            with assert_raises(DatabaseError):
+                pool.getconn()
+        eq_(pool.size, 0)
+
+
+class TestInstrumentation(SimpleTestCase):
+
+    def tearDown(self):
+        instrumentation.stop()
+
+    def test_spans_are_ignored_outside_sampled_requests(self):
+        with instrumentation.span("serializer"):
+            pass
+        instrumentation.record("lock", 1)
+        eq_(instrumentation.current(), None)
+
+    def test_nested_spans_count_once(self):
+        timings = instrumentation.start()
+        with mock.patch.object(instrumentation.time, "monotonic", side_effect=[0, 1, 2, 5]):
+            with instrumentation.span("serializer"):
+                with instrumentation.span("serializer"):
+                    pass
+                with instrumentation.span("auth"):
+                    pass
+        eq_(timings.seconds, {"serializer": 5, "auth": 1})
+
+
+class TestMetrics(SimpleTestCase):
+
+    def test_counters_add_up_across_processes(self):
+        script = "from flite.core import metrics; metrics.counter('worker_jobs_total', 'Jobs').inc(2)"
+        with tempfile.TemporaryDirectory() as path:
+            env = dict(os.environ, prometheus_multiproc_dir=path)
+            for _ in range(2):
+                subprocess.check_call([sys.executable, "-c", script], env=env)
+
+            with mock.patch.dict(os.environ, prometheus_multiproc_dir=path):
+                content_type, body = metrics.exposition()
+        ok_(content_type.startswith("text/plain"))
+        ok_(b"worker_jobs_total 4.0" in body)
+
+
+job_calls = []
+
+
+@jobs.job(queue="test")
+def record_call(value):
+    job_calls.append(value)
+
+
+@jobs.job(queue="test", max_attempts=2)
+def always_fail():
+    raise ValueError("no")
+
+
+@override_settings(JOB_RETRY_BACKOFF=10, JOB_MAX_BACKOFF=60, JOB_LOCK_TIMEOUT=60)
+class TestJobs(TestCase):
+
+    def setUp(self):
+        del job_calls[:]
+
+    def test_delay_queues_the_call(self):
+        queued = record_call.delay("hello")
+        eq_((queued.queue, queued.status, queued.name), ("test", Job.QUEUED, record_call.job_name))
+        eq_(job_calls, [])
+
+        claimed, = jobs.claim(["test"])
+        eq_(jobs.run(claimed), "done")
+        eq_(job_calls, ["hello"])
+        ok_(not Job.objects.exists())
+
+    def test_claims_by_priority_and_skips_claimed_jobs(self):
+        low = jobs.enqueue(record_call.job_name, ["low"], queue="test")
+        high = jobs.enqueue(record_call.job_name, ["high"], queue="test", priority=5)
+        later = timezone.now() + timedelta(hours=1)
+        jobs.enqueue(record_call.job_name, ["later"], queue="test", run_at=later)
+        jobs.enqueue(record_call.job_name, ["other"], queue="other")
+
+        eq_([claimed.pk for claimed in jobs.claim(["test"], limit=1)], [high.pk])
+        eq_([claimed.pk for claimed in jobs.claim(["test"])], [low.pk])
+        eq_(jobs.claim(["test"]), [])
+        eq_(Job.objects.get(pk=high.pk).attempts, 1)
+
+    def test_failures_are_retried_with_backoff_then_marked_failed(self):
+        always_fail.delay()
+        claimed, = jobs.claim()
+        eq_(jobs.run(claimed), "retried")
+        retried = Job.objects.get()
+        eq_(retried.status, Job.QUEUED)
+        ok_(retried.run_at >= timezone.now() + timedelta(seconds=4))
+        ok_("ValueError" in retried.last_error)
+
+        Job.objects.update(run_at=timezone.now())
+        claimed, = jobs.claim()
+        eq_(jobs.run(claimed), "failed")
+        eq_(Job.objects.get().status, Job.FAILED)
+
+    def test_jobs_of_dead_workers_are_queued_again(self):
+        record_call.delay("stuck")
+        jobs.claim()
+        eq_(jobs.requeue_stale(), 0)
+        Job.objects.update(locked_at=timezone.now() - timedelta(minutes=5))
+        eq_(jobs.requeue_stale(), 1)
+        eq_(Job.objects.get().status, Job.QUEUED)
+
+    def test_queue_depth_is_recorded(self):
+        record_call.delay(1)
+        record_call.delay(2)
+        eq_(jobs.record_depth(), {"test": 2})
+        eq_(metrics.sample("jobs_queued", queue="test"), 2)
+        Job.objects.all().delete()
+        jobs.record_depth()
+        eq_(metrics.sample("jobs_queued", queue="test"), 0)
+
+
+class TestRunJobsCommand(TransactionTestCase):
+
+    def setUp(self):
+        del job_calls[:]
+
+    def test_runs_due_jobs_until_none_are_left(self):
+        for value in range(5):
+            record_call.delay(value)
+        always_fail.delay()
+        out = StringIO()
+        # SQLite's shared in-memory test database cannot take writes from
+        # several threads, so the jobs run in this one
+        call_command("run_jobs", queues="test", concurrency=1, batch_size=2, once=True, stdout=out)
+        eq_(sorted(job_calls), list(range(5)))
+        ok_("5 done, 1 to be retried" in out.getvalue())
+        eq_(Job.objects.get().name, always_fail.job_name)
+
+
+class FlakyBackend(locmem.SmsBackend):
+    """Sends batches of two, refusing messages to +1 numbers and failing batches with +99 numbers"""
+    max_batch_size = 2
+
+    def __init__(self):
+        self.batches = []
+
+    def send_messages(self, messages):
+        self.batches.append(messages)
+        if any(message.phone_number.startswith("+99") for message in messages):
+            raise TransientSmsError("gateway down")
+        outcomes = super(FlakyBackend, self).send_messages(messages)
+        for message in messages:
+            if message.phone_number.startswith("+1"):
+                outcomes[message.pk] = SmsError("invalid number")
+        return outcomes
+
+
+@override_settings(SMS_MAX_ATTEMPTS=2, JOB_RETRY_BACKOFF=10, JOB_MAX_BACKOFF=60, SMS_RATE_LIMIT=0)
+class TestSmsDispatch(TestCase):
+
+    def setUp(self):
+        del sms.outbox[:]
+        self.backend = FlakyBackend()
+        self.dispatcher = Dispatcher(backend=self.backend, concurrency=2)
+        self.addCleanup(self.dispatcher.close)
+
+    def test_messages_are_sent_in_batches(self):
+        sms.send_many([("+23480000000{}".format(index), "hello") for index in range(5)])
+        eq_(self.dispatcher.dispatch()["sent"], 4)
+        eq_([len(batch) for batch in self.backend.batches], [2, 2])
+        eq_(self.dispatcher.dispatch()["sent"], 1)
+        eq_(self.dispatcher.dispatch(), {})
+        eq_(len(sms.outbox), 5)
+        sent = SmsMessage.objects.filter(status=SmsMessage.SENT)
+        eq_(sent.count(), 5)
+        ok_(all(message.provider_id == "locmem-{}".format(message.pk) for message in sent))
+
+    def test_refused_messages_fail_and_transient_errors_are_retried(self):
+        # batches of two: the first has a refused message, the second fails
+        refused = sms.send_sms("+15550000000", "hello")
+        sms.send_sms("+2348031234567", "hello")
+        retried = sms.send_sms("+99550000000", "hello")
+        eq_(self.dispatcher.dispatch(), {"sent": 1, "failed": 1, "retried": 1})
+        eq_(SmsMessage.objects.get(pk=refused.pk).last_error, "invalid number")
+
+        retried = SmsMessage.objects.get(pk=retried.pk)
+        eq_((retried.status, retried.attempts), (SmsMessage.QUEUED, 1))
+        ok_(retried.next_attempt_at >= timezone.now() + timedelta(seconds=4))
+        eq_(self.dispatcher.dispatch(), {})
+
+        SmsMessage.objects.update(next_attempt_at=timezone.now())
+        eq_(self.dispatcher.dispatch()["failed"], 1)
+        eq_(SmsMessage.objects.get(pk=retried.pk).status, SmsMessage.FAILED)
+
+    def test_verification_codes_are_queued_as_sms(self):
+        from flite.users import tasks
+
+        tasks.send_sms_verification_code("+2348031234567", "123456")
+        self.dispatcher.dispatch()
+        eq_(sms.outbox[0].body, "Your Flite verification code is 123456")
+
+
+class TestSmsHttpBackend(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = http_backend.SmsBackend(url="http://gateway.test/messages", token="secret")
+        self.messages = [SmsMessage(phone_number="+2348031234567", body="hi") for _ in range(2)]
+
+    def respond(self, status, payload):
+        response = mock.Mock(status=status, data=json.dumps(payload).encode())
+        return mock.patch.object(self.backend.http, "request", return_value=response)
+
+    def test_results_are_matched_to_messages(self):
+        first, second = self.messages
+        with self.respond(200, {"results": [
+            {"id": str(first.pk), "status": "accepted", "provider_id": "p1"},
+            {"id": str(second.pk), "status": "rejected", "error": "invalid number"},
+        ]}) as request:
+            outcomes = self.backend.send_messages(self.messages)
+        eq_(outcomes[first.pk], "p1")
+        ok_(isinstance(outcomes[second.pk], SmsError))
+        eq_(request.call_args[1]["headers"]["Authorization"], "Bearer secret")
+        eq_(len(json.loads(request.call_args[1]["body"])["messages"]), 2)
+
+    def test_accepted_batches_are_never_retried(self):
+        first, second = self.messages
+        accepted = {"id": str(first.pk), "status": "accepted", "provider_id": "p1"}
+        with self.respond(200, {"results": [accepted]}):
+            eq_(self.backend.send_messages(self.messages), {first.pk: "p1", second.pk: ""})
+        unreadable = mock.Mock(status=202, data=b"<html>")
+        with mock.patch.object(self.backend.http, "request", return_value=unreadable):
+            eq_(self.backend.send_messages(self.messages), {first.pk: "", second.pk: ""})
+
+    def test_overload_is_transient(self):
+        with self.respond(503, {}):
+            assert_raises(TransientSmsError, self.backend.send_messages, self.messages)
+        with self.respond(400, {}):
+            with assert_raises(SmsError) as raised:
+                self.backend.send_messages(self.messages)
+            ok_(not isinstance(raised.exception, TransientSmsError))
+
+
+class TestRateLimiter(SimpleTestCase):
+
+    def test_waits_once_the_rate_is_used_up(self):
+        limiter = RateLimiter(10)
+        with mock.patch("flite.core.sms.dispatch.time.sleep") as sleep:
+            limiter.acquire(10)
+            ok_(not sleep.called)
+            limiter.acquire(5)
+        ok_(0.4 < sleep.call_args[0][0] <= 0.5)
@@ -51,5 +51,35 @@ def get_or_404(klass, title=None, **kwargs):
 FAILURE_MSGS = {
     "insufficient_funds": "insufficient funds",
     "must_be_greater": "{} amount must be greater than {}",
-    "no_self_p2p" : "You cannot make p2p transfer to yourself"
+    "no_self_p2p": "You cannot make p2p transfer to yourself",
+    "unknown_recipient": "recipient account does not exist",
+    "too_many_items": "at most {} items can be sent in one request",
 }
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which ``fraction`` of ``values`` fall
+
+    Args:
+        values(list): Sorted numbers
+        fraction(float): Between 0 and 1
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def latency_summary(seconds):
+    """Returns the p50, p95, p99 and max of a list of durations, in milliseconds"""
+    seconds = sorted(seconds)
+
+    def in_ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "p50": in_ms(percentile(seconds, 0.50)),
+        "p95": in_ms(percentile(seconds, 0.95)),
+        "p99": in_ms(percentile(seconds, 0.99)),
+        "max": in_ms(seconds[-1] if seconds else None),
+    }
@@ -1,3 +1,19 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from . import metrics
+
+
+def metrics_view(request):
+    """
+    Serves the metrics in the Prometheus text format. When METRICS_TOKEN
+    is set, scrapers must send it as a bearer token.
+    """
+    if settings.METRICS_TOKEN:
+        expected = "Bearer {}".format(settings.METRICS_TOKEN)
+        if not hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", ""), expected):
+            return HttpResponseForbidden()
+    content_type, body = metrics.exposition()
+    return HttpResponse(body, content_type=content_type)
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings, loaded with ``gunicorn -c python:flite.gunicorn``.
+
+Workers share their metrics through files in prometheus_multiproc_dir.
+The directory is emptied when the server starts, and the files of a
+worker that exits are retired so its gauges stop being reported.
+
+Transaction streams are not served by these workers, whose threads they
+would hold for as long as their clients stay connected; the stream
+server of flite.gunicorn_streams serves them.
+"""
+import os
+import shutil
+
+os.environ.setdefault("prometheus_multiproc_dir", "/tmp/flite-metrics")
+os.environ.setdefault("TRANSACTION_STREAMS_ENABLED", "no")
+
+
+def on_starting(server):
+    path = os.environ["prometheus_multiproc_dir"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,20 @@
+"""
+Gunicorn settings of the transaction stream server, loaded with
+``gunicorn -c python:flite.gunicorn_streams``.
+
+An open stream holds a thread for as long as its client stays connected
+but no database connection, so its workers run many threads each.
+deploy/start-web runs this server and the one of flite.gunicorn, which
+does not serve streams, behind nginx, which routes
+``/api/v1/account/<id>/transactions/stream`` here.
+"""
+import os
+
+os.environ["TRANSACTION_STREAMS_ENABLED"] = "yes"
+# kept apart from the API server's, whose start empties its directory
+os.environ.setdefault("prometheus_multiproc_dir", "/tmp/flite-stream-metrics")
+
+from flite.gunicorn import child_exit, on_starting  # noqa: E402,F401
+
+worker_class = "gthread"
+threads = int(os.environ.get("TRANSACTION_STREAM_THREADS", 256))
@@ -5,6 +5,7 @@ from django.contrib import admin
 from django.views.generic.base import RedirectView
 from rest_framework.routers import DefaultRouter
 from rest_framework.authtoken import views
+from .core.views import metrics_view
 from .users.views import (
     UserViewSet,
     UserCreateViewSet,
@@ -12,8 +13,12 @@ from .users.views import (
     DepositCreateViewSet,
     WithdrawalCreateViewSet,
     P2PCreateViewSet,
+    BulkP2PCreateViewSet,
+    BalanceViewSet,
     ListTransactionsViewSet,
     RetrieveTransactionViewSet,
+    ExportTransactionsViewSet,
+    StreamTransactionsViewSet,
 )
 
 router = DefaultRouter()
@@ -31,11 +36,20 @@ urlpatterns = [
          WithdrawalCreateViewSet.as_view({'post': 'create'}), name="withdrawal-url"),
     path("api/v1/account/<str:sender_account_id>/transfers/<str:recipient_account_id>",
           P2PCreateViewSet.as_view({"post": "create"}), name="p2p-transfer-url",),
+    path("api/v1/account/<str:sender_account_id>/transfers",
+         BulkP2PCreateViewSet.as_view({"post": "create"}), name="bulk-p2p-transfer-url",),
+    path('api/v1/account/<str:account_id>/balance',
+         BalanceViewSet.as_view({'get': 'retrieve'}), name="account-balance"),
     path('api/v1/account/<str:account_id>/transactions',
          ListTransactionsViewSet.as_view({'get': 'list'}), name="user-transactions"),
+    path('api/v1/account/<str:account_id>/transactions/export',
+         ExportTransactionsViewSet.as_view({'get': 'list'}), name="user-transactions-export"),
+    path('api/v1/account/<str:account_id>/transactions/stream',
+         StreamTransactionsViewSet.as_view({'get': 'list'}), name="user-transactions-stream"),
     path('api/v1/account/transactions/<str:transaction_id>',
          RetrieveTransactionViewSet.as_view({'get': 'retrieve'}), name="user-transaction"),
     path('api-token-auth/', views.obtain_auth_token),
+    path('metrics', metrics_view, name="metrics"),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 
 
@@ -1,8 +1,31 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User
+from . import webhooks
+from .models import User, WebhookDelivery, WebhookEndpoint
 
 
 @admin.register(User)
 class UserAdmin(UserAdmin):
     pass
+
+
+@admin.register(WebhookEndpoint)
+class WebhookEndpointAdmin(admin.ModelAdmin):
+    list_display = ('url', 'event_types', 'is_active', 'created')
+    list_filter = ('is_active',)
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = (
+        'event', 'endpoint', 'account_id', 'status', 'attempts', 'next_attempt_at', 'delivered_at',
+    )
+    list_filter = ('status', 'endpoint')
+    search_fields = ('account_id',)
+    raw_id_fields = ('event',)
+    actions = ('redeliver',)
+
+    def redeliver(self, request, queryset):
+        count = webhooks.redeliver(queryset)
+        self.message_user(request, "{} dead delivery(ies) queued again.".format(count))
+    redeliver.short_description = "Deliver the selected dead deliveries again"
@@ -0,0 +1,76 @@
+"""
+Per-account balance cache.
+
+A balance read from the database is cached, and every posting drops
+the cached balances of the accounts it touched from an on-commit hook,
+so the next read sees the committed balance. The hooks delete rather
+than write the new balance: hooks of concurrent postings can run out of
+order, and writing could leave an older balance over a newer one. A read
+that started before a posting committed can still cache the balance it
+saw after the hook ran, so entries also expire after BALANCE_CACHE_TTL
+seconds to bound how long a stale value can be served.
+"""
+import decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from flite.core import metrics, routers
+
+
+hits = metrics.counter("balance_cache_hits_total", "Balance reads served from the balance cache")
+misses = metrics.counter("balance_cache_misses_total", "Balance reads that went to the database")
+
+
+def _cache():
+    return caches[settings.BALANCE_CACHE]
+
+
+def cache_key(owner_id):
+    return "balance:{}".format(owner_id)
+
+
+def _format(value):
+    from .models import Balance
+
+    places = Balance._meta.get_field("available_balance").decimal_places
+    return str(decimal.Decimal(value).quantize(decimal.Decimal(1).scaleb(-places)))
+
+
+def _payload(available_balance, book_balance):
+    return {"available_balance": _format(available_balance), "book_balance": _format(book_balance)}
+
+
+def invalidate(*owner_ids):
+    """Drops the cached balances of ``owner_ids`` once the current transaction commits"""
+    keys = [cache_key(owner_id) for owner_id in owner_ids]
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def get_balance(owner_id):
+    """
+    Returns the balance of ``owner_id`` as a dict of available and book
+    balance, reading the database only on a cache miss.
+    """
+    from .models import Balance
+
+    key = cache_key(owner_id)
+    payload = _cache().get(key)
+    if payload is not None:
+        hits.inc()
+    else:
+        misses.inc()
+        # from the primary: a lagging replica's balance would be cached
+        # for BALANCE_CACHE_TTL; credits still held in the slots of a
+        # sharded balance count too
+        with routers.use_primary():
+            available, book, pending = Balance.objects.filter(owner_id=owner_id).annotate(
+                pending=Coalesce(Sum("slots__available_balance"), 0)
+            ).values_list("available_balance", "book_balance", "pending").get()
+        pending = decimal.Decimal(pending)
+        payload = _payload(decimal.Decimal(available) + pending, decimal.Decimal(book) + pending)
+        _cache().set(key, payload, settings.BALANCE_CACHE_TTL)
+    return payload
@@ -0,0 +1,91 @@
+"""
+Streaming transaction exports.
+
+Rows are read from the TransactionEntry table through ``iterator()``,
+which on Postgres uses a named server-side cursor, and are encoded into
+buffered chunks as they arrive. Memory use stays flat however long the
+history is, and the header goes out before the query has even run.
+"""
+import csv
+import json
+
+from django.conf import settings
+
+from .models import TransactionEntry
+
+
+FIELDS = (
+    "id", "type", "created", "reference", "status", "amount", "new_balance",
+    "owner", "sender", "receipient", "bank",
+)
+COLUMNS = (
+    "id", "type", "created", "reference", "status", "amount", "new_balance",
+    "owner_id", "sender_id", "receipient_id", "bank_id",
+)
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+# flush encoded rows once this many characters are buffered
+BUFFER_SIZE = 64 * 1024
+
+
+class _Echo(object):
+    """A file-like object whose write() returns what it was given, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def _format(value):
+    if value is None:
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow(["" if value is None else _format(value) for value in row])
+
+
+def _encode_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, (_format(value) for value in row)))) + "\n"
+
+
+ENCODERS = {
+    "csv": _encode_csv,
+    "ndjson": _encode_ndjson,
+}
+
+
+def export_queryset(**filters):
+    """Returns the entries to export, oldest first"""
+    return TransactionEntry.objects.filter(**filters).order_by("created", "id")
+
+
+def stream(queryset, file_format):
+    """
+    Yields the rows of ``queryset`` encoded as ``file_format`` in chunks of
+    roughly BUFFER_SIZE characters.
+    """
+    rows = queryset.values_list(*COLUMNS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    lines = ENCODERS[file_format](rows)
+    # send the first line on its own so the client sees bytes right away
+    for line in lines:
+        yield line
+        break
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
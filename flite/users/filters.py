@@ -0,0 +1,23 @@
+import django_filters
+
+from .models import TransactionEntry
+
+
+class TransactionEntryFilter(django_filters.FilterSet):
+    """
+    Filters for the transaction history. Every filter, alone or combined
+    with the date range, is served by one of the TransactionEntry indexes.
+    """
+    created_after = django_filters.IsoDateTimeFilter(field_name="created", lookup_expr="gte")
+    created_before = django_filters.IsoDateTimeFilter(field_name="created", lookup_expr="lt")
+    type = django_filters.MultipleChoiceFilter(choices=TransactionEntry.TYPES)
+    status = django_filters.CharFilter()
+    min_amount = django_filters.NumberFilter(field_name="amount", lookup_expr="gte")
+    max_amount = django_filters.NumberFilter(field_name="amount", lookup_expr="lte")
+    reference = django_filters.CharFilter()
+
+    class Meta:
+        model = TransactionEntry
+        fields = (
+            "created_after", "created_before", "type", "status", "min_amount", "max_amount", "reference",
+        )
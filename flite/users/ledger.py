@@ -0,0 +1,540 @@
+"""
+Ledger postings.
+
+Balance changes are applied with conditional UPDATE statements so the
+arithmetic happens in the database under the row lock the UPDATE takes,
+instead of as a read-modify-write in Python. The new balance comes back
+through ``RETURNING`` and the transaction row is written inside the same
+database transaction, so a posting either lands completely or not at all.
+"""
+import collections
+import decimal
+import functools
+import inspect
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Case, DecimalField, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from flite.core import instrumentation, metrics
+from flite.core.utils import FAILURE_MSGS
+from . import balance_cache, outbox, partitions
+
+
+# serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = ("40001", "40P01")
+
+BALANCE_UPDATE_FIELDS = ("available_balance", "book_balance", "modified")
+
+retries_total = metrics.counter(
+    "ledger_retries_total", "Postings retried after a serialization failure or deadlock"
+)
+lock_wait_seconds_total = metrics.counter(
+    "ledger_lock_wait_seconds_total", "Time spent waiting for balance row locks"
+)
+lock_acquisitions_total = metrics.counter(
+    "ledger_lock_acquisitions_total", "Balance row lock queries executed"
+)
+postings_total = metrics.counter(
+    "ledger_postings_total", "Postings by transaction type and outcome", labelnames=("type", "outcome")
+)
+
+
+_POSTING_SQL = (
+    "UPDATE {table} SET {available} = {available} + %s, {book} = {available} + %s"
+    " WHERE {pk} = %s{guard} RETURNING {available}"
+)
+
+
+def _to_decimal(value, field):
+    """Normalise a raw database value to the precision of ``field``."""
+    return field.to_python(value).quantize(decimal.Decimal(10) ** -field.decimal_places)
+
+
+def _apply(balance, delta, guard=False):
+    """
+    Adds ``delta`` to ``balance`` with a single UPDATE ... RETURNING.
+
+    Args:
+        balance(Balance): The balance to update
+        delta(Decimal): Signed amount to add to the balance
+        guard(bool): Only update when the balance covers the debit
+
+    Returns:
+        The new available balance, or None when the guard rejected the update
+    """
+    opts = balance._meta
+    available = opts.get_field("available_balance")
+    qn = connection.ops.quote_name
+    sql = _POSTING_SQL.format(
+        table=qn(opts.db_table),
+        available=qn(available.column),
+        book=qn(opts.get_field("book_balance").column),
+        pk=qn(opts.pk.column),
+        guard=" AND {} >= %s".format(qn(available.column)) if guard else "",
+    )
+    params = [delta, delta, opts.pk.get_db_prep_value(balance.pk, connection)]
+    if guard:
+        params.append(-delta)
+    with connection.cursor() as cursor:
+        # the UPDATE waits for the row lock like a SELECT ... FOR UPDATE does
+        started = time.monotonic()
+        cursor.execute(sql, params)
+        _record_lock_wait(started)
+        row = cursor.fetchone()
+    return _to_decimal(row[0], available) if row else None
+
+
+def counted(func):
+    """
+    Counts the calls of ``func`` in ``ledger_postings_total`` by the type
+    of its ``klass`` argument and by outcome. Apply it outside
+    ``retrying`` so a retried posting counts once.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        klass = signature.bind(*args, **kwargs).arguments["klass"]
+        try:
+            result = func(*args, **kwargs)
+        except ValidationError as exc:
+            insufficient = FAILURE_MSGS["insufficient_funds"] in exc.messages
+            _count(klass, "insufficient_funds" if insufficient else "rejected")
+            raise
+        except Exception:
+            _count(klass, "error")
+            raise
+        _count(klass, "complete")
+        return result
+    return wrapper
+
+
+def _count(klass, outcome, amount=1):
+    postings_total.labels(type=klass._meta.model_name, outcome=outcome).inc(amount)
+
+
+def _is_retryable(exc):
+    return getattr(exc.__cause__, "pgcode", None) in RETRYABLE_SQLSTATES
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff, capped at LEDGER_RETRY_MAX_DELAY"""
+    delay = min(settings.LEDGER_RETRY_MAX_DELAY, settings.LEDGER_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, delay)
+
+
+def retrying(func):
+    """
+    Re-runs ``func`` when its transaction is aborted by a deadlock or a
+    serialization failure, up to LEDGER_MAX_RETRIES times. A posting in a
+    month that has no partition yet creates the partition once its own
+    transaction has rolled back, and runs again.
+
+    Nothing is retried inside an outer atomic block: the failure has
+    already aborted the caller's transaction, so it must handle it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            return func(*args, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as exc:
+                if attempt >= settings.LEDGER_MAX_RETRIES or not _is_retryable(exc):
+                    raise
+            except IntegrityError as exc:
+                if attempt >= settings.LEDGER_MAX_RETRIES or not partitions.is_missing_partition(exc):
+                    raise
+                partitions.create_for_write(partitions.month_start(timezone.now()))
+                attempt += 1
+                continue
+            retries_total.inc()
+            time.sleep(_backoff(attempt))
+            attempt += 1
+    return wrapper
+
+
+def _record_lock_wait(started):
+    waited = time.monotonic() - started
+    lock_wait_seconds_total.inc(waited)
+    instrumentation.record("lock", waited)
+    lock_acquisitions_total.inc()
+
+
+def _lock(queryset):
+    started = time.monotonic()
+    locked = {row.pk: row for row in queryset.select_for_update().order_by("pk")}
+    _record_lock_wait(started)
+    return locked
+
+
+def lock(model, *pks):
+    """
+    Locks the ``model`` rows in ``pks`` with one SELECT ... FOR UPDATE.
+
+    Rows are locked in primary key order, so two postings touching the
+    same pair of balances always queue up instead of deadlocking.
+
+    Returns:
+        A dict of the locked instances keyed by primary key
+    """
+    return _lock(model.objects.filter(pk__in=pks))
+
+
+def _insert_rows(model, fields, objs):
+    """Inserts ``objs`` into the table of ``model`` with multi-row INSERTs"""
+    qn = connection.ops.quote_name
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        sql = "INSERT INTO {} ({}) {}".format(
+            qn(model._meta.db_table),
+            ", ".join(qn(field.column) for field in fields),
+            connection.ops.bulk_insert_sql(fields, [["%s"] * len(fields)] * len(batch)),
+        )
+        params = [
+            field.get_db_prep_save(field.pre_save(obj, True), connection)
+            for obj in batch for field in fields
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+def insert_transactions(klass, objs):
+    """
+    Inserts unsaved ``klass`` transactions, one table at a time.
+
+    bulk_create() refuses multi-table inherited models, and save() on one
+    issues a wasted UPDATE of the parent row before inserting it, so the
+    parent and child tables are written here with plain INSERTs. Their
+    TransactionEntry read rows and outbox events are written alongside
+    them.
+    """
+    from .models import TransactionEntry
+
+    for obj in objs:
+        for parent, link in klass._meta.parents.items():
+            setattr(obj, link.attname, getattr(obj, parent._meta.pk.attname))
+    for model in list(reversed(klass._meta.get_parent_list())) + [klass]:
+        _insert_rows(model, model._meta.local_concrete_fields, objs)
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    entries = TransactionEntry.objects.bulk_create([TransactionEntry.from_transaction(obj) for obj in objs])
+    outbox.record(entries)
+    return objs
+
+
+def current_balance(balance):
+    """
+    Returns the available balance of ``balance`` including the credits
+    still held in its slots, read with a single query.
+    """
+    field = balance._meta.get_field("available_balance")
+    if not balance.is_sharded:
+        value = type(balance).objects.filter(pk=balance.pk).values_list("available_balance", flat=True).get()
+        return _to_decimal(value, field)
+    available, pending = type(balance).objects.filter(pk=balance.pk).annotate(
+        pending=Coalesce(Sum("slots__available_balance"), 0)
+    ).values_list("available_balance", "pending").get()
+    return _to_decimal(available, field) + _to_decimal(pending, field)
+
+
+def _credit_slot(balance, amount):
+    """
+    Credits a random slot of a sharded balance without touching (or
+    waiting on) the balance row itself.
+    """
+    index = random.randrange(balance.slot_count)
+    updated = balance.slots.filter(index=index).update(available_balance=F("available_balance") + amount)
+    if not updated:
+        # the balance was resharded since it was loaded
+        _apply(balance, amount)
+
+
+def _consolidate(balance):
+    """
+    Moves everything held in the slots of ``balance`` into its row.
+
+    The caller must already hold the lock on the balance row; the slots
+    are always locked after it, so consolidation cannot deadlock with
+    another debit.
+    """
+    slots = list(balance.slots.select_for_update().order_by("index"))
+    pending = sum((slot.available_balance for slot in slots), decimal.Decimal(0))
+    if pending:
+        balance.slots.update(available_balance=0)
+        balance.available_balance += pending
+        balance.book_balance += pending
+        balance.save(update_fields=BALANCE_UPDATE_FIELDS)
+
+
+def reshard(balance, count):
+    """
+    Splits ``balance`` into ``count`` credit slots, or back into a single
+    row when ``count`` is 1.
+    """
+    if count < 1:
+        raise ValueError("a balance needs at least one slot")
+    model = type(balance)
+    with transaction.atomic():
+        locked = lock(model, balance.pk)[balance.pk]
+        _consolidate(locked)
+        locked.slots.all().delete()
+        if count > 1:
+            locked.slots.model.objects.bulk_create(
+                locked.slots.model(balance=locked, index=index) for index in range(count)
+            )
+        locked.slot_count = count
+        locked.save(update_fields=BALANCE_UPDATE_FIELDS + ("slot_count",))
+    balance.slot_count = count
+    balance.available_balance = locked.available_balance
+    balance.book_balance = locked.book_balance
+
+
+def _build(balance, amount, klass, **kwargs):
+    from .models import make_refernce
+
+    return klass(
+        owner_id=balance.owner_id,
+        amount=amount,
+        reference=make_refernce(klass.__name__.capitalize()),
+        **kwargs
+    )
+
+
+def _record(balance, amount, klass, **kwargs):
+    """Writes the transaction row for a posting and returns it"""
+    return insert_transactions(klass, [_build(balance, amount, klass, **kwargs)])[0]
+
+
+@counted
+@retrying
+def credit(balance, amount, klass, **kwargs):
+    """
+    Credits ``balance`` and records a ``klass`` transaction for it.
+
+    Args:
+        balance(Balance): The balance to credit
+        amount(number): The amount to credit
+        klass(class): The transaction model to record
+        kwargs(dict): Extra transaction attributes
+
+    Returns:
+        The recorded transaction
+    """
+    amount = decimal.Decimal(amount)
+    with transaction.atomic():
+        if balance.is_sharded:
+            _credit_slot(balance, amount)
+            new_balance = current_balance(balance)
+        else:
+            new_balance = _apply(balance, amount)
+        tnx = _record(balance, amount, klass, status="complete", new_balance=new_balance, **kwargs)
+        balance_cache.invalidate(balance.owner_id)
+    if not balance.is_sharded:
+        balance.available_balance = balance.book_balance = new_balance
+    return tnx
+
+
+@counted
+@retrying
+def debit(balance, amount, klass, **kwargs):
+    """
+    Debits ``balance`` and records a ``klass`` transaction for it.
+
+    The funds check is part of the UPDATE, so two concurrent debits can
+    never take the balance below zero.
+
+    Raises:
+        ValidationError: When the balance does not cover ``amount``
+    """
+    amount = decimal.Decimal(amount)
+    with transaction.atomic():
+        if balance.is_sharded:
+            _consolidate(lock(type(balance), balance.pk)[balance.pk])
+        new_balance = _apply(balance, -amount, guard=True)
+        if new_balance is None:
+            raise ValidationError(FAILURE_MSGS["insufficient_funds"])
+        tnx = _record(balance, amount, klass, status="complete", new_balance=new_balance, **kwargs)
+        balance_cache.invalidate(balance.owner_id)
+    balance.available_balance = balance.book_balance = new_balance
+    return tnx
+
+
+@counted
+@retrying
+def transfer(source, target, amount, klass, **kwargs):
+    """
+    Moves ``amount`` from ``source`` to ``target`` and records a ``klass``
+    transaction for the sender.
+
+    Both balances are locked before the funds check, so the check sees
+    the committed balance rather than the caller's copy of it.
+
+    Raises:
+        ValidationError: When ``source`` does not cover ``amount``
+    """
+    amount = decimal.Decimal(amount)
+    with transaction.atomic():
+        # a sharded recipient is credited through a slot and is never locked
+        pks = [source.pk] if target.is_sharded else [source.pk, target.pk]
+        locked = lock(type(source), *pks)
+        sender = locked[source.pk]
+        if sender.is_sharded:
+            _consolidate(sender)
+        if sender.available_balance < amount:
+            raise ValidationError(FAILURE_MSGS["insufficient_funds"])
+
+        sender.available_balance -= amount
+        sender.book_balance -= amount
+        sender.save(update_fields=BALANCE_UPDATE_FIELDS)
+        if target.is_sharded:
+            _credit_slot(target, amount)
+        else:
+            recipient = locked[target.pk]
+            recipient.available_balance += amount
+            recipient.book_balance += amount
+            recipient.save(update_fields=BALANCE_UPDATE_FIELDS)
+
+        tnx = _record(
+            sender, amount, klass, status="complete", new_balance=sender.available_balance, **kwargs
+        )
+        balance_cache.invalidate(sender.owner_id, target.owner_id)
+    source.available_balance = sender.available_balance
+    source.book_balance = sender.book_balance
+    if not target.is_sharded:
+        target.available_balance = recipient.available_balance
+        target.book_balance = recipient.book_balance
+    return tnx
+
+
+@retrying
+def bulk_transfer(source, payouts, klass):
+    """
+    Pays every ``(recipient owner id, amount)`` in ``payouts`` from
+    ``source`` in one database transaction.
+
+    The sender and all recipient balances are looked up and locked by a
+    single ordered SELECT ... FOR UPDATE, recipients are credited with
+    one UPDATE and the ``klass`` transactions are written with multi-row
+    INSERTs, so the number of queries does not grow with the batch.
+    Payouts are applied in order; one that fails validation or is not
+    covered by the remaining funds is skipped and reported.
+
+    Returns:
+        A result dict per payout, in the order of ``payouts``
+    """
+    model = type(source)
+    to_owner_id = model._meta.get_field("owner").target_field.to_python
+    payouts = [(to_owner_id(owner_id), decimal.Decimal(amount)) for owner_id, amount in payouts]
+    owner_ids = {owner_id for owner_id, _ in payouts}
+    results = []
+    with transaction.atomic():
+        locked = _lock(model.objects.filter(Q(pk=source.pk) | Q(owner_id__in=owner_ids)))
+        sender = locked[source.pk]
+        if sender.is_sharded:
+            _consolidate(sender)
+        recipients = {balance.owner_id: balance for balance in locked.values()}
+
+        credits = collections.defaultdict(decimal.Decimal)
+        transactions = []
+        funds = sender.available_balance
+        for owner_id, amount in payouts:
+            result = {"recipient": str(owner_id), "amount": str(amount)}
+            results.append(result)
+            if owner_id == sender.owner_id:
+                reason = FAILURE_MSGS["no_self_p2p"]
+            elif owner_id not in recipients:
+                reason = FAILURE_MSGS["unknown_recipient"]
+            elif amount > funds:
+                reason = FAILURE_MSGS["insufficient_funds"]
+            else:
+                funds -= amount
+                credits[recipients[owner_id].pk] += amount
+                tnx = _build(
+                    sender, amount, klass, status="complete", new_balance=funds,
+                    sender_id=sender.owner_id, receipient_id=owner_id,
+                )
+                transactions.append(tnx)
+                result.update(status="complete", reference=tnx.reference)
+                continue
+            result.update(status="failed", reason=reason)
+
+        if transactions:
+            debited = sender.available_balance - funds
+            sender.available_balance = funds
+            sender.book_balance -= debited
+            sender.save(update_fields=BALANCE_UPDATE_FIELDS)
+
+            field = model._meta.get_field("available_balance")
+            increment = Case(
+                *[When(pk=pk, then=Value(amount)) for pk, amount in credits.items()],
+                output_field=DecimalField(max_digits=field.max_digits, decimal_places=field.decimal_places)
+            )
+            model.objects.filter(pk__in=credits).update(
+                available_balance=F("available_balance") + increment,
+                book_balance=F("book_balance") + increment,
+                modified=timezone.now(),
+            )
+            insert_transactions(klass, transactions)
+            balance_cache.invalidate(sender.owner_id, *(
+                balance.owner_id for balance in recipients.values() if balance.pk in credits
+            ))
+    source.available_balance = sender.available_balance
+    source.book_balance = sender.book_balance
+    outcomes = collections.Counter(
+        "complete" if result["status"] == "complete"
+        else "insufficient_funds" if result["reason"] == FAILURE_MSGS["insufficient_funds"]
+        else "rejected"
+        for result in results
+    )
+    for outcome, count in outcomes.items():
+        _count(klass, outcome, count)
+    return results
+
+
+def reconcile(owner_ids):
+    """
+    Checks that the balance of every account in ``owner_ids`` equals the
+    sum of its complete transactions: deposits and P2P transfers received,
+    less withdrawals, bank transfers and P2P transfers sent.
+
+    Returns:
+        A dict with the account id, balance and expected balance of each
+        account that does not add up
+    """
+    from .models import Balance, TransactionEntry
+
+    field = Balance._meta.get_field("available_balance")
+    owner_ids = list(owner_ids)
+    entries = TransactionEntry.objects.filter(status="complete")
+    expected = collections.defaultdict(decimal.Decimal)
+
+    def add(queryset, column, sign):
+        for owner_id, total in queryset.values_list(column).annotate(total=Sum("amount")).order_by():
+            expected[str(owner_id)] += sign * _to_decimal(total, field)
+
+    add(entries.filter(owner_id__in=owner_ids, type=TransactionEntry.DEPOSIT), "owner_id", 1)
+    add(entries.filter(receipient_id__in=owner_ids, type=TransactionEntry.P2P_TRANSFER), "receipient_id", 1)
+    add(entries.filter(owner_id__in=owner_ids).exclude(type=TransactionEntry.DEPOSIT), "owner_id", -1)
+
+    mismatches = []
+    balances = Balance.objects.filter(owner_id__in=owner_ids).annotate(
+        pending=Coalesce(Sum("slots__available_balance"), 0)
+    ).values_list("owner_id", "available_balance", "pending")
+    for owner_id, available, pending in balances:
+        actual = _to_decimal(available, field) + _to_decimal(pending, field)
+        if actual != expected[str(owner_id)]:
+            mismatches.append({
+                "account": str(owner_id), "balance": str(actual), "expected": str(expected[str(owner_id)]),
+            })
+    return mismatches
@@ -0,0 +1,53 @@
+import itertools
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from flite.users import partitions
+from flite.users.models import Transaction, TransactionEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Copies transactions recorded before the TransactionEntry read table "
+        "existed into it, creating the monthly partitions it needs. Months "
+        "partition_transactions detached are skipped. Safe to run more than once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of transactions copied per database transaction")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        # InheritanceQuerySet.iterator() takes no chunk_size; it streams
+        # with Django's default fetch size.
+        transactions = Transaction.objects.select_subclasses().order_by("created", "id")
+        for month in partitions.detached():
+            transactions = transactions.exclude(
+                created__gte=partitions.start_of(month),
+                created__lt=partitions.start_of(partitions.add_months(month, 1)),
+            )
+        transactions = transactions.iterator()
+        # the table may have been partitioned before the history was copied
+        months = set(partitions.existing()) if partitions.is_partitioned() else None
+        copied = 0
+        while True:
+            chunk = list(itertools.islice(transactions, chunk_size))
+            if not chunk:
+                break
+            existing = set(
+                TransactionEntry.objects.filter(id__in=[tnx.pk for tnx in chunk]).values_list("id", flat=True)
+            )
+            entries = [TransactionEntry.from_transaction(tnx) for tnx in chunk if tnx.pk not in existing]
+            if months is not None:
+                needed = {partitions.month_start(entry.created.astimezone(timezone.utc)) for entry in entries}
+                for month in sorted(needed - months):
+                    self.stdout.write("Created {}".format(partitions.create(month)))
+                    months.add(month)
+            with transaction.atomic():
+                TransactionEntry.objects.bulk_create(entries)
+            copied += len(entries)
+
+        self.stdout.write(self.style.SUCCESS("Copied {} transaction(s)".format(copied)))
@@ -0,0 +1,249 @@
+import collections
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from flite.core import metrics
+from flite.core.utils import latency_summary
+from flite.users import ledger
+from flite.users.models import User
+
+OPERATIONS = ("deposit", "withdrawal", "transfer")
+SCENARIOS = ("many-accounts", "hot-account", "mixed")
+# share of the operations of the mixed scenario that involve the hot account
+MIXED_HOT_SHARE = 0.2
+
+
+def parse_mix(value):
+    """Parses ``deposit:40,withdrawal:20,transfer:40`` into operation weights"""
+    try:
+        weights = {name: int(weight) for name, weight in (part.split(":") for part in value.split(","))}
+    except ValueError:
+        raise CommandError("--mix must look like deposit:40,withdrawal:20,transfer:40")
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise CommandError("Unknown operations in --mix: {}".format(", ".join(sorted(unknown))))
+    return weights
+
+
+class InProcessTransport(object):
+    """Sends requests through the Django test client, in this process"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def post(self, path, data, token):
+        if not hasattr(self.local, "client"):
+            self.local.client = Client()
+        response = self.local.client.post(path, data, HTTP_AUTHORIZATION="Token {}".format(token))
+        return response.status_code
+
+    def retries(self):
+        return metrics.sample("ledger_retries_total")
+
+
+class HTTPTransport(object):
+    """Sends requests to a running server"""
+
+    def __init__(self, base_url, metrics_token=None):
+        self.base_url = base_url.rstrip("/")
+        self.metrics_token = metrics_token
+
+    def post(self, path, data, token):
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(data).encode(),
+            headers={"Authorization": "Token {}".format(token), "Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as exc:
+            return exc.code
+
+    def retries(self):
+        request = urllib.request.Request(self.base_url + reverse("metrics"))
+        if self.metrics_token:
+            request.add_header("Authorization", "Bearer {}".format(self.metrics_token))
+        with urllib.request.urlopen(request) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith("ledger_retries_total "):
+                    return float(line.split()[1])
+        return 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the deposit, withdrawal and P2P transfer endpoints with "
+        "concurrent clients, then checks that every balance it touched "
+        "equals the sum of its transactions. Results are written as JSON "
+        "to benchmarks/results/ so runs can be compared."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenario", choices=SCENARIOS, default="many-accounts",
+                            help="many-accounts spreads load evenly, hot-account sends it all through one "
+                                 "account and mixed does both")
+        parser.add_argument("--accounts", type=int, default=100, help="Accounts to create for the run")
+        parser.add_argument("--threads", type=int, default=16, help="Concurrent clients")
+        parser.add_argument("--requests", type=int, default=100, help="Requests per client")
+        parser.add_argument("--mix", default="deposit:40,withdrawal:20,transfer:40",
+                            help="Relative weights of the operations")
+        parser.add_argument("--hot-slots", type=int, default=1,
+                            help="Credit slots for the hot account (see shard_balance)")
+        parser.add_argument("--seed-balance", type=int, default=10000,
+                            help="Opening balance of every account")
+        parser.add_argument("--base-url", help="Send requests to this running server instead of in-process")
+        parser.add_argument("--metrics-token", help="METRICS_TOKEN of the server at --base-url")
+        parser.add_argument("--output",
+                            help="File to write the results to. "
+                                 "Defaults to benchmarks/results/ledger-<scenario>-<time>.json")
+
+    def handle(self, *args, **options):
+        if options["accounts"] < 2:
+            raise CommandError("--accounts must be at least 2")
+        weights = parse_mix(options["mix"])
+        transport = (
+            HTTPTransport(options["base_url"], options["metrics_token"]) if options["base_url"]
+            else InProcessTransport()
+        )
+
+        run = uuid.uuid4().hex[:8]
+        accounts = self._create_accounts(run, options["accounts"], options["seed_balance"])
+        if options["hot_slots"] > 1:
+            accounts[0].balance.set_slot_count(options["hot_slots"])
+        plans = [
+            self._plan(accounts, options["scenario"], weights, options["requests"], random.Random(index))
+            for index in range(options["threads"])
+        ]
+
+        samples = collections.defaultdict(list)
+        statuses = collections.defaultdict(collections.Counter)
+        lock = threading.Lock()
+        barrier = threading.Barrier(options["threads"])
+
+        def client(plan):
+            barrier.wait()
+            for operation, path, data, token in plan:
+                began = time.monotonic()
+                try:
+                    code = transport.post(path, data, token)
+                except Exception as exc:
+                    code = type(exc).__name__
+                elapsed = time.monotonic() - began
+                with lock:
+                    samples[operation].append(elapsed)
+                    statuses[operation][str(code)] += 1
+            connection.close()
+
+        started_at = datetime.utcnow()
+        retries = transport.retries()
+        threads = [threading.Thread(target=client, args=(plan,)) for plan in plans]
+        began = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - began
+        retries = transport.retries() - retries
+
+        mismatches = ledger.reconcile(account.pk for account in accounts)
+        total = sum(len(values) for values in samples.values())
+        errors = sum(
+            count for counter in statuses.values() for code, count in counter.items()
+            if not code.startswith(("2", "4"))
+        )
+        results = {
+            "run": run,
+            "started_at": started_at.isoformat() + "Z",
+            "database": connection.vendor,
+            "transport": "http" if options["base_url"] else "in-process",
+            "scenario": options["scenario"],
+            "accounts": options["accounts"],
+            "hot_slots": options["hot_slots"],
+            "threads": options["threads"],
+            "mix": weights,
+            "requests": total,
+            "duration_seconds": round(elapsed, 3),
+            "requests_per_second": round(total / elapsed, 1) if elapsed else None,
+            "latency_ms": latency_summary([value for values in samples.values() for value in values]),
+            "operations": {
+                operation: {
+                    "requests": len(samples[operation]),
+                    "statuses": dict(statuses[operation]),
+                    "latency_ms": latency_summary(samples[operation]),
+                }
+                for operation in sorted(samples)
+            },
+            "errors": errors,
+            "ledger_retries": retries,
+            "reconciliation": {"accounts": len(accounts), "mismatches": mismatches},
+        }
+
+        output = options["output"] or os.path.join(
+            "benchmarks", "results", "ledger-{}-{}.json".format(
+                options["scenario"], started_at.strftime("%Y%m%dT%H%M%SZ")
+            )
+        )
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as result_file:
+            json.dump(results, result_file, indent=2)
+            result_file.write("\n")
+
+        summary = "{} requests in {:.1f}s ({} req/s), p99 {} ms, {} errors, {} retries. Results in {}".format(
+            total, elapsed, results["requests_per_second"], results["latency_ms"]["p99"],
+            errors, retries, output,
+        )
+        if mismatches:
+            raise CommandError(
+                "{}\n{} balance(s) do not match their transactions".format(summary, len(mismatches))
+            )
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def _create_accounts(self, run, count, seed_balance):
+        """Creates ``count`` users with an unusable password and a seeded balance"""
+        password = make_password(None)
+        accounts = []
+        for index in range(count):
+            user = User.objects.create(username="bench-{}-{}".format(run, index), password=password)
+            user.balance.make_deposit(seed_balance)
+            accounts.append(user)
+        return accounts
+
+    def _plan(self, accounts, scenario, weights, count, rng):
+        """Returns the requests one client sends, as (operation, path, data, token)"""
+        hot = accounts[0]
+        operations = rng.choices(list(weights), weights=list(weights.values()), k=count)
+        plan = []
+        for operation in operations:
+            use_hot = scenario == "hot-account" or (scenario == "mixed" and rng.random() < MIXED_HOT_SHARE)
+            account, other = rng.sample(accounts, 2)
+            amount = rng.randint(1, 20)
+            if operation == "transfer":
+                # the hot account receives: many senders contend on it
+                if use_hot:
+                    sender, recipient = account if account != hot else other, hot
+                else:
+                    sender, recipient = account, other
+                path = reverse("p2p-transfer-url", kwargs={
+                    "sender_account_id": sender.pk, "recipient_account_id": recipient.pk,
+                })
+                plan.append((operation, path, {"amount": amount}, sender.auth_token.key))
+                continue
+            owner = hot if use_hot else account
+            name = "deposit-url" if operation == "deposit" else "withdrawal-url"
+            path = reverse(name, kwargs={"user_id": owner.pk})
+            plan.append((operation, path, {"amount": amount}, owner.auth_token.key))
+        return plan
@@ -0,0 +1,69 @@
+import collections
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from flite.users.webhooks import Dispatcher, fan_out, requeue_stale
+
+# seconds between requeues of deliveries left behind by a dead dispatcher
+MAINTENANCE_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Turns outbox events into webhook deliveries and posts them in batches "
+        "until stopped with SIGINT or SIGTERM. Several can run side by side; "
+        "they claim work one at a time, so each account's events stay in order, "
+        "and post their batches concurrently."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int,
+                            help="Batches posted at once. Defaults to WEBHOOK_CONCURRENCY")
+        parser.add_argument("--batch-size", type=int,
+                            help="Most events posted in one request. Defaults to WEBHOOK_BATCH_SIZE")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to wait before looking again when nothing is due")
+        parser.add_argument("--once", action="store_true", help="Exit once nothing is due instead of waiting")
+
+    def handle(self, *args, **options):
+        for option in ("concurrency", "batch_size"):
+            if options[option] is not None and options[option] < 1:
+                raise CommandError("--{} must be at least 1".format(option.replace("_", "-")))
+        dispatcher = Dispatcher(concurrency=options["concurrency"], batch_size=options["batch_size"])
+        self.stopping = False
+        if not options["once"]:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        events = 0
+        counts = collections.Counter()
+        began = time.monotonic()
+        last_maintenance = None
+        try:
+            while not self.stopping:
+                if last_maintenance is None or time.monotonic() - last_maintenance >= MAINTENANCE_INTERVAL:
+                    requeue_stale()
+                    last_maintenance = time.monotonic()
+                fanned_out = fan_out()
+                events += fanned_out
+                round_counts = dispatcher.deliver()
+                counts.update(round_counts)
+                if not fanned_out and not round_counts:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+        finally:
+            dispatcher.close()
+        elapsed = time.monotonic() - began
+
+        self.stdout.write(self.style.SUCCESS(
+            "{} event(s) and {} delivery attempt(s) in {:.1f}s: "
+            "{} delivered, {} to be retried, {} dead".format(
+                events, sum(counts.values()), elapsed, counts["delivered"], counts["retried"], counts["dead"],
+            )
+        ))
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+from flite.users.filters import TransactionEntryFilter
+from flite.users.models import TransactionEntry
+
+
+def filter_cases(reference):
+    """The filter combinations clients use, as query parameters"""
+    now = timezone.now()
+    last_month = {
+        "created_after": (now - timedelta(days=30)).isoformat(),
+        "created_before": now.isoformat(),
+    }
+    return (
+        ("unfiltered", {}),
+        ("date range", last_month),
+        ("type", {"type": ["deposit"]}),
+        ("type and date range", dict(last_month, type=["withdrawal"])),
+        ("status", {"status": "failed"}),
+        ("status and date range", dict(last_month, status="failed")),
+        ("amount range", {"min_amount": "100", "max_amount": "500"}),
+        ("amount range and date range", dict(last_month, min_amount="100", max_amount="500")),
+        ("reference", {"reference": reference}),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints the query plan of the transaction list for every supported "
+        "filter combination. Run it against a Postgres database with "
+        "production-like data and check the output into benchmarks/."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account",
+                            help="User id to plan for. Defaults to the account with most entries")
+        parser.add_argument("--analyze", action="store_true", help="Run the queries (EXPLAIN ANALYZE)")
+        parser.add_argument("--output", help="File to write the plans to. Defaults to stdout")
+
+    def handle(self, *args, **options):
+        account = options["account"] or self._busiest_account()
+        entries = TransactionEntry.objects.filter(owner_id=account)
+        reference = entries.values_list("reference", flat=True).first() or ""
+        explain_options = {"analyze": True, "buffers": True} if options["analyze"] else {}
+        if explain_options and connection.vendor != "postgresql":
+            raise CommandError("--analyze is only supported on Postgres")
+
+        sections = ["# Transaction list query plans ({}, account {})".format(connection.vendor, account)]
+        for name, params in filter_cases(reference):
+            filterset = TransactionEntryFilter(params, queryset=entries)
+            if not filterset.is_valid():
+                raise CommandError("Invalid filter {}: {}".format(name, filterset.errors))
+            queryset = filterset.qs.order_by("-created", "-id")[:settings.REST_FRAMEWORK["PAGE_SIZE"]]
+            sections.append("## {}\n{}\n\n{}".format(name, params, queryset.explain(**explain_options)))
+        report = "\n\n".join(sections) + "\n"
+
+        if options["output"]:
+            with open(options["output"], "w") as out:
+                out.write(report)
+        else:
+            self.stdout.write(report, ending="")
+
+    def _busiest_account(self):
+        busiest = (
+            TransactionEntry.objects.values("owner_id").annotate(entries=Count("id"))
+            .order_by("-entries").first()
+        )
+        if busiest is None:
+            raise CommandError("There are no transactions to plan for")
+        return busiest["owner_id"]
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from flite.users import exports
+
+
+class Command(BaseCommand):
+    help = "Streams the transactions of every account, or of one, as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", dest="file_format", choices=sorted(exports.CONTENT_TYPES),
+                            default="csv")
+        parser.add_argument("--account", help="Only export the transactions of this user id")
+        parser.add_argument("--output", help="File to write to. Defaults to stdout")
+
+    def handle(self, *args, **options):
+        filters = {"owner_id": options["account"]} if options["account"] else {}
+        chunks = exports.stream(exports.export_queryset(**filters), options["file_format"])
+
+        if not options["output"]:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+        with open(options["output"], "w", newline="") as out:
+            for chunk in chunks:
+                out.write(chunk)
@@ -0,0 +1,137 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from flite.users import signup
+from flite.users.models import User
+
+FORMATS = ("csv", "ndjson")
+FIELDS = ("username", "password", "email", "first_name", "last_name")
+
+
+def read_rows(stream, fmt):
+    """Yields (line number, row) for every user in ``stream``"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            raise CommandError("line {}: {}".format(line_num, exc))
+        if not isinstance(row, dict):
+            raise CommandError("line {}: expected a JSON object".format(line_num))
+        yield line_num, row
+
+
+def build_user(line_num, row):
+    """Returns an unsaved User for ``row`` and its raw password, None for no password"""
+    username = (row.get("username") or "").strip()
+    if not username:
+        raise CommandError("line {}: username is required".format(line_num))
+    return User(
+        username=User.normalize_username(username),
+        email=User.objects.normalize_email(row.get("email") or ""),
+        first_name=row.get("first_name") or "",
+        last_name=row.get("last_name") or "",
+    ), row.get("password") or None
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates users, with their tokens, profiles and balances, from a CSV "
+        "file with a header row or an NDJSON file with one object per line. "
+        "The fields are {}; only username is required and users without a "
+        "password get an unusable one. Users whose username exists already "
+        "are skipped, so a file can be imported again after a failure."
+    ).format(", ".join(FIELDS))
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, - for standard input")
+        parser.add_argument("--format", choices=FORMATS,
+                            help="Defaults to the file extension, csv for standard input")
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of users created per database transaction")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="Processes hashing passwords. Defaults to one per CPU")
+
+    def handle(self, *args, **options):
+        fmt = options["format"] or self._format_of(options["path"])
+        if options["path"] == "-":
+            self._import(sys.stdin, fmt, options)
+        else:
+            with open(options["path"], newline="") as stream:
+                self._import(stream, fmt, options)
+
+    def _format_of(self, path):
+        if path == "-":
+            return "csv"
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        if extension == "jsonl":
+            return "ndjson"
+        if extension not in FORMATS:
+            raise CommandError("Cannot tell the format of {}, pass --format".format(path))
+        return extension
+
+    def _import(self, stream, fmt, options):
+        rows = read_rows(stream, fmt)
+        executor = ProcessPoolExecutor(options["workers"]) if options["workers"] > 1 else None
+        created = skipped = 0
+        began = time.monotonic()
+        try:
+            while True:
+                chunk = [build_user(*row) for row in itertools.islice(rows, options["chunk_size"])]
+                if not chunk:
+                    break
+                new = self._new_users(chunk)
+                skipped += len(chunk) - len(new)
+                self._create(new, executor, options["workers"])
+                created += len(new)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        elapsed = time.monotonic() - began
+
+        self.stdout.write(self.style.SUCCESS(
+            "Created {} user(s), skipped {} existing in {:.1f}s ({} rows/s)".format(
+                created, skipped, elapsed,
+                round((created + skipped) / elapsed, 1) if elapsed else created + skipped,
+            )
+        ))
+
+    def _new_users(self, chunk):
+        """Drops the users that exist already or appeared earlier in the chunk"""
+        usernames = [user.username for user, _ in chunk]
+        existing = set(User.objects.filter(username__in=usernames).values_list("username", flat=True))
+        new = []
+        for user, password in chunk:
+            if user.username not in existing:
+                existing.add(user.username)
+                new.append((user, password))
+        return new
+
+    def _create(self, new, executor, workers):
+        passwords = [password for _, password in new]
+        if executor is None:
+            hashes = map(make_password, passwords)
+        else:
+            # a few tasks per worker keeps them busy without a round trip per password
+            hashes = executor.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+        users = []
+        for (user, _), hashed in zip(new, hashes):
+            user.password = hashed
+            users.append(user)
+        with transaction.atomic():
+            signup.provision_many(users)
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+from django.utils import timezone
+
+from flite.users import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the monthly partitions of the transaction entries table "
+        "ahead of time and, with a retention period, detaches the ones that "
+        "fall out of it. Detaches that were interrupted are finished whatever "
+        "the retention period. Run it daily; it does nothing unless the table "
+        "is partitioned (Postgres 11 and later)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int,
+                            help="Months of partitions to keep ready. "
+                                 "Defaults to TRANSACTION_PARTITION_MONTHS_AHEAD")
+        parser.add_argument("--retain-months", type=int,
+                            help="Months of entries to keep attached, this one included, 0 to keep all. "
+                                 "Defaults to TRANSACTION_PARTITION_RETENTION_MONTHS")
+        parser.add_argument("--drop", action="store_true",
+                            help="Drop detached partitions instead of moving them to the archive schema")
+        parser.add_argument("--dry-run", action="store_true", help="Print what would be done and do nothing")
+
+    def handle(self, *args, **options):
+        months_ahead = options["months_ahead"]
+        if months_ahead is None:
+            months_ahead = settings.TRANSACTION_PARTITION_MONTHS_AHEAD
+        retain_months = options["retain_months"]
+        if retain_months is None:
+            retain_months = settings.TRANSACTION_PARTITION_RETENTION_MONTHS
+        if months_ahead < 0 or retain_months < 0:
+            raise CommandError("--months-ahead and --retain-months cannot be negative")
+        if not partitions.is_partitioned():
+            self.stdout.write("{} is not partitioned, nothing to do".format(partitions.TABLE))
+            return
+
+        today = timezone.now().date()
+        months = partitions.existing()
+        to_create = partitions.missing(months, months_ahead, today)
+        to_detach = partitions.expired(months, retain_months, today) if retain_months else []
+        # left pending by an interrupted DETACH ... CONCURRENTLY, and still attached until finalized
+        detaching = partitions.detaching()
+        to_detach = sorted(set(to_detach) | {month for month, name in months.items() if name in detaching})
+        failed = False
+        dry_run = options["dry_run"]
+        for month in to_create:
+            name = partitions.partition_name(month)
+            failed |= not self.run(("create", "Created"), name, dry_run, partitions.create, month)
+        for month in to_detach:
+            name = months[month]
+            pending = name in detaching
+            if not self.run(("detach", "Detached"), name, dry_run, partitions.detach, name, pending):
+                failed = True
+            elif options["drop"]:
+                failed |= not self.run(("drop", "Dropped"), name, dry_run, partitions.drop, name)
+            else:
+                failed |= not self.run(("archive", "Archived"), name, dry_run, partitions.archive, name)
+        if not to_create and not to_detach:
+            self.stdout.write("Partitions are up to date")
+        if failed:
+            raise CommandError("Some partitions could not be changed, see above; run the command again")
+
+    def run(self, verbs, name, dry_run, func, *args):
+        verb, action = verbs
+        if dry_run:
+            self.stdout.write("Would {} {}".format(verb, name))
+            return True
+        try:
+            func(*args)
+        except OperationalError as exc:
+            # most likely lock_timeout; the next run tries again
+            self.stderr.write("{} {} failed: {}".format(action, name, exc))
+            return False
+        self.stdout.write(self.style.SUCCESS("{} {}".format(action, name)))
+        return True
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from flite.users.models import Balance
+
+
+class Command(BaseCommand):
+    help = (
+        "Splits a user's balance into credit slots so concurrent credits to a "
+        "busy account do not queue on one row. Use 1 slot to merge it back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("account_id", help="The id of the user owning the balance")
+        parser.add_argument("slots", type=int, help="Number of credit slots")
+
+    def handle(self, *args, **options):
+        if options["slots"] < 1:
+            raise CommandError("slots must be at least 1")
+        try:
+            balance = Balance.objects.get(owner_id=options["account_id"])
+        except Balance.DoesNotExist:
+            raise CommandError("No balance for account {}".format(options["account_id"]))
+
+        balance.set_slot_count(options["slots"])
+        self.stdout.write(self.style.SUCCESS(
+            "Balance of {} now has {} slot(s)".format(options["account_id"], balance.slot_count)
+        ))
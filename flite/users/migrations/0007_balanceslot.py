@@ -0,0 +1,36 @@
+# Generated by Django 2.1.9 on 2026-10-18 15:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_auto_20210609_1117'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSlot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('available_balance', models.DecimalField(decimal_places=2, default=0.0, max_digits=9)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='balance',
+            name='slot_count',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='balanceslot',
+            name='balance',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots', to='users.Balance'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='balanceslot',
+            unique_together={('balance', 'index')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.9 on 2026-10-18 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_balanceslot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['owner', 'created', 'id'], name='users_tnx_owner_created_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.1.9 on 2026-10-18 15:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_transaction_owner_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionEntry',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('banktransfer', 'Bank transfer'), ('p2ptransfer', 'P2P transfer')], max_length=20)),
+                ('created', models.DateTimeField(editable=False)),
+                ('modified', models.DateTimeField(blank=True, null=True)),
+                ('reference', models.CharField(max_length=200)),
+                ('status', models.CharField(max_length=200)),
+                ('amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=9)),
+                ('new_balance', models.DecimalField(decimal_places=2, default=0.0, max_digits=9)),
+                ('bank', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='users.Bank')),
+                ('owner', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transaction_entries', to=settings.AUTH_USER_MODEL)),
+                ('receipient', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Transaction entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='transactionentry',
+            index=models.Index(fields=['owner', 'created', 'id'], name='users_entry_owner_created_idx'),
+        ),
+    ]
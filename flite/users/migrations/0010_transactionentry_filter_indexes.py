@@ -0,0 +1,32 @@
+# Generated by Django 2.1.9 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_transactionentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transactionentry',
+            index=models.Index(fields=['owner', 'type', 'created', 'id'], name='users_entry_owner_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionentry',
+            index=models.Index(fields=['owner', 'amount'], name='users_entry_owner_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionentry',
+            index=models.Index(fields=['reference'], name='users_entry_reference_idx'),
+        ),
+        # Django 2.1 indexes cannot have a condition. Almost every entry is
+        # complete, so status filters look for the few that are not.
+        migrations.RunSQL(
+            ['CREATE INDEX users_entry_owner_status_idx ON users_transactionentry '
+             '(owner_id, status, created, id) WHERE status <> \'complete\''],
+            ['DROP INDEX users_entry_owner_status_idx'],
+        ),
+    ]
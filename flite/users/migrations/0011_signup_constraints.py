@@ -0,0 +1,25 @@
+# Generated by Django 2.1.9 on 2026-10-18 15:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_transactionentry_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='referral',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='referrals', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='referral_code',
+            field=models.CharField(max_length=120, unique=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+SEQUENCE = 'users_referral_code_seq'
+# referral_codes.BLOCK_SIZE
+BLOCK_SIZE = 100
+
+
+def create_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE SEQUENCE {} INCREMENT BY {} MINVALUE {} START WITH {}'.format(
+                SEQUENCE, BLOCK_SIZE, BLOCK_SIZE, BLOCK_SIZE
+            )
+        )
+    else:
+        # a one-row counter holding the start of the next block
+        schema_editor.execute('CREATE TABLE {} (value bigint NOT NULL)'.format(SEQUENCE))
+        schema_editor.execute('INSERT INTO {} (value) VALUES ({})'.format(SEQUENCE, BLOCK_SIZE))
+
+
+def drop_sequence(apps, schema_editor):
+    kind = 'SEQUENCE' if schema_editor.connection.vendor == 'postgresql' else 'TABLE'
+    schema_editor.execute('DROP {} {}'.format(kind, SEQUENCE))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_signup_constraints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='userprofile',
+            name='referral_code',
+            field=models.CharField(max_length=120),
+        ),
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX users_userprofile_referral_code_upper ON users_userprofile (UPPER(referral_code))'],
+            ['DROP INDEX users_userprofile_referral_code_upper'],
+        ),
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.9 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_outbox_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboxevent',
+            index=models.Index(fields=['account', 'id'], name='users_outbox_account_idx'),
+        ),
+    ]
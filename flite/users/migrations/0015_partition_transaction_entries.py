@@ -0,0 +1,108 @@
+"""
+Range partitions users_transactionentry by created month on Postgres 11
+and later, with partitions from the oldest transaction's month to
+MONTHS_AHEAD months from now. The oldest is looked up in
+users_transaction too, since its history may not be copied into the
+entries yet. The entries are copied into the new table
+inside this migration's transaction, so on a large table run it while
+postings can wait. Other databases, and older Postgres, keep the table
+as it is.
+"""
+from django.db import migrations
+from django.utils import timezone
+
+TABLE = 'users_transactionentry'
+# partitions.MIN_SERVER_VERSION
+MIN_SERVER_VERSION = 110000
+MONTHS_AHEAD = 3
+
+INDEXES = (
+    ('users_entry_owner_created_idx', '(owner_id, created, id)'),
+    ('users_entry_owner_type_idx', '(owner_id, type, created, id)'),
+    ('users_entry_owner_amount_idx', '(owner_id, amount)'),
+    ('users_entry_reference_idx', '(reference)'),
+    ('users_entry_owner_status_idx', '(owner_id, status, created, id) WHERE status <> \'complete\''),
+)
+FOREIGN_KEYS = (
+    ('owner_id', 'users_user'),
+    ('sender_id', 'users_user'),
+    ('receipient_id', 'users_user'),
+    ('bank_id', 'users_bank'),
+)
+
+
+def _applies(schema_editor):
+    connection = schema_editor.connection
+    return connection.vendor == 'postgresql' and connection.pg_version >= MIN_SERVER_VERSION
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+
+def _swap(schema_editor, create_sql, after_create=()):
+    """Copies the entries into a new table made by ``create_sql`` and puts it in the old one's place"""
+    execute = schema_editor.execute
+    execute(create_sql.format(table=TABLE + '_new'))
+    for sql in after_create:
+        execute(sql)
+    execute('INSERT INTO {0}_new SELECT * FROM {0}'.format(TABLE))
+    execute('DROP TABLE {}'.format(TABLE))
+    execute('ALTER TABLE {0}_new RENAME TO {0}'.format(TABLE))
+    execute('ALTER INDEX {0}_new_pkey RENAME TO {0}_pkey'.format(TABLE))
+    for name, columns in INDEXES:
+        execute('CREATE INDEX {} ON {} {}'.format(name, TABLE, columns))
+    for column, referenced in FOREIGN_KEYS:
+        execute(
+            'ALTER TABLE {0} ADD CONSTRAINT {0}_{1}_fk FOREIGN KEY ({1}) REFERENCES {2} (id) '
+            'DEFERRABLE INITIALLY DEFERRED'.format(TABLE, column, referenced)
+        )
+
+
+def partition(apps, schema_editor):
+    if not _applies(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        # LEAST ignores NULLs, so either table may be empty
+        cursor.execute(
+            'SELECT LEAST((SELECT MIN(created) FROM users_transaction), '
+            '(SELECT MIN(created) FROM {}))'.format(TABLE)
+        )
+        oldest = cursor.fetchone()[0]
+    now = timezone.now()
+    month = (oldest or now).date().replace(day=1)
+    last = _add_months(now.date().replace(day=1), MONTHS_AHEAD)
+    partitions = []
+    while month <= last:
+        partitions.append(
+            "CREATE TABLE {0}_p{1:%Y_%m} PARTITION OF {0}_new "
+            "FOR VALUES FROM ('{1} 00:00:00+00') TO ('{2} 00:00:00+00')".format(
+                TABLE, month, _add_months(month, 1)
+            )
+        )
+        month = _add_months(month, 1)
+    # the partition key has to be part of the primary key
+    _swap(
+        schema_editor,
+        'CREATE TABLE {table} (LIKE ' + TABLE + ' INCLUDING DEFAULTS, PRIMARY KEY (id, created)) '
+        'PARTITION BY RANGE (created)',
+        partitions,
+    )
+
+
+def unpartition(apps, schema_editor):
+    if not _applies(schema_editor):
+        return
+    _swap(schema_editor, 'CREATE TABLE {table} (LIKE ' + TABLE + ' INCLUDING DEFAULTS, PRIMARY KEY (id))')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0014_outbox_account_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.9 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0015_partition_transaction_entries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newuserphoneverification',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='newuserphoneverification',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.9 on 2026-10-18 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0016_phone_verification_attempts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='type',
+            field=models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('banktransfer', 'Bank transfer'), ('p2ptransfer', 'P2P transfer'), ('p2preceived', 'P2P transfer received')], max_length=20),
+        ),
+    ]
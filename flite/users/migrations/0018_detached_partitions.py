@@ -0,0 +1,23 @@
+# Generated by Django 2.1.9 on 2026-10-18 16:51
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0017_outbox_received_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetachedPartition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('name', models.CharField(max_length=63)),
+                ('detached_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.9 on 2026-10-18 16:57
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0018_detached_partitions'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='newuserphoneverification',
+            name='attempts',
+        ),
+        migrations.RemoveField(
+            model_name='newuserphoneverification',
+            name='expires_at',
+        ),
+    ]
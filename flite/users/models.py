@@ -1,21 +1,20 @@
-import decimal
 import uuid
 import secrets
 
-from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import DEFAULT_DB_ALIAS, models
 from django.conf import settings
 from django.dispatch import receiver
 from django.contrib.auth.models import AbstractUser
 from django.utils.encoding import python_2_unicode_compatible
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_migrate, post_save
 from rest_framework.authtoken.models import Token
+from flite.core import authentication
 from flite.core.models import BaseModel
 from phonenumber_field.modelfields import PhoneNumberField
 from django.utils import timezone
 from model_utils.managers import InheritanceManager
 
-from flite.core.utils import FAILURE_MSGS
+from . import ledger, partitions, referral_codes, signup
 
 
 @python_2_unicode_compatible
@@ -29,9 +28,29 @@ class User(AbstractUser):
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
-        Token.objects.create(user=instance)
-        UserProfile.objects.create(user=instance)
-        Balance.objects.create(owner=instance)
+        signup.provision(instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_tokens(sender, instance=None, created=False, **kwargs):
+    # cached lookups hold a copy of the user, so any change (deactivation
+    # in particular) must evict them; User.objects.update() sends no
+    # post_save and has to call authentication.invalidate_user itself
+    if not created:
+        authentication.invalidate_user(instance)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance=None, **kwargs):
+    authentication.invalidate(instance.key)
+
+
+@receiver(post_migrate)
+def create_transaction_partitions(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    # so a database is never left without this month's partition, even
+    # before partition_transactions first runs
+    if sender.name == "flite.users" and using == DEFAULT_DB_ALIAS:
+        partitions.ensure()
 
 
 class Phonenumber(BaseModel):
@@ -45,6 +64,8 @@ class Phonenumber(BaseModel):
 
 
 class UserProfile(BaseModel):
+    # unique regardless of case, through the functional index added in
+    # migration 0012
     referral_code = models.CharField(max_length=120)
     user = models.OneToOneField('users.User',on_delete=models.CASCADE)
 
@@ -54,17 +75,10 @@ class UserProfile(BaseModel):
             self.referral_code = self.generate_new_referal_code()
         return super(UserProfile, self).save(*args, **kwargs)
 
-
-    def generate_new_referal_code(self):
-        """
-        Returns a unique passcode
-        """
-        def _passcode():
-            return str(uuid.uuid4().hex)[0:8]
-        passcode = _passcode()
-        while UserProfile.objects.filter(referral_code=passcode).exists():
-            passcode = _passcode()
-        return passcode
+    @staticmethod
+    def generate_new_referal_code():
+        """Returns a referral code no other profile has, see referral_codes"""
+        return referral_codes.allocate()
 
 
 
@@ -83,7 +97,7 @@ class NewUserPhoneVerification(BaseModel):
 
 
 class Referral(BaseModel):
-    owner = models.OneToOneField('users.User',on_delete=models.CASCADE,related_name="owner")
+    owner = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name="referrals")
     referred = models.OneToOneField('users.User',on_delete=models.CASCADE, related_name="referred")
 
     class Meta:
@@ -96,75 +110,47 @@ class Balance(BaseModel):
     book_balance = models.DecimalField(default=0.0, decimal_places=2, max_digits=9)
     available_balance = models.DecimalField(default=0.0, decimal_places=2, max_digits=9)
     active = models.BooleanField(default=True)
+    # Credits to a balance with more than one slot land in a random
+    # BalanceSlot instead of this row, so they never wait on its lock.
+    slot_count = models.PositiveSmallIntegerField(default=1)
 
     class Meta:
         verbose_name = "Balance"
         verbose_name_plural = "Balances"
 
+    @property
+    def is_sharded(self):
+        return self.slot_count > 1
+
+    def get_available_balance(self):
+        """The available balance including credits still held in slots"""
+        return ledger.current_balance(self)
+
+    def set_slot_count(self, count):
+        ledger.reshard(self, count)
+
     def make_deposit(self, amount):
-        self.available_balance += decimal.Decimal(amount)
-        self.book_balance = self.available_balance
-        self.save()
-        self._make_transaction(
-            amount, Deposit, status="complete", new_balance=self.available_balance
-        )
+        return ledger.credit(self, amount, Deposit)
 
     def make_withdrawal(self, amount):
-        self._can_debit_or_error(amount)
-        self.available_balance -= decimal.Decimal(amount)
-        self.book_balance = self.available_balance
-        self.save()
-        self._make_transaction(
-            amount, Withdrawal, status="complete", new_balance=self.available_balance
-        )
+        return ledger.debit(self, amount, Withdrawal)
 
-    def _make_transaction(self, amount, klass, **kwargs):
-        """
-        Creates a transaction with information of
-        passed as attributes passed
-
-        Args:
-            amount(number): The transaction amount
-            klass(class): A model class
-            kwargs(dict): Keyword arguments
-        """
-        tnx = klass(
-            owner=self.owner,
-            amount=amount,
-            reference=make_refernce(klass.__name__.capitalize()),
-            **kwargs
+    def make_p2p_transfer(self, amount, target):
+        return ledger.transfer(
+            self, target, amount, P2PTransfer, sender_id=self.owner_id, receipient_id=target.owner_id
         )
-        tnx.save()
 
-    def _can_debit_or_error(self, amount):
-        if self.available_balance < amount:
-            raise ValidationError(FAILURE_MSGS["insufficient_funds"])
+    def make_bulk_p2p_transfer(self, payouts):
+        return ledger.bulk_transfer(self, payouts, P2PTransfer)
 
-    def make_p2p_transfer(self, amount, target):
-        self._can_debit_or_error(amount)
-        with transaction.atomic():
-            # lock for update
-            self.get_lock()
-            target.get_lock()
-
-            self.available_balance -= amount
-            target.available_balance += amount
-            self.book_balance -= amount
-            target.book_balance += amount
-            self.save()
-            target.save()
-
-            self._make_transaction(
-                amount,
-                P2PTransfer,
-                sender=self.owner,
-                receipient=target.owner,
-                status="complete",
-                new_balance=self.available_balance,
-            )
-
-    def get_lock(self):
-        Balance.objects.select_for_update().get(id=self.id)
+
+class BalanceSlot(models.Model):
+    balance = models.ForeignKey(Balance, on_delete=models.CASCADE, related_name="slots")
+    index = models.PositiveSmallIntegerField()
+    available_balance = models.DecimalField(default=0.0, decimal_places=2, max_digits=9)
+
+    class Meta:
+        unique_together = ("balance", "index")
 
 
 def make_refernce(pre, length=11):
@@ -202,6 +188,12 @@ class Transaction(BaseModel):
 
     objects = InheritanceManager()
 
+    class Meta:
+        indexes = [
+            # serves the keyset-paginated transaction history
+            models.Index(fields=["owner", "created", "id"], name="users_tnx_owner_created_idx"),
+        ]
+
 
 class Deposit(Transaction):
     pass
@@ -225,6 +217,164 @@ class P2PTransfer(Transaction):
         verbose_name_plural = "P2P Transfers"
 
 
+class TransactionEntry(models.Model):
+    """
+    Append-only, single-table copy of every transaction.
+
+    Entries are written in the same database transaction as the posting
+    and carry the transaction type as a column, so transaction history
+    is read with one index scan instead of joining every subclass table.
+    """
+    DEPOSIT = "deposit"
+    WITHDRAWAL = "withdrawal"
+    BANK_TRANSFER = "banktransfer"
+    P2P_TRANSFER = "p2ptransfer"
+    TYPES = (
+        (DEPOSIT, "Deposit"),
+        (WITHDRAWAL, "Withdrawal"),
+        (BANK_TRANSFER, "Bank transfer"),
+        (P2P_TRANSFER, "P2P transfer"),
+    )
+
+    # the id of the Transaction this entry was copied from
+    id = models.UUIDField(primary_key=True, editable=False)
+    type = models.CharField(max_length=20, choices=TYPES)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="transaction_entries",
+                              db_index=False)
+    created = models.DateTimeField(editable=False)
+    modified = models.DateTimeField(blank=True, null=True)
+    reference = models.CharField(max_length=200)
+    status = models.CharField(max_length=200)
+    amount = models.DecimalField(default=0.0, decimal_places=2, max_digits=9)
+    new_balance = models.DecimalField(default=0.0, decimal_places=2, max_digits=9)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+", null=True, blank=True,
+                               db_index=False)
+    receipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+", null=True, blank=True,
+                                   db_index=False)
+    bank = models.ForeignKey(Bank, on_delete=models.CASCADE, related_name="+", null=True, blank=True,
+                             db_index=False)
+
+    class Meta:
+        verbose_name_plural = "Transaction entries"
+        # Each index leads with the owner and, where the filter allows it,
+        # ends with (created, id) so the keyset ordering needs no sort. A
+        # partial index on unsettled statuses is created in migration 0010.
+        indexes = [
+            models.Index(fields=["owner", "created", "id"], name="users_entry_owner_created_idx"),
+            models.Index(fields=["owner", "type", "created", "id"], name="users_entry_owner_type_idx"),
+            models.Index(fields=["owner", "amount"], name="users_entry_owner_amount_idx"),
+            models.Index(fields=["reference"], name="users_entry_reference_idx"),
+        ]
+
+    @classmethod
+    def from_transaction(cls, tnx):
+        """Builds the entry for a saved Transaction subclass instance"""
+        return cls(
+            id=tnx.pk,
+            type=tnx.__class__.__name__.lower(),
+            owner_id=tnx.owner_id,
+            created=tnx.created,
+            modified=tnx.modified,
+            reference=tnx.reference,
+            status=tnx.status,
+            amount=tnx.amount,
+            new_balance=tnx.new_balance,
+            sender_id=getattr(tnx, "sender_id", None),
+            receipient_id=getattr(tnx, "receipient_id", None),
+            bank_id=getattr(tnx, "bank_id", None),
+        )
+
+
+class DetachedPartition(models.Model):
+    """
+    A month of transaction entries that partition_transactions detached
+    on purpose, which backfill_transaction_entries leaves alone, see
+    partitions
+    """
+    month = models.DateField(unique=True)
+    name = models.CharField(max_length=63)
+    detached_at = models.DateTimeField(default=timezone.now)
+
+
+class OutboxEvent(models.Model):
+    """
+    A ledger event for downstream systems, written in the same database
+    transaction as the posting it describes, see outbox
+    """
+    # the recipient's side of a P2P transfer
+    P2P_RECEIVED = "p2preceived"
+    TYPES = TransactionEntry.TYPES + ((P2P_RECEIVED, "P2P transfer received"),)
+
+    # increasing ids give every account's events their order
+    id = models.BigAutoField(primary_key=True)
+    account = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+", db_index=False)
+    type = models.CharField(max_length=20, choices=TYPES)
+    transaction_id = models.UUIDField()
+    # the transaction as the transaction list API shows it, JSON encoded
+    payload = models.TextField()
+    created = models.DateTimeField(default=timezone.now)
+    # set once the event's webhook deliveries are created
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["dispatched_at", "id"], name="users_outbox_dispatch_idx"),
+            # an account's events after the last one its stream sent
+            models.Index(fields=["account", "id"], name="users_outbox_account_idx"),
+        ]
+
+
+class WebhookEndpoint(BaseModel):
+    """A URL that ledger events are posted to"""
+    url = models.URLField(max_length=500)
+    # signs each request body, see webhooks.signature
+    secret = models.CharField(max_length=100, default=secrets.token_hex)
+    # comma separated event types, all when blank
+    event_types = models.CharField(max_length=200, blank=True)
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.url
+
+    def wants(self, event_type):
+        return not self.event_types or event_type in [kind.strip() for kind in self.event_types.split(",")]
+
+
+class WebhookDelivery(BaseModel):
+    """The delivery of one OutboxEvent to one WebhookEndpoint"""
+    PENDING = "pending"
+    SENDING = "sending"
+    DELIVERED = "delivered"
+    # given up on after WEBHOOK_MAX_ATTEMPTS
+    DEAD = "dead"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (DELIVERED, "Delivered"),
+        (DEAD, "Dead"),
+    )
+
+    endpoint = models.ForeignKey(WebhookEndpoint, on_delete=models.CASCADE, related_name="deliveries")
+    event = models.ForeignKey(OutboxEvent, on_delete=models.CASCADE, related_name="deliveries")
+    # copied from the event so the per-account ordering check needs no join
+    account_id = models.UUIDField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    delivered_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = "Webhook deliveries"
+        unique_together = ("endpoint", "event")
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="users_delivery_claim_idx"),
+            # orders the queue of deliveries of each endpoint and account
+            models.Index(fields=["endpoint", "account_id", "event"], name="users_delivery_order_idx"),
+        ]
+
+
 class Card(models.Model):
 
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
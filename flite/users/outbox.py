@@ -0,0 +1,58 @@
+"""
+Transactional outbox of ledger events.
+
+``record`` writes an OutboxEvent for every transaction the ledger
+inserts, in the posting's own database transaction, so an event exists
+if and only if its posting committed. A P2P transfer also gets a
+``p2preceived`` event for its recipient, without the sender's balance. The ``dispatch_webhooks`` command
+(see webhooks) turns them into deliveries to the registered
+WebhookEndpoints, and the accounts' transaction streams are woken (see
+streams) once the posting commits.
+"""
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import streams
+
+
+def record(entries):
+    """
+    Inserts the OutboxEvents of the TransactionEntries in ``entries`` with
+    one INSERT and notifies their accounts' streams
+    """
+    from .models import OutboxEvent, TransactionEntry
+    from .serializers import ListTransactionsSerializer
+
+    events = []
+    for entry in entries:
+        data = ListTransactionsSerializer(entry).data
+        events.append(_event(entry, entry.owner_id, entry.type, data))
+        if entry.type == TransactionEntry.P2P_TRANSFER and entry.receipient_id is not None:
+            received = dict(data, new_balance=None)
+            events.append(_event(entry, entry.receipient_id, OutboxEvent.P2P_RECEIVED, received))
+    OutboxEvent.objects.bulk_create(events)
+    streams.notify({str(event.account_id) for event in events})
+
+
+def _event(entry, account_id, type, data):
+    from .models import OutboxEvent
+
+    return OutboxEvent(
+        account_id=account_id,
+        type=type,
+        transaction_id=entry.pk,
+        payload=json.dumps(data, cls=JSONEncoder),
+        created=entry.created,
+    )
+
+
+def as_message(event):
+    """The representation of ``event`` posted to webhooks"""
+    return {
+        "id": event.pk,
+        "type": event.type,
+        "account": str(event.account_id),
+        "created": event.created.isoformat(),
+        "data": json.loads(event.payload),
+    }
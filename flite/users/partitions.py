@@ -0,0 +1,232 @@
+"""
+Monthly partitions of the transaction entries table.
+
+On Postgres 11 and later, migration 0015 range partitions
+users_transactionentry on ``created``, one partition a month named
+users_transactionentry_pYYYY_MM. Queries that bound ``created``, as the
+keyset pagination and the date filters do, only read the partitions in
+range. ``partition_transactions`` keeps TRANSACTION_PARTITION_MONTHS_AHEAD
+months of empty partitions ready ahead of today, and so does every
+``migrate``. A posting whose month has no partition all the same, say
+because the command stopped running, creates it and is retried, see
+ledger.retrying. With a retention period the command also detaches the
+partitions that fall out of it and archives or drops them. Detached
+months are recorded as DetachedPartition rows, so that
+backfill_transaction_entries does not copy them back.
+
+Every DDL statement runs with TRANSACTION_PARTITION_LOCK_TIMEOUT. A
+statement that cannot take its lock in time gives up instead of
+queueing, since while it queued it would block every query behind it.
+The next run tries again. Partitions are created empty and then
+attached, which on Postgres 12 leaves reads and writes of the table
+running. On Postgres 14 old partitions are detached concurrently, and a
+concurrent detach that was interrupted is finalized by the next run.
+
+Elsewhere the table is not partitioned and all of this does nothing.
+"""
+import logging
+import re
+from datetime import date, datetime
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+TABLE = "users_transactionentry"
+ARCHIVE_SCHEMA = "archive"
+# migration 0015 partitions the table from this Postgres version on
+MIN_SERVER_VERSION = 110000
+# DETACH PARTITION ... CONCURRENTLY and FINALIZE
+CONCURRENT_DETACH_VERSION = 140000
+# check_violation, raised for a row no partition accepts
+CHECK_VIOLATION = "23514"
+
+_NAME = re.compile(r"^{}_p(\d{{4}})_(\d{{2}})$".format(TABLE))
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def start_of(month):
+    """The first moment of ``month`` in UTC, where partition bounds fall"""
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return "{}_p{:%Y_%m}".format(TABLE, month)
+
+
+def is_partitioned():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def month_of(name):
+    """The month the partition ``name`` holds, None for other tables"""
+    match = _NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def existing():
+    """The attached partitions, keyed by the month they hold"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass",
+            [TABLE],
+        )
+        names = [name for name, in cursor.fetchall()]
+    return {month_of(name): name for name in names if month_of(name) is not None}
+
+
+def detaching():
+    """The names of the partitions whose concurrent detach was interrupted and awaits FINALIZE"""
+    if connection.pg_version < CONCURRENT_DETACH_VERSION:
+        return set()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass AND pg_inherits.inhdetachpending",
+            [TABLE],
+        )
+        return {name for name, in cursor.fetchall()}
+
+
+def detached():
+    """The months that were detached on purpose"""
+    from .models import DetachedPartition
+
+    return set(DetachedPartition.objects.values_list("month", flat=True))
+
+
+def _set_lock_timeout(cursor, local=True):
+    cursor.execute("SET {}lock_timeout = %s".format("LOCAL " if local else ""),
+                   ["{}ms".format(int(settings.TRANSACTION_PARTITION_LOCK_TIMEOUT * 1000))])
+
+
+def create(month):
+    """Creates the empty partition for ``month`` and attaches it"""
+    qn = connection.ops.quote_name
+    name = partition_name(month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        _set_lock_timeout(cursor)
+        cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(
+            qn(name), qn(TABLE)
+        ))
+        # attaching an empty table needs no scan, and the table's indexes
+        # and foreign keys are created on it as it is attached
+        cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)".format(
+            qn(TABLE), qn(name)
+        ), [start_of(month), start_of(add_months(month, 1))])
+    return name
+
+
+def ensure(months_ahead=None, today=None):
+    """
+    Creates the partitions missing from this month to ``months_ahead``
+    months on, TRANSACTION_PARTITION_MONTHS_AHEAD by default
+
+    Returns:
+        The names of the partitions created
+    """
+    if not is_partitioned():
+        return []
+    if months_ahead is None:
+        months_ahead = settings.TRANSACTION_PARTITION_MONTHS_AHEAD
+    months = missing(existing(), months_ahead, today or timezone.now().date())
+    return [create(month) for month in months]
+
+
+def is_missing_partition(exc):
+    """Whether ``exc`` was raised by writing an entry no partition accepts"""
+    cause = exc.__cause__
+    return getattr(cause, "pgcode", None) == CHECK_VIOLATION and "no partition of relation" in str(cause)
+
+
+def create_for_write(month):
+    """
+    Creates the partition for ``month`` that a posting found missing. Two
+    postings can both try, so failing is logged rather than raised: the
+    posting's retry tells whether the partition is there.
+    """
+    try:
+        name = create(month)
+    except DatabaseError:
+        logger.warning("Could not create the partition for %s", month, exc_info=True)
+        return None
+    logger.warning("Created %s for a posting, is partition_transactions running?", name)
+    return name
+
+
+def detach(name, pending=False):
+    """
+    Detaches the partition ``name``, finishing an interrupted concurrent
+    detach instead when ``pending``
+    """
+    qn = connection.ops.quote_name
+    if connection.pg_version >= CONCURRENT_DETACH_VERSION and not connection.in_atomic_block:
+        # CONCURRENTLY cannot run in a transaction, so the timeout is the session's
+        with connection.cursor() as cursor:
+            _set_lock_timeout(cursor, local=False)
+            try:
+                cursor.execute("ALTER TABLE {} DETACH PARTITION {} {}".format(
+                    qn(TABLE), qn(name), "FINALIZE" if pending else "CONCURRENTLY"
+                ))
+            finally:
+                cursor.execute("RESET lock_timeout")
+        _record_detached(name)
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        _set_lock_timeout(cursor)
+        cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(qn(TABLE), qn(name)))
+        _record_detached(name)
+
+
+def _record_detached(name):
+    from .models import DetachedPartition
+
+    DetachedPartition.objects.update_or_create(
+        month=month_of(name), defaults={"name": name, "detached_at": timezone.now()}
+    )
+
+
+def archive(name):
+    """Moves a detached partition to the archive schema"""
+    qn = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        _set_lock_timeout(cursor)
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS {}".format(qn(ARCHIVE_SCHEMA)))
+        cursor.execute("ALTER TABLE {} SET SCHEMA {}".format(qn(name), qn(ARCHIVE_SCHEMA)))
+
+
+def drop(name):
+    with transaction.atomic(), connection.cursor() as cursor:
+        _set_lock_timeout(cursor)
+        cursor.execute("DROP TABLE {}".format(connection.ops.quote_name(name)))
+
+
+def missing(months, months_ahead, today):
+    """The months from this one to ``months_ahead`` on that have no partition in ``months``"""
+    first = month_start(today)
+    wanted = (add_months(first, offset) for offset in range(months_ahead + 1))
+    return [month for month in wanted if month not in months]
+
+
+def expired(months, retain_months, today):
+    """The months in ``months`` older than the last ``retain_months``, this one included"""
+    cutoff = add_months(month_start(today), 1 - retain_months)
+    return sorted(month for month in months if month < cutoff)
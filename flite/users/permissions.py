@@ -1,6 +1,6 @@
 from rest_framework import permissions
 
-from flite.users.models import Transaction
+from flite.users.models import TransactionEntry
 
 
 class IsUserOrReadOnly(permissions.BasePermission):
@@ -25,5 +25,5 @@ class OwnerOnlyPermission(permissions.BasePermission):
         kwargs = view.kwargs
         url_param_id = kwargs.get('user_id') or kwargs.get('sender_account_id') or kwargs.get('account_id')
         if not url_param_id:
-            return Transaction.objects.filter(id=kwargs.get("transaction_id")).exists()
+            return TransactionEntry.objects.filter(id=kwargs.get("transaction_id")).exists()
         return str(request.user.id) == str(url_param_id)
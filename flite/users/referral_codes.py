@@ -0,0 +1,76 @@
+"""
+Referral code allocation.
+
+Codes are derived from a database sequence, so they are unique without
+checking the table first. A process reserves BLOCK_SIZE sequence values
+with one ``nextval`` and hands them out from memory, so most signups do
+not touch the sequence at all. Each value is scrambled by a bijection on
+45 bits, which keeps consecutive signups from getting consecutive codes,
+and written as 9 Crockford base32 characters.
+"""
+import threading
+
+from django.db import connection
+
+SEQUENCE = "users_referral_code_seq"
+# the sequence's INCREMENT BY, see migration 0012
+BLOCK_SIZE = 100
+
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+LENGTH = 9
+BITS = 5 * LENGTH
+MASK = (1 << BITS) - 1
+# odd multipliers, so multiplication modulo 2**45 can be undone
+MULTIPLIERS = (0x1F3A5C7E9B1, 0x0D2B4F6A8C3)
+
+
+def scramble(value):
+    """Maps ``value`` to a number of the same bit width; no two values share a result"""
+    value = (value * MULTIPLIERS[0]) & MASK
+    value ^= value >> (BITS // 2)
+    return (value * MULTIPLIERS[1]) & MASK
+
+
+def encode(value):
+    """Writes a number below 2**45 as LENGTH base32 characters"""
+    chars = []
+    for _ in range(LENGTH):
+        value, index = divmod(value, 32)
+        chars.append(ALPHABET[index])
+    return "".join(reversed(chars))
+
+
+def _reserve_block():
+    """Returns the first value of a block of BLOCK_SIZE values nobody else will get"""
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT nextval(%s)", [SEQUENCE])
+        else:
+            # a counter table stands in for the sequence elsewhere
+            cursor.execute(
+                "UPDATE {0} SET value = value + %s RETURNING value - %s".format(
+                    connection.ops.quote_name(SEQUENCE)
+                ),
+                [BLOCK_SIZE, BLOCK_SIZE],
+            )
+        return cursor.fetchone()[0]
+
+
+class Allocator(object):
+
+    def __init__(self):
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """Returns a new referral code"""
+        with self._lock:
+            if self._next >= self._end:
+                self._next = _reserve_block()
+                self._end = self._next + BLOCK_SIZE
+            value = self._next
+            self._next += 1
+        return encode(scramble(value))
+
+
+allocate = Allocator().allocate
@@ -1,12 +1,15 @@
+from django.conf import settings
+from phonenumber_field.serializerfields import PhoneNumberField
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied
 
-from .models import User, NewUserPhoneVerification, UserProfile, Referral, Transaction
-from . import utils
+from .models import User, TransactionEntry
+from . import signup, verification
+from ..core.instrumentation import TimedSerializerMixin
 from ..core.utils import FAILURE_MSGS, get_or_404
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
 
     class Meta:
         model = User
@@ -14,37 +17,24 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ('username', )
 
 
-class CreateUserSerializer(serializers.ModelSerializer):
+class CreateUserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     referral_code = serializers.CharField(required=False)
 
 
     def validate_referral_code(self, code):
-
-        self.reffered_profile = UserProfile.objects.filter(referral_code=code.lower())
-        is_valid_code = self.reffered_profile.exists()
-        if not is_valid_code:
+        referrer = signup.referrer_id(code)
+        if referrer is None:
             raise serializers.ValidationError(
                 "Referral code does not exist"
             )
-        else:
-            return code
+        self.referrer = referrer
+        return code
 
     def create(self, validated_data):
-        # call create_user on user object. Without this
-        # the password will be stored in plain text.
-        referral_code = None
-        if 'referral_code' in validated_data:
-            referral_code = validated_data.pop('referral_code',None)
-
-        user = User.objects.create_user(**validated_data)
-
-        if referral_code:
-            referral =Referral()
-            referral.owner = self.reffered_profile.first().user
-            referral.referred = user
-            referral.save()
-
-        return user
+        # signup hashes the password and creates the token, profile,
+        # balance and referral along with the user
+        validated_data.pop('referral_code', None)
+        return signup.signup(referrer=getattr(self, 'referrer', None), **validated_data)
 
     class Meta:
         model = User
@@ -53,27 +43,25 @@ class CreateUserSerializer(serializers.ModelSerializer):
         extra_kwargs = {'password': {'write_only': True}}
 
 
-class SendNewPhonenumberSerializer(serializers.ModelSerializer):
+class SendNewPhonenumberSerializer(TimedSerializerMixin, serializers.Serializer):
+    id = serializers.CharField(read_only=True)
+    phone_number = PhoneNumberField(write_only=True)
+    email = serializers.EmailField(write_only=True, required=False, allow_blank=True)
+    verification_code = serializers.CharField(read_only=True)
 
     def create(self, validated_data):
-        phone_number = validated_data.get("phone_number", None)
-        email = validated_data.get("email", None)
-
-        obj, code = utils.send_mobile_signup_sms(phone_number, email)
+        # nothing is written to the database until the code is verified
+        verification_id, code = verification.start(
+            validated_data["phone_number"], validated_data.get("email")
+        )
 
         return {
-            "verification_code":code,
-            "id":obj.id
+            "verification_code": code,
+            "id": verification_id
         }
 
-    class Meta:
-        model = NewUserPhoneVerification
-        fields = ('id', 'phone_number', 'verification_code', 'email',)
-        extra_kwargs = {'phone_number': {'write_only': True, 'required':True}, 'email': {'write_only': True}, }
-        read_only_fields = ('id', 'verification_code')
-
 
-class DepositWithdrawalBaseSerializer(serializers.Serializer):
+class DepositWithdrawalBaseSerializer(TimedSerializerMixin, serializers.Serializer):
     amount = serializers.DecimalField(max_digits=1000_000, decimal_places=2)
 
     def validate_amount(self, amount):
@@ -92,7 +80,7 @@ class CreateWithdrawalSerializer(DepositWithdrawalBaseSerializer):
         user.balance.make_withdrawal(self.validated_data["amount"])
 
 
-class CreateP2PSerializer(serializers.Serializer):
+class P2PBaseSerializer(TimedSerializerMixin, serializers.Serializer):
     amount = serializers.DecimalField(max_digits=1000_000, decimal_places=2)
 
     def validate_amount(self, amount):
@@ -100,6 +88,8 @@ class CreateP2PSerializer(serializers.Serializer):
             raise serializers.ValidationError(FAILURE_MSGS["must_be_greater"].format("Transfer", 0))
         return amount
 
+
+class CreateP2PSerializer(P2PBaseSerializer):
     def save(self, user, kwargs):
         sender = get_or_404(User, id=kwargs.pop("sender_account_id", None))
         recipient = get_or_404(User, id=kwargs.pop("recipient_account_id", None))
@@ -110,12 +100,30 @@ class CreateP2PSerializer(serializers.Serializer):
         sender.balance.make_p2p_transfer(self.validated_data["amount"], recipient.balance)
 
 
-class ListTransactionsSerializer(serializers.ModelSerializer):
-    type = serializers.SerializerMethodField()
-    class Meta:
-        model = Transaction
-        fields = "__all__"
+class BulkP2PItemSerializer(P2PBaseSerializer):
+    recipient = serializers.UUIDField()
+
 
-    def get_type(self, obj):
-        return obj.__class__.__name__.lower()
+class CreateBulkP2PSerializer(TimedSerializerMixin, serializers.Serializer):
+    transfers = BulkP2PItemSerializer(many=True, allow_empty=False)
+
+    def validate_transfers(self, transfers):
+        if len(transfers) > settings.BULK_TRANSFER_MAX_ITEMS:
+            raise serializers.ValidationError(
+                FAILURE_MSGS["too_many_items"].format(settings.BULK_TRANSFER_MAX_ITEMS)
+            )
+        return transfers
+
+    def save(self, user, kwargs):
+        if str(kwargs.pop("sender_account_id", None)) != str(user.id):
+            raise PermissionDenied()
+        payouts = [(item["recipient"], item["amount"]) for item in self.validated_data["transfers"]]
+        return user.balance.make_bulk_p2p_transfer(payouts)
+
+
+class ListTransactionsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = TransactionEntry
+        fields = ("id", "type", "created", "modified", "reference", "status", "amount", "new_balance",
+                  "owner", "sender", "receipient", "bank")
 
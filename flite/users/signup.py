@@ -0,0 +1,78 @@
+"""
+User signup.
+
+A new user's row, token, profile, balance and referral are written in
+one database transaction with one INSERT each, so a failed signup
+leaves nothing behind. Referral codes come from referral_codes.allocate,
+which never hands out the same code twice, so they are not checked for
+uniqueness first.
+"""
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+
+def referrer_id(code):
+    """Returns the id of the user owning the referral ``code``, None if there is none"""
+    from .models import UserProfile
+
+    # UPPER(referral_code) = UPPER(code), which the functional index answers
+    return UserProfile.objects.filter(referral_code__iexact=code).values_list("user_id", flat=True).first()
+
+
+def provision(user):
+    """Creates the token, profile and balance every user has"""
+    from .models import Balance, UserProfile
+
+    Token.objects.create(user=user)
+    UserProfile.objects.create(user=user, referral_code=UserProfile.generate_new_referal_code())
+    Balance.objects.create(owner=user)
+
+
+def provision_many(users):
+    """
+    Creates the users and everything they need with one INSERT per table.
+    Like ``bulk_create`` it sends no post_save signals, so provision() is
+    not called; run it inside a transaction.
+    """
+    from .models import Balance, User, UserProfile
+
+    User.objects.bulk_create(users)
+    tokens = [Token(user=user) for user in users]
+    for token in tokens:
+        # Token.save() would do this
+        token.key = token.generate_key()
+    Token.objects.bulk_create(tokens)
+    UserProfile.objects.bulk_create([
+        UserProfile(user=user, referral_code=UserProfile.generate_new_referal_code()) for user in users
+    ])
+    Balance.objects.bulk_create([Balance(owner=user) for user in users])
+
+
+def signup(username, password, referrer=None, **fields):
+    """
+    Creates a user with everything it needs, in one transaction.
+
+    Args:
+        username(str): The username
+        password(str): The raw password
+        referrer: Id of the user who referred this one, if any
+        fields(dict): Other User fields
+
+    Returns:
+        The new user
+    """
+    from .models import Referral, User
+
+    user = User(
+        username=User.normalize_username(username),
+        email=User.objects.normalize_email(fields.pop("email", "")),
+        **fields
+    )
+    user.set_password(password)
+    with transaction.atomic():
+        # the primary key is set already, so without force_insert save()
+        # would try an UPDATE first; the post_save receiver calls provision()
+        user.save(force_insert=True)
+        if referrer is not None:
+            Referral.objects.create(owner_id=referrer, referred=user)
+    return user
@@ -0,0 +1,272 @@
+"""
+Server-sent event streams of an account's new transactions.
+
+Every process has one Hub. A stream subscribes to it for its account
+and sleeps until woken, then reads the account's OutboxEvents after the
+last one it sent. Once a posting commits, an on-commit hook wakes the
+hubs of every process: on Postgres with one NOTIFY per posting, sent on
+a connection of its own so that the postings' commits never queue up on
+the NOTIFY lock, and heard by the one LISTEN connection each process
+keeps; elsewhere by waking this process's hub directly. Streams also
+look for new events every TRANSACTION_STREAM_HEARTBEAT seconds, so a
+lost notification only delays an event.
+
+An open stream holds a thread but no database connection, and however
+many streams are open a process listens on one connection.
+
+Event ids are OutboxEvent ids, and a client that reconnects with the
+Last-Event-ID it saw gets every event after it. An account's events
+commit in id order because a posting holds the account's balance lock
+until it commits, so resuming skips nothing. Credits to a sharded
+balance take no lock and can commit out of order, so a sharded
+account's events are only sent once they are
+TRANSACTION_STREAM_SHARDED_LAG seconds old, by when every event before
+them has committed.
+"""
+import collections
+import logging
+import select
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from flite.core import metrics, routers
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "flite_transactions"
+# milliseconds a client waits before reconnecting
+RETRY = 1000
+# most events read from the database at once
+BATCH_SIZE = 100
+# seconds the listener waits for a notification before checking its connection
+LISTEN_TIMEOUT = 5
+# seconds before the listener reconnects after losing its connection
+RECONNECT_DELAY = 1
+
+streams_open = metrics.gauge("transaction_streams_open", "Open transaction streams")
+stream_events_total = metrics.counter("transaction_stream_events_total", "Events sent on transaction streams")
+
+
+class Hub(object):
+    """Wakes the streams of the accounts that have new events"""
+
+    def __init__(self):
+        self._subscribers = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, account_id):
+        """Returns a threading.Event that is set whenever ``account_id`` has new events"""
+        self.listen()
+        wake = threading.Event()
+        with self._lock:
+            self._subscribers[str(account_id)].add(wake)
+        return wake
+
+    def unsubscribe(self, account_id, wake):
+        with self._lock:
+            subscribers = self._subscribers.get(str(account_id))
+            if subscribers is not None:
+                subscribers.discard(wake)
+                if not subscribers:
+                    del self._subscribers[str(account_id)]
+
+    def publish(self, account_ids):
+        with self._lock:
+            wakes = [
+                wake for account_id in account_ids for wake in self._subscribers.get(str(account_id), ())
+            ]
+        for wake in wakes:
+            wake.set()
+
+    def publish_all(self):
+        with self._lock:
+            wakes = [wake for subscribers in self._subscribers.values() for wake in subscribers]
+        for wake in wakes:
+            wake.set()
+
+    @property
+    def listening(self):
+        return self._listener is not None and self._listener.is_alive()
+
+    def listen(self):
+        """Starts the LISTEN thread on Postgres, unless it is running"""
+        if connections[DEFAULT_DB_ALIAS].vendor != "postgresql" or self.listening:
+            return
+        with self._lock:
+            if not self.listening:
+                self._listener = threading.Thread(target=self._listen, name="transaction-stream-listener")
+                self._listener.daemon = True
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = _connect()
+                with conn.cursor() as cursor:
+                    cursor.execute("LISTEN {}".format(CHANNEL))
+                # notifications sent while disconnected are lost
+                self.publish_all()
+                while True:
+                    if select.select([conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    account_ids = {notify.payload for notify in conn.notifies}
+                    del conn.notifies[:]
+                    self.publish(account_ids)
+            except Exception:
+                logger.exception("Transaction stream listener failed, reconnecting")
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+class Notifier(object):
+    """Sends NOTIFYs on an autocommit connection per thread, outside any posting's transaction"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def send(self, account_ids):
+        import psycopg2
+
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None or conn.closed:
+                conn = self._local.conn = _connect()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT pg_notify(%s, account_id) FROM unnest(%s::text[]) AS account_id",
+                        [CHANNEL, account_ids],
+                    )
+                return
+            except psycopg2.Error:
+                conn.close()
+                # once more on a new connection if the old one had gone away
+                if attempt:
+                    raise
+
+
+hub = Hub()
+notifier = Notifier()
+
+
+def _connect():
+    import psycopg2
+
+    conn = psycopg2.connect(**connections[DEFAULT_DB_ALIAS].get_connection_params())
+    conn.autocommit = True
+    return conn
+
+
+def notify(account_ids):
+    """Wakes the streams of ``account_ids``, in every process, once the current transaction commits"""
+    account_ids = sorted(account_ids)
+    transaction.on_commit(lambda: _announce(account_ids))
+
+
+def _announce(account_ids):
+    if connections[DEFAULT_DB_ALIAS].vendor != "postgresql":
+        hub.publish(account_ids)
+        return
+    try:
+        notifier.send(account_ids)
+    except Exception:
+        # the posting has committed; its streams find it on their next heartbeat
+        logger.exception("Could not notify the transaction streams of %s", ", ".join(account_ids))
+
+
+def _read(account_id, after):
+    """
+    Returns the events of ``account_id`` after ``after`` that can be sent,
+    and the seconds until the ones held back can be, None when none are
+    """
+    from .models import Balance, OutboxEvent
+
+    sharded = Balance.objects.filter(owner_id=OuterRef("account_id"), slot_count__gt=1)
+    # from the primary, where a notification's event is already visible
+    with routers.use_primary():
+        rows = list(
+            OutboxEvent.objects.filter(account_id=account_id, id__gt=after)
+            .annotate(sharded=Exists(sharded))
+            .order_by("id").values_list("id", "payload", "created", "sharded")[:BATCH_SIZE]
+        )
+    connection = connections[DEFAULT_DB_ALIAS]
+    if not connection.in_atomic_block:
+        # an idle stream must not hold a connection
+        connection.close()
+
+    held = None
+    if rows and rows[0][3]:
+        # credits to a sharded balance can still commit with lower ids
+        horizon = timezone.now() - timedelta(seconds=settings.TRANSACTION_STREAM_SHARDED_LAG)
+        for index, (_, _, created, _) in enumerate(rows):
+            if created > horizon:
+                held = (created - horizon).total_seconds()
+                rows = rows[:index]
+                break
+    return [(event_id, payload) for event_id, payload, _, _ in rows], held
+
+
+def _last_event_id(account_id):
+    from django.db.models import Max
+    from .models import OutboxEvent
+
+    with routers.use_primary():
+        return OutboxEvent.objects.filter(account_id=account_id).aggregate(last=Max("id"))["last"] or 0
+
+
+def stream(account_id, last_event_id=None, heartbeat=None, max_duration=None):
+    """
+    Yields the new transactions of ``account_id`` as server-sent events
+
+    Args:
+        account_id(uuid): The account whose transactions are sent
+        last_event_id(int): The id of the last event the client has, None
+            to send only the transactions made from now on
+        heartbeat(float): Seconds of quiet before a keep-alive comment is
+            sent. Defaults to TRANSACTION_STREAM_HEARTBEAT
+        max_duration(float): Seconds before the stream ends and the client
+            reconnects. Defaults to TRANSACTION_STREAM_MAX_DURATION
+    """
+    heartbeat = heartbeat or settings.TRANSACTION_STREAM_HEARTBEAT
+    deadline = time.monotonic() + (max_duration or settings.TRANSACTION_STREAM_MAX_DURATION)
+    wake = hub.subscribe(account_id)
+    streams_open.inc()
+    try:
+        after = _last_event_id(account_id) if last_event_id is None else last_event_id
+        yield "retry: {}\n\n".format(RETRY)
+        sent = time.monotonic()
+        while time.monotonic() < deadline:
+            # cleared before reading, so an event committed meanwhile still wakes the stream
+            wake.clear()
+            events, held = _read(account_id, after)
+            if events:
+                after = events[-1][0]
+                stream_events_total.inc(len(events))
+                yield "".join(
+                    "id: {}\nevent: transaction\ndata: {}\n\n".format(event_id, payload)
+                    for event_id, payload in events
+                )
+                sent = time.monotonic()
+                continue
+            if time.monotonic() - sent >= heartbeat:
+                yield ": keep-alive\n\n"
+                sent = time.monotonic()
+            timeout = heartbeat - (time.monotonic() - sent)
+            if held is not None:
+                timeout = min(timeout, held)
+            wake.wait(max(min(timeout, deadline - time.monotonic()), 0))
+    finally:
+        hub.unsubscribe(account_id, wake)
+        streams_open.dec()
@@ -1 +1,8 @@
+from flite.core import sms
+from flite.core.jobs import job
 
+
+@job(queue="sms", priority=10)
+def send_sms_verification_code(phone_number, code):
+    """Sends the code a new user verifies their phone number with"""
+    sms.send_sms(phone_number, "Your Flite verification code is {}".format(code))
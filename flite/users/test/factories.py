@@ -1,5 +1,7 @@
 import factory
 
+from ..models import TransactionEntry
+
 
 class UserFactory(factory.django.DjangoModelFactory):
 
@@ -45,3 +47,8 @@ class TransactionFactory(factory.django.DjangoModelFactory):
 class DepositFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = 'users.Deposit'
+
+    @factory.post_generation
+    def entry(obj, create, extracted, **kwargs):
+        if create:
+            TransactionEntry.from_transaction(obj).save(force_insert=True)
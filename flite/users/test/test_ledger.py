@@ -0,0 +1,665 @@
+import hashlib
+import hmac
+import json
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+
+import mock
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from nose.tools import eq_, ok_, assert_raises
+
+from flite.core import metrics, routers
+from .. import balance_cache, ledger, partitions, webhooks
+from ..models import (
+    Balance, Deposit, OutboxEvent, P2PTransfer, Transaction, TransactionEntry, WebhookDelivery,
+    WebhookEndpoint, Withdrawal,
+)
+from .factories import UserFactory
+
+
+class DeadlockDetected(Exception):
+    pgcode = "40P01"
+
+
+def deadlock():
+    try:
+        raise DeadlockDetected()
+    except DeadlockDetected as exc:
+        raise OperationalError("deadlock detected") from exc
+
+
+class NoPartition(Exception):
+    pgcode = partitions.CHECK_VIOLATION
+
+
+def no_partition():
+    try:
+        raise NoPartition('no partition of relation "users_transactionentry" found for row')
+    except NoPartition as exc:
+        raise IntegrityError(str(exc)) from exc
+
+
+class TestLedgerPostings(TestCase):
+
+    def setUp(self):
+        self.balance = UserFactory().balance
+        Balance.objects.filter(pk=self.balance.pk).update(available_balance=100, book_balance=100)
+
+    def test_deposit_updates_balance_and_records_transaction(self):
+        tnx = self.balance.make_deposit(Decimal("25.50"))
+
+        eq_(self.balance.available_balance, Decimal("125.50"))
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("125.50"))
+        eq_(self.balance.book_balance, Decimal("125.50"))
+        ok_(isinstance(tnx, Deposit))
+        eq_(tnx.new_balance, Decimal("125.50"))
+        eq_(tnx.status, "complete")
+
+    def test_deposit_applies_to_current_row_not_stale_instance(self):
+        stale = Balance.objects.get(pk=self.balance.pk)
+        self.balance.make_deposit(10)
+        stale.make_deposit(10)
+
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("120.00"))
+
+    def test_withdrawal_updates_balance_and_records_transaction(self):
+        tnx = self.balance.make_withdrawal(Decimal("40"))
+
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("60.00"))
+        eq_(self.balance.book_balance, Decimal("60.00"))
+        ok_(isinstance(tnx, Withdrawal))
+        eq_(tnx.new_balance, Decimal("60.00"))
+
+    def test_withdrawal_of_entire_balance(self):
+        self.balance.make_withdrawal(100)
+
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("0.00"))
+
+    def test_withdrawal_with_insufficient_funds_changes_nothing(self):
+        stale = Balance.objects.get(pk=self.balance.pk)
+        self.balance.make_withdrawal(80)
+
+        with assert_raises(ValidationError):
+            stale.make_withdrawal(80)
+
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("20.00"))
+        eq_(Withdrawal.objects.filter(owner=self.balance.owner).count(), 1)
+
+
+class TestLedgerTransfers(TestCase):
+
+    def setUp(self):
+        self.source = UserFactory().balance
+        self.target = UserFactory().balance
+        Balance.objects.filter(pk=self.source.pk).update(available_balance=100, book_balance=100)
+
+    def test_transfer_moves_funds_and_records_transaction(self):
+        tnx = self.source.make_p2p_transfer(Decimal("30"), self.target)
+
+        self.source.refresh_from_db()
+        self.target.refresh_from_db()
+        eq_(self.source.available_balance, Decimal("70.00"))
+        eq_(self.target.available_balance, Decimal("30.00"))
+        ok_(isinstance(tnx, P2PTransfer))
+        eq_(tnx.sender, self.source.owner)
+        eq_(tnx.receipient, self.target.owner)
+        eq_(tnx.new_balance, Decimal("70.00"))
+
+    def test_transfer_checks_funds_against_locked_row(self):
+        Balance.objects.filter(pk=self.source.pk).update(available_balance=10, book_balance=10)
+
+        with assert_raises(ValidationError):
+            self.source.make_p2p_transfer(Decimal("30"), self.target)
+
+        self.target.refresh_from_db()
+        eq_(self.target.available_balance, Decimal("0.00"))
+        eq_(P2PTransfer.objects.count(), 0)
+
+    def test_transfer_locks_both_balances_in_one_query(self):
+        acquisitions = metrics.sample("ledger_lock_acquisitions_total")
+        with CaptureQueriesContext(connection) as queries:
+            self.source.make_p2p_transfer(10, self.target)
+
+        selects = [q["sql"] for q in queries.captured_queries if q["sql"].startswith("SELECT")]
+        eq_(len(selects), 1)
+        ok_(selects[0].endswith('ORDER BY "users_balance"."id" ASC'))
+        eq_(metrics.sample("ledger_lock_acquisitions_total"), acquisitions + 1)
+
+    def test_deposits_and_withdrawals_record_their_lock_wait(self):
+        acquisitions = metrics.sample("ledger_lock_acquisitions_total")
+        self.source.make_deposit(10)
+        self.source.make_withdrawal(5)
+        eq_(metrics.sample("ledger_lock_acquisitions_total"), acquisitions + 2)
+
+
+@override_settings(LEDGER_RETRY_BASE_DELAY=0, LEDGER_MAX_RETRIES=2)
+class TestLedgerTransferRetries(TransactionTestCase):
+
+    def setUp(self):
+        self.source = UserFactory().balance
+        self.target = UserFactory().balance
+        Balance.objects.filter(pk=self.source.pk).update(available_balance=100, book_balance=100)
+
+    def test_transfer_is_retried_after_a_deadlock(self):
+        retries = metrics.sample("ledger_retries_total")
+        real_lock = ledger.lock
+        calls = []
+
+        def flaky_lock(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                deadlock()
+            return real_lock(*args)
+
+        with mock.patch.object(ledger, "lock", flaky_lock):
+            self.source.make_p2p_transfer(10, self.target)
+
+        eq_(len(calls), 2)
+        eq_(metrics.sample("ledger_retries_total"), retries + 1)
+        self.source.refresh_from_db()
+        eq_(self.source.available_balance, Decimal("90.00"))
+        eq_(P2PTransfer.objects.count(), 1)
+
+    def test_transfer_gives_up_after_max_retries(self):
+        with mock.patch.object(ledger, "lock", side_effect=lambda *args: deadlock()) as lock:
+            with assert_raises(OperationalError):
+                self.source.make_p2p_transfer(10, self.target)
+        eq_(lock.call_count, 3)
+
+    def test_a_posting_in_a_month_without_a_partition_creates_it(self):
+        real_insert = ledger.insert_transactions
+        calls = []
+
+        def insert_before_the_partition(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                no_partition()
+            return real_insert(*args)
+
+        with mock.patch.object(ledger, "insert_transactions", insert_before_the_partition), \
+                mock.patch.object(partitions, "create", return_value="p") as create:
+            self.source.make_deposit(10)
+
+        eq_(len(calls), 2)
+        create.assert_called_once_with(partitions.month_start(timezone.now()))
+        self.source.refresh_from_db()
+        eq_(self.source.available_balance, Decimal("110.00"))
+        eq_(Deposit.objects.count(), 1)
+
+        # other integrity errors are not retried
+        with mock.patch.object(ledger, "insert_transactions", side_effect=IntegrityError("duplicate")):
+            with assert_raises(IntegrityError):
+                self.source.make_deposit(10)
+        eq_(create.call_count, 1)
+
+    def test_other_database_errors_are_not_retried(self):
+        with mock.patch.object(ledger, "lock", side_effect=OperationalError("gone away")) as lock:
+            with assert_raises(OperationalError):
+                self.source.make_p2p_transfer(10, self.target)
+        eq_(lock.call_count, 1)
+
+
+class TestBalanceCache(TransactionTestCase):
+    """The on-commit hooks only run outside of TestCase's wrapping transaction"""
+
+    def setUp(self):
+        self.sender = UserFactory().balance
+        self.recipient = UserFactory().balance
+        Balance.objects.filter(pk=self.sender.pk).update(available_balance=100, book_balance=100)
+        self.sender.refresh_from_db()
+
+    def cached(self, balance):
+        return balance_cache._cache().get(balance_cache.cache_key(balance.owner_id))
+
+    def test_postings_drop_the_cached_balance(self):
+        balance_cache.get_balance(self.sender.owner_id)
+        balance_cache.get_balance(self.recipient.owner_id)
+        self.sender.make_p2p_transfer(Decimal("5"), self.recipient)
+
+        eq_(self.cached(self.sender), None)
+        eq_(self.cached(self.recipient), None)
+        eq_(balance_cache.get_balance(self.sender.owner_id)["available_balance"], "95.00")
+        eq_(balance_cache.get_balance(self.recipient.owner_id)["available_balance"], "5.00")
+
+    def test_reads_after_the_first_do_not_query(self):
+        self.sender.make_withdrawal(Decimal("40"))
+        eq_(balance_cache.get_balance(self.sender.owner_id)["available_balance"], "60.00")
+        with self.assertNumQueries(0):
+            eq_(balance_cache.get_balance(self.sender.owner_id)["available_balance"], "60.00")
+
+    def test_misses_read_from_the_primary(self):
+        pinned = []
+
+        def db_for_read(router, model, **hints):
+            pinned.append(routers.is_pinned())
+            return "default"
+
+        with mock.patch.object(routers.ReplicaRouter, "db_for_read", db_for_read):
+            balance_cache.get_balance(self.sender.owner_id)
+        ok_(pinned)
+        ok_(all(pinned))
+
+    def test_late_hooks_never_cache_an_older_balance(self):
+        hooks = []
+        with mock.patch("django.db.transaction.on_commit", side_effect=hooks.append):
+            self.sender.make_deposit(Decimal("10"))
+            self.sender.make_deposit(Decimal("20"))
+        balance_cache.get_balance(self.sender.owner_id)
+        # the first posting's hook runs last
+        for hook in reversed(hooks):
+            hook()
+        eq_(balance_cache.get_balance(self.sender.owner_id)["available_balance"], "130.00")
+
+    def test_failed_postings_leave_the_cache_alone(self):
+        balance_cache.get_balance(self.sender.owner_id)
+        with assert_raises(ValidationError):
+            self.sender.make_withdrawal(Decimal("500"))
+        eq_(self.cached(self.sender)["available_balance"], "100.00")
+
+    def test_bulk_transfers_invalidate_recipients(self):
+        balance_cache.get_balance(self.sender.owner_id)
+        balance_cache.get_balance(self.recipient.owner_id)
+        self.sender.make_bulk_p2p_transfer([(self.recipient.owner_id, Decimal("10"))])
+
+        eq_(self.cached(self.recipient), None)
+        eq_(balance_cache.get_balance(self.recipient.owner_id)["available_balance"], "10.00")
+        eq_(balance_cache.get_balance(self.sender.owner_id)["available_balance"], "90.00")
+
+
+class TestLedgerBulkTransfers(TestCase):
+
+    def setUp(self):
+        self.source = UserFactory().balance
+        self.recipients = [UserFactory().balance for _ in range(3)]
+        Balance.objects.filter(pk=self.source.pk).update(available_balance=100, book_balance=100)
+
+    def test_bulk_transfer_credits_every_recipient(self):
+        payouts = [(balance.owner_id, Decimal("10")) for balance in self.recipients]
+        payouts.append((self.recipients[0].owner_id, Decimal("5")))
+
+        results = self.source.make_bulk_p2p_transfer(payouts)
+
+        eq_([result["status"] for result in results], ["complete"] * 4)
+        self.source.refresh_from_db()
+        eq_(self.source.available_balance, Decimal("65.00"))
+        eq_(self.source.book_balance, Decimal("65.00"))
+        balances = [Balance.objects.get(pk=balance.pk).available_balance for balance in self.recipients]
+        eq_(balances, [Decimal("15.00"), Decimal("10.00"), Decimal("10.00")])
+        transfers = P2PTransfer.objects.filter(sender=self.source.owner).order_by("new_balance")
+        eq_([tnx.new_balance for tnx in transfers], [Decimal(65), Decimal(70), Decimal(80), Decimal(90)])
+
+    def test_bulk_transfer_reports_failed_items(self):
+        payouts = [
+            (self.recipients[0].owner_id, Decimal("60")),
+            (self.recipients[1].owner_id, Decimal("60")),
+            (self.source.owner_id, Decimal("1")),
+            (UserFactory.build().id, Decimal("1")),
+            (self.recipients[2].owner_id, Decimal("40")),
+        ]
+
+        results = self.source.make_bulk_p2p_transfer(payouts)
+
+        eq_([result["status"] for result in results], ["complete", "failed", "failed", "failed", "complete"])
+        eq_(results[1]["reason"], "insufficient funds")
+        eq_(results[2]["reason"], "You cannot make p2p transfer to yourself")
+        eq_(results[3]["reason"], "recipient account does not exist")
+        self.source.refresh_from_db()
+        eq_(self.source.available_balance, Decimal("0.00"))
+        eq_(P2PTransfer.objects.count(), 2)
+
+    def test_bulk_transfer_query_count_does_not_grow_with_batch(self):
+        many = [UserFactory().balance for _ in range(20)]
+        with CaptureQueriesContext(connection) as single:
+            self.source.make_bulk_p2p_transfer([(self.recipients[0].owner_id, 1)])
+        with CaptureQueriesContext(connection) as batch:
+            self.source.make_bulk_p2p_transfer([(balance.owner_id, 1) for balance in many])
+
+        eq_(len(batch.captured_queries), len(single.captured_queries))
+
+
+class TestShardedBalances(TestCase):
+
+    def setUp(self):
+        self.balance = UserFactory().balance
+        self.other = UserFactory().balance
+        Balance.objects.filter(pk__in=[self.balance.pk, self.other.pk]).update(
+            available_balance=100, book_balance=100
+        )
+        self.balance.refresh_from_db()
+        self.balance.set_slot_count(4)
+
+    def test_reshard_creates_slots(self):
+        eq_(self.balance.slots.count(), 4)
+        eq_(Balance.objects.get(pk=self.balance.pk).slot_count, 4)
+
+    def test_credits_land_in_slots(self):
+        for _ in range(5):
+            tnx = self.balance.make_deposit(10)
+
+        eq_(Balance.objects.get(pk=self.balance.pk).available_balance, Decimal("100.00"))
+        eq_(self.balance.get_available_balance(), Decimal("150.00"))
+        eq_(tnx.new_balance, Decimal("150.00"))
+
+    def test_transfer_to_sharded_balance_does_not_lock_it(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.other.make_p2p_transfer(25, self.balance)
+
+        lock_query = [q["sql"] for q in queries.captured_queries if q["sql"].startswith("SELECT")][0]
+        ok_(self.balance.pk.hex not in lock_query)
+        eq_(self.balance.get_available_balance(), Decimal("125.00"))
+        eq_(self.other.get_available_balance(), Decimal("75.00"))
+
+    def test_debit_consolidates_slots(self):
+        self.balance.make_deposit(50)
+
+        self.balance.make_withdrawal(140)
+
+        eq_(self.balance.get_available_balance(), Decimal("10.00"))
+        eq_(sum(slot.available_balance for slot in self.balance.slots.all()), 0)
+
+    def test_debit_cannot_exceed_consolidated_balance(self):
+        self.balance.make_deposit(50)
+
+        with assert_raises(ValidationError):
+            self.balance.make_p2p_transfer(151, self.other)
+        eq_(self.balance.get_available_balance(), Decimal("150.00"))
+
+    def test_merging_slots_keeps_the_balance(self):
+        self.balance.make_deposit(50)
+
+        self.balance.set_slot_count(1)
+
+        eq_(self.balance.slots.count(), 0)
+        self.balance.refresh_from_db()
+        eq_(self.balance.available_balance, Decimal("150.00"))
+
+
+class TestTransactionEntries(TestCase):
+
+    def setUp(self):
+        self.balance = UserFactory().balance
+        self.other = UserFactory().balance
+
+    def test_postings_write_entries(self):
+        deposit = self.balance.make_deposit(50)
+        transfer = self.balance.make_p2p_transfer(20, self.other)
+
+        entry = TransactionEntry.objects.get(pk=deposit.pk)
+        eq_(entry.type, TransactionEntry.DEPOSIT)
+        eq_(entry.new_balance, Decimal("50.00"))
+        entry = TransactionEntry.objects.get(pk=transfer.pk)
+        eq_(entry.type, TransactionEntry.P2P_TRANSFER)
+        eq_(str(entry.receipient_id), str(self.other.owner_id))
+        eq_(entry.reference, transfer.reference)
+
+    def test_bulk_postings_write_entries(self):
+        self.balance.make_deposit(50)
+        self.balance.make_bulk_p2p_transfer([(self.other.owner_id, 10), (self.other.owner_id, 15)])
+
+        eq_(TransactionEntry.objects.filter(owner=self.balance.owner, type="p2ptransfer").count(), 2)
+
+    def test_filter_query_plans_can_be_explained(self):
+        self.balance.make_deposit(50)
+        out = StringIO()
+
+        call_command("explain_transaction_filters", stdout=out)
+
+        ok_("## type and date range" in out.getvalue())
+        ok_("users_entry_owner_type_idx" in out.getvalue())
+
+    def test_reconcile_reports_balances_that_do_not_add_up(self):
+        self.balance.make_deposit(Decimal("100"))
+        self.balance.make_p2p_transfer(Decimal("30"), self.other)
+        owners = [self.balance.owner_id, self.other.owner_id]
+        eq_(ledger.reconcile(owners), [])
+
+        Balance.objects.filter(pk=self.other.pk).update(available_balance=1)
+        eq_(ledger.reconcile(owners), [
+            {"account": str(self.other.owner_id), "balance": "1.00", "expected": "30.00"},
+        ])
+
+    def test_backfill_copies_missing_entries(self):
+        deposit = self.balance.make_deposit(50)
+        self.balance.make_withdrawal(20)
+        TransactionEntry.objects.filter(pk=deposit.pk).delete()
+
+        call_command("backfill_transaction_entries", chunk_size=1, stdout=StringIO())
+        call_command("backfill_transaction_entries", stdout=StringIO())
+
+        eq_(TransactionEntry.objects.count(), 2)
+        eq_(TransactionEntry.objects.get(pk=deposit.pk).type, "deposit")
+
+    def test_backfill_copies_history_older_than_the_partitions(self):
+        old, detached, recent = (self.balance.make_deposit(amount) for amount in (10, 20, 30))
+        Transaction.objects.filter(pk=old.pk).update(created=datetime(2025, 3, 10, tzinfo=timezone.utc))
+        Transaction.objects.filter(pk=detached.pk).update(created=datetime(2025, 5, 10, tzinfo=timezone.utc))
+        TransactionEntry.objects.all().delete()
+        partitions._record_detached(partitions.partition_name(date(2025, 5, 1)))
+        this_month = partitions.month_start(timezone.now())
+
+        # only this month has a partition, as after migrating a fresh table
+        with mock.patch.object(partitions, "is_partitioned", return_value=True), \
+                mock.patch.object(partitions, "existing", return_value={this_month: "p"}), \
+                mock.patch.object(partitions, "create", side_effect=partitions.partition_name) as create:
+            call_command("backfill_transaction_entries", stdout=StringIO())
+
+        create.assert_called_once_with(date(2025, 3, 1))
+        # the month detached on purpose is not copied back
+        eq_(set(TransactionEntry.objects.values_list("id", flat=True)), {old.pk, recent.pk})
+
+    def test_partitions_are_kept_ahead_and_expired(self):
+        today = date(2026, 11, 15)
+        months = {date(2025, 12, 1): "p", date(2026, 10, 1): "p", date(2026, 11, 1): "p"}
+
+        eq_(partitions.missing(months, 2, today), [date(2026, 12, 1), date(2027, 1, 1)])
+        eq_(partitions.expired(months, 2, today), [date(2025, 12, 1)])
+        eq_(partitions.expired(months, 12, today), [])
+        eq_(partitions.partition_name(date(2027, 1, 1)), "users_transactionentry_p2027_01")
+
+    def test_partition_command_needs_a_partitioned_table(self):
+        out = StringIO()
+        call_command("partition_transactions", stdout=out)
+        ok_("is not partitioned" in out.getvalue())
+
+    def test_migrate_creates_the_partitions_ahead(self):
+        today = date(2026, 11, 15)
+        with mock.patch.object(partitions, "is_partitioned", return_value=True), \
+                mock.patch.object(partitions, "existing", return_value={date(2026, 11, 1): "p"}), \
+                mock.patch.object(partitions, "create", side_effect=partitions.partition_name) as create:
+            eq_(partitions.ensure(2, today), [
+                "users_transactionentry_p2026_12", "users_transactionentry_p2027_01",
+            ])
+            call_command("migrate", "users", verbosity=0)
+        # migrate ensures TRANSACTION_PARTITION_MONTHS_AHEAD months from the real today
+        ok_(create.call_count > 2)
+
+    def test_partition_command_finalizes_interrupted_detaches(self):
+        this_month = partitions.month_start(timezone.now())
+        pending = partitions.add_months(this_month, -1)
+        months = {
+            month: partitions.partition_name(month)
+            for month in (partitions.add_months(this_month, offset) for offset in range(-1, 4))
+        }
+        with mock.patch.object(partitions, "is_partitioned", return_value=True), \
+                mock.patch.object(partitions, "existing", return_value=months), \
+                mock.patch.object(partitions, "detaching", return_value={months[pending]}), \
+                mock.patch.object(partitions, "detach") as detach, \
+                mock.patch.object(partitions, "archive") as archive:
+            call_command("partition_transactions", months_ahead=3, retain_months=0, stdout=StringIO())
+
+        # finished even without a retention period
+        detach.assert_called_once_with(months[pending], True)
+        archive.assert_called_once_with(months[pending])
+
+
+@override_settings(WEBHOOK_MAX_ATTEMPTS=2)
+class TestWebhooks(TestCase):
+
+    def setUp(self):
+        self.balance = UserFactory().balance
+        self.other = UserFactory().balance
+        self.endpoint = WebhookEndpoint.objects.create(url="http://hooks.test/flite")
+        self.dispatcher = webhooks.Dispatcher(concurrency=1, batch_size=10)
+
+    def respond(self, *statuses):
+        return mock.patch.object(
+            self.dispatcher.http, "request", side_effect=[mock.Mock(status=status) for status in statuses]
+        )
+
+    def posted(self, request):
+        return [json.loads(call[1]["body"].decode()) for call in request.call_args_list]
+
+    def make_due(self):
+        WebhookDelivery.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+    def test_postings_write_events(self):
+        deposit = self.balance.make_deposit(50)
+        self.balance.make_bulk_p2p_transfer([(self.other.owner_id, 10), (self.other.owner_id, 15)])
+
+        eq_(OutboxEvent.objects.count(), 5)
+        event = OutboxEvent.objects.earliest("id")
+        eq_(event.type, "deposit")
+        eq_(str(event.transaction_id), str(deposit.pk))
+        eq_(json.loads(event.payload)["new_balance"], "50.00")
+
+        received = OutboxEvent.objects.filter(account_id=self.other.owner_id).order_by("id")
+        eq_([event.type for event in received], [OutboxEvent.P2P_RECEIVED] * 2)
+        payload = json.loads(received[0].payload)
+        eq_(payload["amount"], "10.00")
+        # the sender's balance is not the recipient's business
+        eq_(payload["new_balance"], None)
+
+    def test_events_are_posted_in_signed_batches(self):
+        WebhookEndpoint.objects.create(url="http://hooks.test/withdrawals", event_types="withdrawal")
+        deposit = self.balance.make_deposit(50)
+        self.other.make_deposit(20)
+
+        eq_(webhooks.fan_out(), 2)
+        eq_(webhooks.fan_out(), 0)
+        with self.respond(200) as request:
+            eq_(self.dispatcher.deliver(), {"delivered": 2, "retried": 0, "dead": 0})
+
+        body = request.call_args[1]["body"]
+        events = json.loads(body.decode())["events"]
+        eq_([event["type"] for event in events], ["deposit", "deposit"])
+        eq_(events[0]["data"]["id"], str(deposit.pk))
+        expected = hmac.new(self.endpoint.secret.encode(), body, hashlib.sha256).hexdigest()
+        eq_(request.call_args[1]["headers"]["X-Flite-Signature"], "sha256=" + expected)
+        eq_(WebhookDelivery.objects.filter(status=WebhookDelivery.DELIVERED).count(), 2)
+        eq_(self.dispatcher.deliver(), {})
+
+    def test_an_accounts_events_are_delivered_in_order(self):
+        first = self.balance.make_deposit(50)
+        second = self.balance.make_withdrawal(20)
+        other = self.other.make_deposit(10)
+        webhooks.fan_out()
+
+        with self.respond(500, 200) as request:
+            eq_(self.dispatcher.deliver(), {"delivered": 0, "retried": 3, "dead": 0})
+            # nothing is due until the retry
+            eq_(self.dispatcher.deliver(), {})
+            self.make_due()
+            eq_(self.dispatcher.deliver(), {"delivered": 3, "retried": 0, "dead": 0})
+        rounds = [[event["data"]["id"] for event in body["events"]] for body in self.posted(request)]
+        eq_(rounds, [[str(first.pk), str(second.pk), str(other.pk)]] * 2)
+
+    def test_later_events_wait_for_a_retried_one(self):
+        first = self.balance.make_deposit(50)
+        webhooks.fan_out()
+        with self.respond(500):
+            self.dispatcher.deliver()
+        second = self.balance.make_withdrawal(20)
+        webhooks.fan_out()
+
+        eq_(self.dispatcher.deliver(), {})
+        self.make_due()
+        with self.respond(200) as request:
+            eq_(self.dispatcher.deliver(), {"delivered": 2, "retried": 0, "dead": 0})
+        events = self.posted(request)[0]["events"]
+        eq_([event["data"]["id"] for event in events], [str(first.pk), str(second.pk)])
+
+    def test_an_accounts_events_are_never_split_across_batches(self):
+        self.dispatcher = webhooks.Dispatcher(concurrency=2, batch_size=2)
+        for amount in (10, 20, 30):
+            self.balance.make_deposit(amount)
+        self.other.make_deposit(40)
+        webhooks.fan_out()
+
+        with self.respond(200, 200, 200) as request:
+            eq_(self.dispatcher.deliver(), {"delivered": 3, "retried": 0, "dead": 0})
+            eq_(self.dispatcher.deliver(), {"delivered": 1, "retried": 0, "dead": 0})
+        batches = [
+            [(event["data"]["owner"], event["data"]["amount"]) for event in body["events"]]
+            for body in self.posted(request)
+        ]
+        balance, other = str(self.balance.owner_id), str(self.other.owner_id)
+        # at most two of a queue per round, and the other account's deposit does not fit beside them
+        eq_(sorted(batches[:2]), sorted([[(balance, "10.00"), (balance, "20.00")], [(other, "40.00")]]))
+        eq_(batches[2], [(balance, "30.00")])
+
+    def test_dispatchers_side_by_side_keep_an_accounts_order(self):
+        deposits = [self.balance.make_deposit(amount) for amount in (10, 20, 30)]
+        webhooks.fan_out()
+        first = webhooks.Dispatcher(concurrency=1, batch_size=2)
+        second = webhooks.Dispatcher(concurrency=1, batch_size=10)
+
+        with mock.patch.object(webhooks, "_serialize", wraps=webhooks._serialize) as serialize:
+            claimed = first.claim()
+            # the rest of the queue waits until the first dispatcher's batch is done
+            eq_(second.claim(), [])
+        eq_(serialize.call_count, 2)
+        eq_([delivery.event.transaction_id for delivery in claimed], [deposit.pk for deposit in deposits[:2]])
+
+        first.record([(claimed, None)], OutboxEvent.objects.in_bulk())
+        eq_([delivery.event.transaction_id for delivery in second.claim()], [deposits[2].pk])
+
+    def test_sharded_accounts_events_are_held_before_fan_out(self):
+        self.balance.set_slot_count(2)
+        self.balance.make_deposit(50)
+
+        with override_settings(WEBHOOK_SHARDED_LAG=60):
+            eq_(webhooks.fan_out(), 0)
+        with override_settings(WEBHOOK_SHARDED_LAG=0):
+            eq_(webhooks.fan_out(), 1)
+
+    def test_deliveries_are_dead_lettered_after_max_attempts(self):
+        first = self.balance.make_deposit(50)
+        webhooks.fan_out()
+
+        with self.respond(503, 503):
+            eq_(self.dispatcher.deliver(), {"delivered": 0, "retried": 1, "dead": 0})
+            self.make_due()
+            eq_(self.dispatcher.deliver(), {"delivered": 0, "retried": 0, "dead": 1})
+        dead = WebhookDelivery.objects.get(event__transaction_id=first.pk)
+        eq_(dead.status, WebhookDelivery.DEAD)
+        eq_(dead.last_error, "Endpoint responded 503")
+
+        # a dead delivery no longer holds up the account's later events
+        self.balance.make_withdrawal(20)
+        webhooks.fan_out()
+        with self.respond(200):
+            eq_(self.dispatcher.deliver(), {"delivered": 1, "retried": 0, "dead": 0})
+        eq_(webhooks.redeliver(WebhookDelivery.objects.all()), 1)
+        with self.respond(200):
+            eq_(self.dispatcher.deliver(), {"delivered": 1, "retried": 0, "dead": 0})
+
+    def test_command_fans_out_and_delivers(self):
+        self.balance.make_deposit(50)
+        out = StringIO()
+
+        with mock.patch("urllib3.PoolManager.request", return_value=mock.Mock(status=204)):
+            call_command("dispatch_webhooks", once=True, concurrency=1, stdout=out)
+
+        ok_("1 event(s) and 1 delivery attempt(s)" in out.getvalue())
+        eq_(WebhookDelivery.objects.get().status, WebhookDelivery.DELIVERED)
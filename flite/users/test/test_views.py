@@ -1,5 +1,16 @@
+import csv
+import io
 import json
-
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+import mock
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, transaction
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.forms.models import model_to_dict
 from django.contrib.auth.hashers import check_password
@@ -7,8 +18,11 @@ from nose.tools import ok_, eq_
 from rest_framework.test import APITestCase
 from rest_framework import status
 from faker import Faker
-from ..models import User,UserProfile,Referral
+from .. import referral_codes, streams, tasks, verification
+from ..models import User, UserProfile, Referral, NewUserPhoneVerification
 from .factories import UserFactory, DepositFactory
+from ...core import authentication, idempotency, metrics
+from ...core.models import Job
 from ...core.utils import FAILURE_MSGS
 
 fake = Faker()
@@ -50,6 +64,44 @@ class TestUserListTestCase(APITestCase):
 
         eq_(Referral.objects.filter(referred__username=self.user_data['username'],owner__username=referring_user.username).exists(),True)
 
+    def test_signup_runs_one_insert_per_row(self):
+        referring_user = UserFactory()
+        self.user_data.update({"referral_code": referring_user.userprofile.referral_code})
+        # username and referral code checks, user, token, profile, balance
+        # and referral inserts, and the savepoint standing in for the
+        # signup transaction inside the test's one
+        with mock.patch.object(referral_codes, "allocate", return_value="ABCDEFGHJ"), \
+                self.assertNumQueries(2 + 1 + 1 + 1 + 1 + 1 + 2):
+            response = self.client.post(self.url, self.user_data)
+        eq_(response.status_code, status.HTTP_201_CREATED)
+
+    def test_failed_signup_leaves_nothing_behind(self):
+        with mock.patch("flite.users.signup.Token.objects.create", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError), self.assertLogs("django.request", "ERROR"):
+                self.client.post(self.url, self.user_data)
+        ok_(not User.objects.filter(username=self.user_data['username']).exists())
+
+    def test_referral_codes_match_regardless_of_case(self):
+        referring_user = UserFactory()
+        self.user_data.update({"referral_code": referring_user.userprofile.referral_code.lower()})
+        response = self.client.post(self.url, self.user_data)
+        eq_(response.status_code, status.HTTP_201_CREATED)
+        ok_(Referral.objects.filter(owner=referring_user, referred_id=response.data["id"]).exists())
+
+    def test_referral_codes_differing_only_in_case_are_rejected(self):
+        code = UserFactory().userprofile.referral_code
+        other = UserFactory().userprofile
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserProfile.objects.filter(pk=other.pk).update(referral_code=code.lower())
+
+    def test_referral_codes_are_allocated_in_blocks(self):
+        allocator = referral_codes.Allocator()
+        reserve_block = referral_codes._reserve_block
+        with mock.patch.object(referral_codes, "_reserve_block", wraps=reserve_block) as reserve:
+            codes = [allocator.allocate() for _ in range(referral_codes.BLOCK_SIZE + 1)]
+        eq_(reserve.call_count, 2)
+        eq_(len(set(codes)), len(codes))
+        ok_(all(len(code) == referral_codes.LENGTH for code in codes))
 
     def test_post_request_with_valid_data_succeeds_referral_is_not_created_if_code_is_invalid(self):
 
@@ -58,6 +110,105 @@ class TestUserListTestCase(APITestCase):
         eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class TestImportUsers(TestCase):
+
+    def import_users(self, content, suffix=".csv", **options):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix) as source:
+            source.write(content)
+            source.flush()
+            out = io.StringIO()
+            call_command("import_users", source.name, workers=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_imports_users_with_tokens_profiles_and_balances(self):
+        self.import_users("username,password,email\nada,s3cret-pass,ada@EXAMPLE.com\nbob,,\n")
+        ada = User.objects.get(username="ada")
+        ok_(ada.check_password("s3cret-pass"))
+        eq_(ada.email, "ada@example.com")
+        ok_(ada.auth_token.key)
+        ok_(ada.userprofile.referral_code)
+        eq_(ada.balance.available_balance, 0)
+        ok_(not User.objects.get(username="bob").has_usable_password())
+
+    def test_reimporting_skips_existing_users(self):
+        content = '{"username": "ada"}\n{"username": "bob"}\n'
+        self.import_users(content, suffix=".ndjson")
+        output = self.import_users(content, suffix=".ndjson", chunk_size=1)
+        ok_("Created 0 user(s), skipped 2" in output)
+        eq_(User.objects.filter(username__in=["ada", "bob"]).count(), 2)
+
+    def test_rows_without_username_are_rejected(self):
+        with self.assertRaises(CommandError):
+            self.import_users("username,email\n,ada@example.com\n")
+
+
+class TestPhoneVerification(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('newuserphoneverification-list')
+        self.data = {'phone_number': '+2348031234567', 'email': fake.email()}
+
+    def send(self):
+        response = self.client.post(self.url, self.data)
+        eq_(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id'], response.data['verification_code']
+
+    def verify(self, verification_id, code):
+        url = reverse('newuserphoneverification-detail', kwargs={'pk': verification_id})
+        return self.client.put(url, {'code': code})
+
+    def test_sending_a_code_only_queues_the_sms(self):
+        with self.assertNumQueries(1):
+            self.send()
+        ok_(not NewUserPhoneVerification.objects.exists())
+        job = Job.objects.get()
+        eq_(job.name, tasks.send_sms_verification_code.job_name)
+        eq_(json.loads(job.arguments)["args"], [self.data['phone_number'], mock.ANY])
+
+    def test_correct_code_is_recorded_in_one_query(self):
+        verification_id, code = self.send()
+        with self.assertNumQueries(1):
+            response = self.verify(verification_id, code)
+        eq_(response.data['verification_code_status'], '1')
+        record = NewUserPhoneVerification.objects.get(phone_number=self.data['phone_number'])
+        ok_(record.is_verified)
+        eq_(record.email, self.data['email'])
+
+        with self.assertNumQueries(0):
+            response = self.verify(verification_id, code)
+        eq_(response.data['verification_code_status'], '0')
+
+    def test_verifying_a_number_again_updates_its_record(self):
+        for _ in range(2):
+            self.verify(*self.send())
+        eq_(NewUserPhoneVerification.objects.filter(phone_number=self.data['phone_number']).count(), 1)
+
+    def test_incorrect_codes_are_limited(self):
+        verification_id, code = self.send()
+        with override_settings(PHONE_VERIFICATION_MAX_ATTEMPTS=2), self.assertNumQueries(0):
+            eq_(self.verify(verification_id, 'nope').status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.verify(verification_id, 'nope')
+            ok_('Too many' in response.data['message'])
+            eq_(self.verify(verification_id, code).status_code, status.HTTP_404_NOT_FOUND)
+        ok_(not NewUserPhoneVerification.objects.exists())
+
+    def test_expired_codes_are_rejected(self):
+        verification_id, code = self.send()
+        cache.delete(verification.cache_key(verification_id))
+        eq_(self.verify(verification_id, code).status_code, status.HTTP_404_NOT_FOUND)
+        ok_(not NewUserPhoneVerification.objects.exists())
+
+    def test_sending_is_throttled_per_number(self):
+        rates = {'phone_verification_ip': '100/hour', 'phone_verification_number': '2/hour'}
+        with mock.patch('rest_framework.throttling.SimpleRateThrottle.THROTTLE_RATES', rates):
+            self.send()
+            self.send()
+            eq_(self.client.post(self.url, self.data).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.data['phone_number'] = '+2348037654321'
+            self.send()
+
+
 class TestUserDetailTestCase(APITestCase):
     """
     Tests /users detail operations.
@@ -82,6 +233,78 @@ class TestUserDetailTestCase(APITestCase):
         eq_(user.first_name, new_first_name)
 
 
+class TestCachedTokenAuthentication(APITestCase):
+    """
+    Tests token lookups through the token cache
+    """
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.url = reverse('account-balance', kwargs={'account_id': self.user.pk})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.user.auth_token}')
+
+    def test_repeated_requests_do_not_look_up_the_token(self):
+        eq_(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        hits = metrics.sample("auth_token_cache_hits_total")
+
+        with self.assertNumQueries(0):
+            eq_(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        eq_(metrics.sample("auth_token_cache_hits_total"), hits + 1)
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get(self.url)
+        self.user.auth_token.delete()
+        eq_(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        eq_(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_copies_held_by_other_workers_are_not_used_after_revocation(self):
+        self.client.get(self.url)
+        name = authentication.cache_key(self.user.auth_token.key)
+        entry = authentication._local.get(name)
+        self.user.is_active = False
+        self.user.save()
+
+        # as if the copy was in another worker's cache, which the save did not reach
+        authentication._local.set(name, entry)
+        eq_(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_generations_never_repeat_after_they_expire(self):
+        name = authentication.cache_key(self.user.auth_token.key)
+        authentication.invalidate(self.user.auth_token.key)
+        self.client.get(self.url)
+        entry = authentication._local.get(name)
+        # as if the revocation cache evicted the generation the entry was cached under
+        cache.delete(authentication.generation_key(name))
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        authentication.invalidate_user(self.user)
+        # held by another worker, which the invalidation did not reach
+        authentication._local.set(name, entry)
+        eq_(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_shared_cache_is_used_and_invalidated(self):
+        with override_settings(TOKEN_SHARED_CACHE='default'):
+            self.client.get(self.url)
+            key = authentication.cache_key(self.user.auth_token.key)
+            ok_(cache.get(key) is not None)
+
+            self.user.auth_token.delete()
+            eq_(cache.get(key), None)
+
+    def test_local_cache_is_bounded(self):
+        lru = authentication.LRUCache(max_size=2, ttl=60)
+        for key in "abc":
+            lru.set(key, key)
+        eq_(len(lru), 2)
+        eq_(lru.get("a"), None)
+        eq_(lru.get("c"), "c")
+
+
 class TestTransactions(APITestCase):
     """
        Tests user transactions
@@ -202,12 +425,227 @@ class TestTransactions(APITestCase):
         eq_(FAILURE_MSGS["no_self_p2p"], json.loads(response.content)[0])
         eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_user_can_make_a_bulk_p2p_transfer(self):
+        user3 = UserFactory()
+        payload = {"transfers": [
+            {"recipient": str(self.user2.pk), "amount": 40},
+            {"recipient": str(user3.pk), "amount": 70},
+            {"recipient": str(user3.pk), "amount": 50},
+        ]}
+        response = self.client.post(self._set_url("bulk-p2p-transfer-url", sender_account_id=self.user.pk),
+                                    payload, format="json")
+        eq_(response.status_code, status.HTTP_201_CREATED)
+        eq_(response.data["status"], "partial")
+        eq_([result["status"] for result in response.data["results"]], ["complete", "failed", "complete"])
+
+        self.user.balance.refresh_from_db()
+        eq_(self.user.balance.available_balance, 10)
+        user3.balance.refresh_from_db()
+        eq_(user3.balance.available_balance, 50)
+
+    def test_user_can_make_a_bulk_p2p_transfer_fails(self):
+        """
+        Bulk transfers need at least one valid item
+        """
+        url = self._set_url("bulk-p2p-transfer-url", sender_account_id=self.user.pk)
+        response = self.client.post(url, {"transfers": []}, format="json")
+        eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        payload = {"transfers": [{"recipient": str(self.user2.pk), "amount": 0}]}
+        response = self.client.post(url, payload, format="json")
+        eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_user_can_fetch_all_transactions(self):
         response = self.client.get(self.transactions_url)
         # assert after fetching data
         eq_(response.status_code, status.HTTP_200_OK)
         eq_(self.user.transaction.count(), 1)
 
+    def test_user_can_page_through_transactions(self):
+        for _ in range(4):
+            self.user.balance.make_deposit(10)
+
+        seen = []
+        url = self.transactions_url + "?page_size=2"
+        while url:
+            response = self.client.get(url)
+            eq_(response.status_code, status.HTTP_200_OK)
+            ok_("count" not in response.data)
+            seen += [transaction["id"] for transaction in response.data["results"]]
+            url = response.data["next"]
+
+        eq_(len(seen), 5)
+        expected = self.user.transaction.order_by("-created", "-id").values_list("id", flat=True)
+        eq_(seen, [str(pk) for pk in expected])
+
+    def test_user_can_fetch_transactions_with_count(self):
+        response = self.client.get(self.transactions_url + "?count=true")
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response.data["count"], 1)
+        eq_(response.data["next"], None)
+
+    def test_user_can_fetch_transactions_with_invalid_cursor_fails(self):
+        response = self.client.get(self.transactions_url + "?cursor=bm90LWEtY3Vyc29y")
+        eq_(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_user_can_filter_transactions(self):
+        self.user.balance.make_deposit(300)
+        self.user.balance.make_withdrawal(50)
+        withdrawal = self.user.balance.make_withdrawal(250)
+
+        def fetch(query):
+            response = self.client.get(self.transactions_url + "?" + query)
+            eq_(response.status_code, status.HTTP_200_OK)
+            return [transaction["amount"] for transaction in response.data["results"]]
+
+        eq_(fetch("type=withdrawal"), ["250.00", "50.00"])
+        eq_(fetch("type=withdrawal&type=deposit&min_amount=100"), ["250.00", "300.00"])
+        eq_(fetch("max_amount=100&type=withdrawal"), ["50.00"])
+        eq_(fetch("reference=" + withdrawal.reference), ["250.00"])
+        eq_(fetch("status=failed"), [])
+        eq_(fetch("created_after=" + withdrawal.created.isoformat().replace("+", "%2B")), ["250.00"])
+
+    def test_user_can_filter_transactions_fails(self):
+        response = self.client.get(self.transactions_url + "?type=refund")
+        eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_user_can_export_transactions_as_csv(self):
+        self.user.balance.make_deposit(10)
+        response = self.client.get(self._set_url("user-transactions-export", account_id=self.user.pk))
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response["Content-Type"], "text/csv")
+
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        eq_(len(rows), 2)
+        eq_(rows[-1]["type"], "deposit")
+        eq_(rows[-1]["amount"], "10.00")
+
+    def test_user_can_export_transactions_as_ndjson(self):
+        url = self._set_url("user-transactions-export", account_id=self.user.pk) + "?file_format=ndjson"
+        response = self.client.get(url)
+        eq_(response.status_code, status.HTTP_200_OK)
+
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        eq_([json.loads(line)["id"] for line in lines], [str(self.user.transaction.first().id)])
+
+    def test_user_can_export_a_date_range(self):
+        deposit = self.user.balance.make_deposit(10)
+        url = self._set_url("user-transactions-export", account_id=self.user.pk)
+        url += "?file_format=ndjson&created_after={}".format(quote(deposit.created.isoformat()))
+
+        lines = b"".join(self.client.get(url).streaming_content).decode().splitlines()
+        eq_([json.loads(line)["id"] for line in lines], [str(deposit.pk)])
+
+    def test_user_can_export_transactions_fails(self):
+        url = self._set_url("user-transactions-export", account_id=self.user.pk) + "?file_format=xml"
+        eq_(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
+        url = self._set_url("user-transactions-export", account_id=self.user.pk) + "?created_after=yesterday"
+        eq_(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
+        url = self._set_url("user-transactions-export", account_id=self.user2.pk)
+        eq_(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def _events(self, content):
+        events = []
+        for block in content.split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+            if fields.get("event") == "transaction":
+                events.append((int(fields["id"]), json.loads(fields["data"])))
+        return events
+
+    @override_settings(TRANSACTION_STREAM_HEARTBEAT=0.01, TRANSACTION_STREAM_MAX_DURATION=0.05)
+    def test_user_can_stream_transactions(self):
+        first = self.user.balance.make_deposit(10)
+        second = self.user.balance.make_withdrawal(5)
+        url = self._set_url("user-transactions-stream", account_id=self.user.pk)
+
+        response = self.client.get(url, HTTP_LAST_EVENT_ID="0", HTTP_ACCEPT="text/event-stream")
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response["Content-Type"], "text/event-stream")
+        events = self._events(b"".join(response.streaming_content).decode())
+        eq_([data["id"] for _, data in events], [str(first.pk), str(second.pk)])
+
+        # resuming from the first event sends only the second
+        response = self.client.get(url + "?last_event_id={}".format(events[0][0]))
+        eq_(self._events(b"".join(response.streaming_content).decode()), events[1:])
+
+    def test_user_can_stream_transactions_fails(self):
+        url = self._set_url("user-transactions-stream", account_id=self.user.pk)
+        eq_(self.client.get(url, HTTP_LAST_EVENT_ID="latest").status_code, status.HTTP_400_BAD_REQUEST)
+
+        url = self._set_url("user-transactions-stream", account_id=self.user2.pk)
+        response = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+        eq_(response.status_code, status.HTTP_403_FORBIDDEN)
+        ok_(response.content.startswith(b"event: error\n"))
+
+        # only the stream server serves streams
+        url = self._set_url("user-transactions-stream", account_id=self.user.pk)
+        with override_settings(TRANSACTION_STREAMS_ENABLED=False):
+            eq_(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_sends_transactions_made_after_it_opened(self):
+        self.user.balance.make_deposit(10)
+        stream = streams.stream(self.user.pk, heartbeat=0.01, max_duration=5)
+        ok_(next(stream).startswith("retry: "))
+
+        deposit = self.user.balance.make_deposit(20)
+        event = next(stream)
+        stream.close()
+        eq_([data["id"] for _, data in self._events(event)], [str(deposit.pk)])
+
+    def test_stream_sends_transfers_the_account_received(self):
+        stream = streams.stream(self.user2.pk, heartbeat=0.01, max_duration=5)
+        next(stream)
+
+        transfer = self.user.balance.make_p2p_transfer(30, self.user2.balance)
+        events = self._events(next(stream))
+        stream.close()
+        eq_(
+            [(data["id"], data["receipient"]) for _, data in events], [(str(transfer.pk), str(self.user2.pk))]
+        )
+
+    def test_stream_is_woken_by_the_hub(self):
+        stream = streams.stream(self.user.pk, last_event_id=0, heartbeat=10, max_duration=10)
+        next(stream)
+        with mock.patch.object(streams, "_read", side_effect=[([], None), ([(7, '{"id": "x"}')], None)]):
+            threading.Timer(0.05, streams.hub.publish, [[self.user.pk]]).start()
+            began = time.monotonic()
+            event = next(stream)
+        stream.close()
+        ok_(time.monotonic() - began < 5)
+        eq_(event, 'id: 7\nevent: transaction\ndata: {"id": "x"}\n\n')
+
+    @override_settings(TRANSACTION_STREAM_SHARDED_LAG=0.2)
+    def test_sharded_accounts_events_are_held_until_earlier_ones_have_committed(self):
+        self.user.balance.set_slot_count(2)
+        deposit = self.user.balance.make_deposit(10)
+
+        # a credit to another slot could still commit with a lower id
+        events, held = streams._read(self.user.pk, 0)
+        eq_(events, [])
+        ok_(0 < held <= 0.2)
+
+        # the stream reads again once the event is old enough, without waiting for a heartbeat
+        stream = streams.stream(self.user.pk, last_event_id=0, heartbeat=10, max_duration=10)
+        next(stream)
+        began = time.monotonic()
+        events = self._events(next(stream))
+        stream.close()
+        ok_(time.monotonic() - began < 5)
+        eq_([data["id"] for _, data in events], [str(deposit.pk)])
+
+    def test_postings_wake_their_accounts_streams(self):
+        wake = streams.hub.subscribe(self.user.pk)
+        try:
+            with mock.patch("django.db.transaction.on_commit", side_effect=lambda func: func()):
+                self.user2.balance.make_deposit(10)
+                ok_(not wake.is_set())
+                self.user.balance.make_deposit(10)
+            ok_(wake.is_set())
+        finally:
+            streams.hub.unsubscribe(self.user.pk, wake)
+
     def test_user_can_fetch_a_single_transaction(self):
         response = self.client.get(self.transaction_url)
         eq_(response.status_code, status.HTTP_200_OK)
@@ -233,5 +671,116 @@ class TestTransactions(APITestCase):
         ))
         eq_(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_user_can_fetch_balance(self):
+        url = self._set_url("account-balance", account_id=self.user.pk)
+        response = self.client.get(url)
+        eq_(response.status_code, status.HTTP_200_OK)
+        eq_(response.data, {"available_balance": "100.00", "book_balance": "100.00"})
+
+        # the second read is served from the cache
+        self.user.balance.available_balance = 0
+        self.user.balance.save()
+        eq_(self.client.get(url).data["available_balance"], "100.00")
+
+    def test_user_can_fetch_balance_fails(self):
+        url = self._set_url("account-balance", account_id=self.user2.pk)
+        eq_(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(REQUEST_TIMING_SAMPLE_RATE=1)
+    def test_sampled_requests_report_their_timings(self):
+        with mock.patch("flite.core.middleware.logger") as logger:
+            response = self.client.post(self.p2p_transfer_url, {"amount": 30})
+
+        eq_(response.status_code, status.HTTP_201_CREATED)
+        timings = dict(part.split(";", 1) for part in response["Server-Timing"].split(", "))
+        for name in ("auth", "db", "lock", "serializer", "view", "total"):
+            ok_(timings[name].startswith("dur="), name)
+        line = json.loads(logger.info.call_args[0][0])
+        eq_(line["path"], self.p2p_transfer_url)
+        ok_(line["sql_count"] > 0)
+        ok_('"{} queries"'.format(line["sql_count"]) in timings["sql"])
+
+    def test_requests_are_not_instrumented_unless_sampled(self):
+        response = self.client.post(self.p2p_transfer_url, {"amount": 30})
+        ok_(not response.has_header("Server-Timing"))
+
+    def test_metrics_are_exported(self):
+        self.client.post(self.deposit_url, {"amount": 100})
+        self.client.post(self.withdrawal_url, {"amount": 500})
+
+        response = self.client.get(reverse("metrics"))
+        eq_(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        for line in (
+            'ledger_postings_total{outcome="complete",type="deposit"}',
+            'ledger_postings_total{outcome="insufficient_funds",type="withdrawal"}',
+            'http_request_duration_seconds_bucket{le="0.005",method="POST",route="deposit-url"}',
+            "auth_token_cache_hits_total",
+            "ledger_retries_total",
+        ):
+            ok_(line in body, line)
+
+    def test_unknown_methods_are_labelled_other(self):
+        labels = {"method": "other", "route": "deposit-url", "status": "405"}
+        before = metrics.sample("http_requests_total", **labels)
+
+        self.client.generic("BREW", self.deposit_url)
+
+        eq_(metrics.sample("http_requests_total", **labels), before + 1)
+        eq_(metrics.sample("http_requests_total", method="BREW", route="deposit-url", status="405"), 0)
+
+    @override_settings(METRICS_TOKEN="scraper")
+    def test_metrics_require_the_token_when_configured(self):
+        eq_(self.client.get(reverse("metrics")).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.credentials(HTTP_AUTHORIZATION="Bearer scraper")
+        response = self.client.get(reverse("metrics"))
+        eq_(response.status_code, status.HTTP_200_OK)
+
+    def test_deposit_with_repeated_idempotency_key_is_applied_once(self):
+        first = self.client.post(self.deposit_url, {"amount": 100}, HTTP_IDEMPOTENCY_KEY="deposit-1")
+        retry = self.client.post(self.deposit_url, {"amount": 100}, HTTP_IDEMPOTENCY_KEY="deposit-1")
+
+        eq_(first.status_code, status.HTTP_201_CREATED)
+        eq_(retry.status_code, status.HTTP_201_CREATED)
+        eq_(retry.data, first.data)
+        eq_(retry["Idempotent-Replayed"], "true")
+        self.user.balance.refresh_from_db()
+        eq_(self.user.balance.available_balance, 200)
+
+    def test_p2p_transfer_with_repeated_idempotency_key_is_applied_once(self):
+        for _ in range(2):
+            response = self.client.post(self.p2p_transfer_url, {"amount": 30}, HTTP_IDEMPOTENCY_KEY="p2p-1")
+            eq_(response.status_code, status.HTTP_201_CREATED)
+
+        self.user.balance.refresh_from_db()
+        eq_(self.user.balance.available_balance, 70)
+
+    def test_idempotency_key_reused_with_different_payload_fails(self):
+        self.client.post(self.withdrawal_url, {"amount": 10}, HTTP_IDEMPOTENCY_KEY="withdrawal-1")
+        response = self.client.post(self.withdrawal_url, {"amount": 20}, HTTP_IDEMPOTENCY_KEY="withdrawal-1")
+
+        eq_(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.user.balance.refresh_from_db()
+        eq_(self.user.balance.available_balance, 90)
+
+    def test_failed_request_is_not_replayed(self):
+        payload = {"amount": 150}
+        response = self.client.post(self.withdrawal_url, payload, HTTP_IDEMPOTENCY_KEY="withdrawal-2")
+        eq_(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.post(self.deposit_url, {"amount": 100})
+        response = self.client.post(self.withdrawal_url, payload, HTTP_IDEMPOTENCY_KEY="withdrawal-2")
+        eq_(response.status_code, status.HTTP_201_CREATED)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0)
+    def test_request_with_in_flight_idempotency_key_conflicts(self):
+        request = mock.Mock(user=self.user, method="POST", path=self.deposit_url)
+        cache.add(idempotency._cache_key(request, "deposit-3") + ":lock", True)
+
+        response = self.client.post(self.deposit_url, {"amount": 100}, HTTP_IDEMPOTENCY_KEY="deposit-3")
+        eq_(response.status_code, status.HTTP_409_CONFLICT)
+        self.user.balance.refresh_from_db()
+        eq_(self.user.balance.available_balance, 100)
+
     def _set_url(self, reverse_name, **kwargs):
         return reverse(reverse_name, kwargs={**kwargs})
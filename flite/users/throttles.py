@@ -0,0 +1,24 @@
+from phonenumber_field.phonenumber import to_python
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class PhoneVerificationIPThrottle(SimpleRateThrottle):
+    """Limits how many verification codes one client address can request"""
+    scope = "phone_verification_ip"
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {"scope": self.scope, "ident": self.get_ident(request)}
+
+
+class PhoneVerificationNumberThrottle(SimpleRateThrottle):
+    """Limits how many verification codes are sent to one phone number"""
+    scope = "phone_verification_number"
+
+    def get_cache_key(self, request, view):
+        value = request.data.get("phone_number")
+        phone_number = to_python(str(value)) if value else None
+        if phone_number is None or not phone_number.is_valid():
+            # the serializer rejects the request
+            return None
+        # one key per number, however it is written
+        return self.cache_format % {"scope": self.scope, "ident": phone_number.as_e164}
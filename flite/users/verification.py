@@ -0,0 +1,132 @@
+"""
+Phone number verification.
+
+A code sent to a phone number waits in the PHONE_VERIFICATION_CACHE for
+PHONE_VERIFICATION_CODE_TTL seconds, under a random id the client sends
+back along with the code. Sending a code only queues the SMS job, and
+checking one costs no query: only a correct one is written to
+NewUserPhoneVerification, with a single upsert. After
+PHONE_VERIFICATION_MAX_ATTEMPTS wrong codes the pending code is dropped
+and a new one has to be requested. Production refuses a cache that is
+local to one process, so every worker sees the same codes and attempt
+counts.
+"""
+import hmac
+import secrets
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils import timezone
+
+from . import tasks
+
+CODE_DIGITS = 6
+
+VERIFIED = "verified"
+ALREADY_VERIFIED = "already_verified"
+INCORRECT = "incorrect"
+TOO_MANY_ATTEMPTS = "too_many_attempts"
+EXPIRED = "expired"
+
+
+def _cache():
+    return caches[settings.PHONE_VERIFICATION_CACHE]
+
+
+def cache_key(verification_id):
+    return "phone-verification:{}".format(verification_id)
+
+
+def attempts_key(verification_id):
+    return "phone-verification-attempts:{}".format(verification_id)
+
+
+def generate_code():
+    return str(secrets.randbelow(10 ** CODE_DIGITS)).zfill(CODE_DIGITS)
+
+
+def start(phone_number, email):
+    """
+    Creates a pending verification for ``phone_number``
+
+    Returns:
+        The id of the verification and the code to send
+    """
+    verification_id = str(uuid.uuid4())
+    code = generate_code()
+    pending = {"phone_number": str(phone_number), "email": email or "", "code": code}
+    ttl = settings.PHONE_VERIFICATION_CODE_TTL
+    _cache().set_many({cache_key(verification_id): pending, attempts_key(verification_id): 0}, ttl)
+    tasks.send_sms_verification_code.delay(pending["phone_number"], code)
+    return verification_id, code
+
+
+def check(verification_id, code):
+    """
+    Checks ``code`` against the pending verification ``verification_id``
+    and records the phone number as verified if it matches
+
+    Returns:
+        One of VERIFIED, ALREADY_VERIFIED, INCORRECT, TOO_MANY_ATTEMPTS
+        and EXPIRED
+    """
+    cache = _cache()
+    key = cache_key(verification_id)
+    pending = cache.get(key)
+    if pending is None:
+        return EXPIRED
+    if pending.get("verified"):
+        return ALREADY_VERIFIED
+    if not hmac.compare_digest(pending["code"], str(code)):
+        try:
+            attempts = cache.incr(attempts_key(verification_id))
+        except ValueError:
+            # the counter expired first
+            attempts = settings.PHONE_VERIFICATION_MAX_ATTEMPTS
+        if attempts < settings.PHONE_VERIFICATION_MAX_ATTEMPTS:
+            return INCORRECT
+        cache.delete_many([key, attempts_key(verification_id)])
+        return TOO_MANY_ATTEMPTS
+
+    record_verified(verification_id, pending)
+    # kept so that repeating the request is answered from the cache
+    cache.set(key, dict(pending, verified=True), settings.PHONE_VERIFICATION_CODE_TTL)
+    cache.delete(attempts_key(verification_id))
+    return VERIFIED
+
+
+def record_verified(verification_id, pending):
+    """Inserts or updates the NewUserPhoneVerification of the phone number in one query"""
+    from .models import NewUserPhoneVerification
+
+    meta = NewUserPhoneVerification._meta
+    now = timezone.now()
+    values = {
+        "id": uuid.UUID(verification_id),
+        "created": now,
+        "modified": now,
+        "phone_number": pending["phone_number"],
+        "verification_code": pending["code"],
+        "is_verified": True,
+        "email": pending["email"],
+    }
+    fields = [meta.get_field(name) for name in values]
+    quote = connection.ops.quote_name
+    updated = ("modified", "verification_code", "is_verified", "email")
+    # ON CONFLICT ... DO UPDATE is understood by both Postgres and SQLite
+    sql = (
+        "INSERT INTO {table} ({columns}) VALUES ({params}) "
+        "ON CONFLICT ({phone}) DO UPDATE SET {updates}"
+    ).format(
+        table=quote(meta.db_table),
+        columns=", ".join(quote(field.column) for field in fields),
+        params=", ".join(["%s"] * len(fields)),
+        phone=quote(meta.get_field("phone_number").column),
+        updates=", ".join(
+            "{0} = EXCLUDED.{0}".format(quote(meta.get_field(name).column)) for name in updated
+        ),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [field.get_db_prep_save(values[field.name], connection) for field in fields])
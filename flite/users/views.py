@@ -1,8 +1,17 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, mixins, status
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
-from .models import User, NewUserPhoneVerification, Transaction
+from rest_framework.renderers import JSONRenderer
+from flite.core.idempotency import idempotent
+from flite.core.pagination import KeysetPagination
+from flite.core.renderers import EventStreamRenderer
+from .models import User, NewUserPhoneVerification, TransactionEntry
 from .permissions import IsUserOrReadOnly, OwnerOnlyPermission
+from .throttles import PhoneVerificationIPThrottle, PhoneVerificationNumberThrottle
 from .serializers import (
     CreateUserSerializer,
     UserSerializer,
@@ -10,9 +19,11 @@ from .serializers import (
     CreateDepositSerializer,
     CreateWithdrawalSerializer,
     CreateP2PSerializer,
+    CreateBulkP2PSerializer,
     ListTransactionsSerializer,
 )
-from . import utils
+from . import balance_cache, exports, streams, verification
+from .filters import TransactionEntryFilter
 
 
 class UserViewSet(mixins.RetrieveModelMixin,
@@ -39,30 +50,39 @@ class UserCreateViewSet(mixins.CreateModelMixin,
         return UserSerializer if self.action == "list" else CreateUserSerializer
 
 
-class SendNewPhonenumberVerifyViewSet(mixins.CreateModelMixin,mixins.UpdateModelMixin, viewsets.GenericViewSet):
+class SendNewPhonenumberVerifyViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin,
+                                      viewsets.GenericViewSet):
     """
-    Sending of verification code
+    Sending and checking of verification codes. Pending codes live in the
+    cache, see verification
     """
-    queryset = NewUserPhoneVerification.objects.all()
+    queryset = NewUserPhoneVerification.objects.none()
     serializer_class = SendNewPhonenumberSerializer
     permission_classes = (AllowAny,)
 
+    def get_throttles(self):
+        if self.action == "create":
+            return [PhoneVerificationIPThrottle(), PhoneVerificationNumberThrottle()]
+        return super().get_throttles()
 
-    def update(self, request, pk=None,**kwargs):
-        verification_object = self.get_object()
+    def update(self, request, pk=None, **kwargs):
         code = request.data.get("code")
 
         if code is None:
-            return Response({"message":"Request not successful"}, 400)
+            return Response({"message": "Request not successful"}, 400)
 
-        if verification_object.verification_code != code:
-            return Response({"message":"Verification code is incorrect"}, 400)
-
-        code_status, msg = utils.validate_mobile_signup_sms(verification_object.phone_number, code)
+        outcome = verification.check(pk, code)
+        if outcome == verification.EXPIRED:
+            return Response({"message": "Verification code has expired or does not exist"}, 404)
+        if outcome == verification.INCORRECT:
+            return Response({"message": "Verification code is incorrect"}, 400)
+        if outcome == verification.TOO_MANY_ATTEMPTS:
+            return Response({"message": "Too many incorrect codes, request a new one"}, 400)
 
+        verified = outcome == verification.VERIFIED
         content = {
-                'verification_code_status': str(code_status),
-                'message': msg,
+            'verification_code_status': str(int(verified)),
+            'message': "Code verified" if verified else "Code has been verified",
         }
         return Response(content, 200)
 
@@ -71,6 +91,7 @@ class SendNewPhonenumberVerifyViewSet(mixins.CreateModelMixin,mixins.UpdateModel
 class DepositCreateViewSet(viewsets.ViewSet):
     permission_classes = (OwnerOnlyPermission,)
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = CreateDepositSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -87,6 +108,7 @@ class DepositCreateViewSet(viewsets.ViewSet):
 class WithdrawalCreateViewSet(viewsets.ViewSet):
     permission_classes = (OwnerOnlyPermission,)
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = CreateWithdrawalSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -103,6 +125,7 @@ class WithdrawalCreateViewSet(viewsets.ViewSet):
 class P2PCreateViewSet(viewsets.ViewSet):
     permission_classes = (OwnerOnlyPermission, )
 
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = CreateP2PSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -116,12 +139,49 @@ class P2PCreateViewSet(viewsets.ViewSet):
         return Response(ctx, status=status.HTTP_201_CREATED)
 
 
+class BulkP2PCreateViewSet(viewsets.ViewSet):
+    permission_classes = (OwnerOnlyPermission, )
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        serializer = CreateBulkP2PSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save(request.user, kwargs)
+
+        completed = sum(1 for result in results if result["status"] == "complete")
+        if completed == len(results):
+            batch_status = "complete"
+        elif completed:
+            batch_status = "partial"
+        else:
+            batch_status = "failed"
+        ctx = {
+            "status": batch_status,
+            "transaction_type": "p2p transfer",
+            "results": results,
+        }
+        return Response(ctx, status=status.HTTP_201_CREATED)
+
+
+class BalanceViewSet(viewsets.ViewSet):
+    """
+    Returns the balance of an account from the balance cache
+    """
+    permission_classes = (OwnerOnlyPermission,)
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(balance_cache.get_balance(request.user.pk))
+
+
 class ListTransactionsViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     serializer_class = ListTransactionsSerializer
     permission_classes = (OwnerOnlyPermission,)
+    pagination_class = KeysetPagination
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = TransactionEntryFilter
 
     def get_queryset(self):
-        return Transaction.objects.filter(owner=self.request.user).select_subclasses()
+        return TransactionEntry.objects.filter(owner=self.request.user)
 
 
 class RetrieveTransactionViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
@@ -130,5 +190,62 @@ class RetrieveTransactionViewSet(mixins.RetrieveModelMixin, viewsets.GenericView
     lookup_url_kwarg = "transaction_id"
 
     def get_queryset(self):
-        return Transaction.objects.filter(owner=self.request.user).select_subclasses()
+        return TransactionEntry.objects.filter(owner=self.request.user)
+
+
+class ExportTransactionsViewSet(viewsets.ViewSet):
+    """
+    Streams the transaction history of an account as CSV or NDJSON,
+    narrowed by the same filters as the transaction list
+    """
+    permission_classes = (OwnerOnlyPermission,)
 
+    def list(self, request, *args, **kwargs):
+        file_format = request.query_params.get("file_format", "csv")
+        if file_format not in exports.CONTENT_TYPES:
+            return Response(
+                {"file_format": ["Choose one of: {}".format(", ".join(sorted(exports.CONTENT_TYPES)))]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        filterset = TransactionEntryFilter(
+            request.query_params, queryset=exports.export_queryset(owner=request.user)
+        )
+        if not filterset.is_valid():
+            return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+        queryset = filterset.qs
+        response = StreamingHttpResponse(
+            exports.stream(queryset, file_format), content_type=exports.CONTENT_TYPES[file_format]
+        )
+        response["Content-Disposition"] = 'attachment; filename="transactions-{}.{}"'.format(
+            request.user.pk, file_format
+        )
+        return response
+
+
+class StreamTransactionsViewSet(viewsets.ViewSet):
+    """
+    Streams the new transactions of an account as server-sent events,
+    from after the Last-Event-ID header or ``last_event_id`` parameter
+    when one is given
+    """
+    permission_classes = (OwnerOnlyPermission,)
+    renderer_classes = (JSONRenderer, EventStreamRenderer)
+
+    def list(self, request, *args, **kwargs):
+        if not settings.TRANSACTION_STREAMS_ENABLED:
+            # served by the stream server, so streams never hold the API's threads
+            raise NotFound("Transaction streams are not served here.")
+        last_event_id = request.META.get("HTTP_LAST_EVENT_ID") or request.query_params.get("last_event_id")
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                return Response({"last_event_id": ["A valid integer is required."]},
+                                status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(
+            streams.stream(request.user.pk, last_event_id), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        # keeps nginx from buffering the events
+        response["X-Accel-Buffering"] = "no"
+        return response
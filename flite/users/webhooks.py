@@ -0,0 +1,295 @@
+"""
+Webhook delivery of outbox events.
+
+A Dispatcher round has two steps:
+
+1. ``fan_out`` claims undispatched OutboxEvents and creates a
+   WebhookDelivery for every active endpoint that wants them. Credits to
+   a sharded balance take no balance lock and can commit out of id
+   order, so a sharded account's events are only fanned out once they
+   are WEBHOOK_SHARDED_LAG seconds old, by when every event before them
+   has committed.
+2. ``deliver`` claims due deliveries. The undelivered deliveries of an
+   endpoint and account form a queue, and only its first
+   WEBHOOK_BATCH_SIZE are claimed, stopping at the first one that is
+   being sent or waiting for a retry. An account's claimed deliveries go
+   out in one batch, in order, so they reach the endpoint in order even
+   across retries. Batches hold up to WEBHOOK_BATCH_SIZE events of one
+   endpoint, and up to WEBHOOK_CONCURRENCY of them are posted at once
+   over pooled connections.
+
+Any number of dispatchers can run side by side. On Postgres they fan out
+and claim one at a time, under a transaction-level advisory lock, so
+each sees the deliveries the one before it claimed: otherwise the one
+that claimed the start of an account's queue might not have taken all of
+it, and the next could claim the rest and send it alongside. Posting the
+batches, which is where the time goes, is not serialized.
+
+A batch answered with a 2xx status is delivered. Any other answer is
+retried with the job backoff, and after WEBHOOK_MAX_ATTEMPTS the
+deliveries are dead-lettered: marked dead, and no longer holding up
+later events of their account.
+
+Each request carries ``X-Flite-Signature: sha256=<hex>``, the HMAC-SHA256
+of the body keyed with the endpoint's secret.
+"""
+import collections
+import hashlib
+import hmac
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import urllib3
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Exists, OuterRef, Q, TextField, Value, When
+from django.utils import timezone
+
+from flite.core import jobs, metrics
+from flite.core.db.claim import claim
+from . import outbox
+
+
+deliveries_total = metrics.counter(
+    "webhook_deliveries_total", "Webhook deliveries by outcome (delivered, retried or dead)",
+    labelnames=("outcome",)
+)
+batch_seconds = metrics.histogram("webhook_batch_seconds", "Time for an endpoint to take a batch of events")
+event_lag_seconds = metrics.histogram(
+    "webhook_event_lag_seconds", "Time from a ledger event to its delivery",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600),
+)
+
+# pg_advisory_xact_lock key that dispatchers fan out and claim under
+CLAIM_LOCK_KEY = 0x666c77
+
+# the first deliveries of each endpoint and account queue that are due,
+# up to the first one being sent or waiting for a retry
+_CLAIMABLE_SQL = """
+{table}.id IN (SELECT id FROM (
+    SELECT id,
+           ROW_NUMBER() OVER (PARTITION BY endpoint_id, account_id ORDER BY event_id) AS position,
+           SUM(CASE WHEN status = %s AND next_attempt_at <= %s THEN 0 ELSE 1 END)
+               OVER (PARTITION BY endpoint_id, account_id ORDER BY event_id) AS blocked
+    FROM {table}
+    WHERE status IN (%s, %s)
+) queues
+WHERE blocked = 0 AND position <= %s)
+"""
+
+
+def signature(secret, body):
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _serialize():
+    """Waits for the other dispatchers' fan-outs and claims, until the current transaction ends"""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CLAIM_LOCK_KEY])
+
+
+def fan_out(limit=None):
+    """
+    Creates the deliveries of up to ``limit`` undispatched events
+
+    Returns:
+        The number of events dispatched
+    """
+    from .models import Balance, OutboxEvent, WebhookDelivery, WebhookEndpoint
+
+    now = timezone.now()
+    sharded = Balance.objects.filter(owner_id=OuterRef("account_id"), slot_count__gt=1)
+    # a sharded account's credits can still commit with lower ids
+    recent = Q(sharded=True, created__gt=now - timedelta(seconds=settings.WEBHOOK_SHARDED_LAG))
+    with transaction.atomic():
+        _serialize()
+        events = claim(
+            OutboxEvent.objects.filter(dispatched_at__isnull=True).annotate(sharded=Exists(sharded))
+            .exclude(recent), ("id",),
+            limit or settings.WEBHOOK_BATCH_SIZE * settings.WEBHOOK_CONCURRENCY, {"dispatched_at": now},
+        )
+        if events:
+            endpoints = list(WebhookEndpoint.objects.filter(is_active=True))
+            WebhookDelivery.objects.bulk_create([
+                WebhookDelivery(
+                    endpoint=endpoint, event=event, account_id=event.account_id, next_attempt_at=now
+                )
+                for event in sorted(events, key=lambda event: event.pk)
+                for endpoint in endpoints if endpoint.wants(event.type)
+            ])
+    return len(events)
+
+
+class Dispatcher(object):
+
+    def __init__(self, concurrency=None, batch_size=None):
+        self.concurrency = concurrency or settings.WEBHOOK_CONCURRENCY
+        self.batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+        self.executor = ThreadPoolExecutor(self.concurrency) if self.concurrency > 1 else None
+        # one connection per concurrent batch to each endpoint host
+        self.http = urllib3.PoolManager(
+            maxsize=self.concurrency,
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(total=settings.WEBHOOK_TIMEOUT),
+        )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.http.clear()
+
+    def claim(self):
+        """Marks the next deliveries of each endpoint and account as being sent and returns them"""
+        from .models import WebhookDelivery
+
+        now = timezone.now()
+        meta = WebhookDelivery._meta
+        due_at = meta.get_field("next_attempt_at").get_db_prep_value(now, connection)
+        due = WebhookDelivery.objects.filter(status=WebhookDelivery.PENDING).extra(
+            where=[_CLAIMABLE_SQL.format(table=connection.ops.quote_name(meta.db_table))],
+            params=[
+                WebhookDelivery.PENDING, due_at,
+                WebhookDelivery.PENDING, WebhookDelivery.SENDING,
+                self.batch_size,
+            ],
+        )
+        with transaction.atomic():
+            _serialize()
+            claimed = claim(
+                due, ("event_id",), self.batch_size * self.concurrency,
+                {"status": WebhookDelivery.SENDING, "locked_at": now, "modified": now},
+                increment=("attempts",),
+            )
+        return sorted(claimed, key=lambda delivery: delivery.event_id)
+
+    def send(self, endpoint, deliveries, events):
+        """Posts one batch to ``endpoint``, returning None on success or the error"""
+        messages = [outbox.as_message(events[delivery.event_id]) for delivery in deliveries]
+        body = json.dumps({"events": messages}).encode()
+        headers = {"Content-Type": "application/json", "X-Flite-Signature": signature(endpoint.secret, body)}
+        try:
+            with batch_seconds.time():
+                response = self.http.request("POST", endpoint.url, body=body, headers=headers)
+        except urllib3.exceptions.HTTPError as exc:
+            return "Endpoint unreachable: {}".format(exc)
+        except Exception as exc:
+            return repr(exc)
+        if not 200 <= response.status < 300:
+            return "Endpoint responded {}".format(response.status)
+        return None
+
+    def deliver(self):
+        """
+        Sends one round of due deliveries
+
+        Returns:
+            A Counter of the outcomes, empty when nothing was due
+        """
+        from .models import OutboxEvent, WebhookEndpoint
+
+        deliveries = self.claim()
+        if not deliveries:
+            return collections.Counter()
+        endpoints = WebhookEndpoint.objects.in_bulk({delivery.endpoint_id for delivery in deliveries})
+        events = OutboxEvent.objects.in_bulk({delivery.event_id for delivery in deliveries})
+
+        batches = [
+            (endpoints[endpoint_id], batch_deliveries)
+            for endpoint_id, batch_deliveries in self.batches(deliveries)
+        ]
+
+        def send(batch):
+            endpoint, batch_deliveries = batch
+            return batch_deliveries, self.send(endpoint, batch_deliveries, events)
+
+        results = map(send, batches) if self.executor is None else self.executor.map(send, batches)
+        return self.record(results, events)
+
+    def batches(self, deliveries):
+        """
+        Splits claimed ``deliveries``, in event order, into batches of one
+        endpoint, never splitting an account's deliveries: batches are
+        posted concurrently, so only within one batch is their order kept
+        """
+        queues = collections.OrderedDict()
+        for delivery in deliveries:
+            queues.setdefault((delivery.endpoint_id, delivery.account_id), []).append(delivery)
+        open_batches = {}
+        batches = []
+        for (endpoint_id, _), queue in queues.items():
+            batch = open_batches.get(endpoint_id)
+            if batch is None or len(batch) + len(queue) > self.batch_size:
+                batch = open_batches[endpoint_id] = []
+                batches.append((endpoint_id, batch))
+            batch.extend(queue)
+        for _, batch in batches:
+            batch.sort(key=lambda delivery: delivery.event_id)
+        return batches
+
+    def record(self, results, events):
+        """Writes the outcome of every delivery back to its row"""
+        from .models import WebhookDelivery
+
+        now = timezone.now()
+        delivered, retried, dead = [], {}, {}
+        for batch_deliveries, error in results:
+            for delivery in batch_deliveries:
+                if error is None:
+                    delivered.append(delivery.pk)
+                    lag = (now - events[delivery.event_id].created).total_seconds()
+                    event_lag_seconds.observe(max(lag, 0))
+                elif delivery.attempts < settings.WEBHOOK_MAX_ATTEMPTS:
+                    retried.setdefault(delivery.attempts, {})[delivery.pk] = error
+                else:
+                    dead[delivery.pk] = error
+
+        if delivered:
+            WebhookDelivery.objects.filter(pk__in=delivered).update(
+                status=WebhookDelivery.DELIVERED, delivered_at=now, modified=now, locked_at=None,
+                last_error="",
+            )
+        for attempts, errors in retried.items():
+            WebhookDelivery.objects.filter(pk__in=errors).update(
+                status=WebhookDelivery.PENDING, modified=now, locked_at=None,
+                next_attempt_at=now + timedelta(seconds=jobs.backoff(attempts)), last_error=_each(errors),
+            )
+        if dead:
+            WebhookDelivery.objects.filter(pk__in=dead).update(
+                status=WebhookDelivery.DEAD, modified=now, locked_at=None, last_error=_each(dead),
+            )
+
+        counts = collections.Counter(
+            delivered=len(delivered), retried=sum(len(errors) for errors in retried.values()), dead=len(dead)
+        )
+        for outcome, count in counts.items():
+            deliveries_total.labels(outcome=outcome).inc(count)
+        return counts
+
+
+def _each(errors):
+    return Case(
+        *[When(pk=pk, then=Value(error, output_field=TextField())) for pk, error in errors.items()],
+        output_field=TextField(),
+    )
+
+
+def requeue_stale():
+    """Makes deliveries pending again whose dispatcher stopped while sending them"""
+    from .models import WebhookDelivery
+
+    cutoff = timezone.now() - timedelta(seconds=settings.WEBHOOK_LOCK_TIMEOUT)
+    return WebhookDelivery.objects.filter(status=WebhookDelivery.SENDING, locked_at__lt=cutoff).update(
+        status=WebhookDelivery.PENDING, locked_at=None, modified=timezone.now()
+    )
+
+
+def redeliver(deliveries):
+    """Gives dead-lettered ``deliveries`` a fresh set of attempts"""
+    from .models import WebhookDelivery
+
+    return deliveries.filter(status=WebhookDelivery.DEAD).update(
+        status=WebhookDelivery.PENDING, attempts=0, next_attempt_at=timezone.now(), modified=timezone.now()
+    )